@@ -0,0 +1,43 @@
+"""
+Benchmark comparing the JSON and binary message codecs.
+
+Measures encode and decode throughput and the number of bytes
+sent over the network (frame included) for typical messages::
+
+   $ python benchmarks/bench_codec.py -n 100000
+"""
+
+import timeit
+import click
+from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.codec import CODECS
+from soucevi1_dist_chat.framing import HEADER
+
+
+MESSAGES = {
+    'user': CMessage(sender_address='192.168.100.200', sender_port=45678, sender_name='Lojza',
+                     message_type=MessageType.user_message, message_data='Ahoj, jak se mas?', time=123456),
+    'election': CMessage(sender_address='192.168.100.200', sender_port=45678, sender_name='Lojza',
+                         message_type=MessageType.election_message,
+                         message_data={'addr': '192.168.100.200', 'port': 45678}, time=123456),
+}
+
+
+@click.command()
+@click.option('-n', '--number', type=int, default=100000, help='Number of encodings/decodings per measurement')
+def main(number):
+    """
+    Run the benchmark and print one line per codec and message kind.
+    """
+    print(f'{"message":<10}{"codec":<8}{"bytes":>7}{"encode/s":>12}{"decode/s":>12}')
+    for kind, message in MESSAGES.items():
+        for name, codec in CODECS.items():
+            payload = codec.encode(message)
+            encode = timeit.timeit(lambda: codec.encode(message), number=number)
+            decode = timeit.timeit(lambda: codec.decode(payload), number=number)
+            print(f'{kind:<10}{name:<8}{len(payload) + HEADER.size:>7}'
+                  f'{number / encode:>12.0f}{number / decode:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Benchmark running a whole chat of real nodes on the loopback.
+
+N nodes are started in one process. Their input is scripted instead of read
+from the prompt and the received messages are recorded instead of printed.
+The benchmark measures:
+
+   * join: time for all N nodes to join the ring one after another
+   * broadcast: throughput and p50/p99 latency of user messages sent by random nodes
+   * repair: time to renew the ring after a random (non-leader) node crashes
+   * election: time until all nodes agree on a new leader after the leader crashes
+
+One JSON line with the results is printed for every N and every event loop
+(asyncio and uvloop by default, uvloop falls back to asyncio when it is not
+installed, the "loop" key tells which one was really used)::
+
+   $ python benchmarks/bench_ring.py -n 10 -n 100 -n 500 --loop asyncio --loop uvloop
+
+All the nodes share one event loop, so a long burst delays the heartbeats
+of everyone and the failure detectors would suspect healthy nodes.
+The heartbeats are therefore disabled by default, the crashes are detected
+by the closed connections.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import resource
+import time
+import click
+from soucevi1_dist_chat.chat_io import CallbackOutput, IteratorInput
+from soucevi1_dist_chat.CNode import CNode, DISSEMINATION_MODES
+from soucevi1_dist_chat.event_loop import LOOPS, use_loop
+
+
+async def queue_lines(queue):
+    """
+    Scripted input of a node: the messages put in the queue.
+    """
+    while True:
+        yield await queue.get()
+
+
+def key(address, port):
+    return str(address), str(port)
+
+
+def ring_complete(nodes):
+    """
+    :param nodes: Running nodes
+    :return: True if the next and prev links of the nodes form one ring
+             and the leader has a connection to every other node
+    """
+    by_key = {key(n.address, n.port): n for n in nodes}
+    leaders = [n for n in nodes if n.is_leader]
+    if len(leaders) != 1 or len(leaders[0].connections) != len(nodes) - 1:
+        return False
+    if len(nodes) == 1:
+        return True
+
+    leader = leaders[0]
+    node, visited = leader, set()
+    for _ in nodes:
+        if key(node.leader_address, node.leader_port) != key(leader.address, leader.port):
+            return False
+        nxt = by_key.get(key(node.next_node_address, node.next_node_port))
+        if nxt is None or node.next_node_writer is None or nxt.prev_node_writer is None:
+            return False
+        if key(nxt.prev_node_address, nxt.prev_node_port) != key(node.address, node.port) and len(nodes) > 2:
+            return False
+        visited.add(key(node.address, node.port))
+        node = nxt
+    return node is leader and len(visited) == len(nodes)
+
+
+async def wait_until(condition, timeout):
+    """
+    :return: Seconds until the condition became true
+    :raises asyncio.TimeoutError: The condition did not become true in time
+    """
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            raise asyncio.TimeoutError
+        await asyncio.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def bench(count, messages, base_port, timeout, options):
+    """
+    Run all the measurements with a chat of the given number of nodes.
+
+    :return: Dictionary with the results
+    """
+    latencies = []
+    nodes, tasks, inputs = [], [], {}
+    result = {'nodes': count}
+    phase = 'join'
+
+    def record(message):
+        # Only the benchmark messages carry the time they were sent
+        if isinstance(message.message_data, list):
+            latencies.append(time.perf_counter() - message.message_data[1])
+
+    def start(port, leader):
+        lines = asyncio.Queue()
+        node = CNode(leader, '127.0.0.1', port, None if leader else '127.0.0.1', None if leader else base_port,
+                     f'n{port - base_port}', input_source=IteratorInput(queue_lines(lines)),
+                     output=CallbackOutput(record), **options)
+        inputs[node] = lines
+        nodes.append(node)
+        tasks.append(asyncio.create_task(node.run()))
+
+    try:
+        # Join
+        began = time.perf_counter()
+        start(base_port, True)
+        await asyncio.sleep(0.05)
+        for i in range(1, count):
+            start(base_port + i, False)
+            await wait_until(lambda: ring_complete(nodes), timeout)
+        result['join'] = time.perf_counter() - began
+
+        # Broadcast
+        phase = 'broadcast'
+        latencies.clear()
+        expected = messages * (count - 1)
+        began = time.perf_counter()
+        for i in range(messages):
+            inputs[random.choice(nodes)].put_nowait([i, time.perf_counter()])
+            if i % 100 == 99:
+                await asyncio.sleep(0)
+        await wait_until(lambda: len(latencies) >= expected, timeout)
+        elapsed = time.perf_counter() - began
+        result['broadcast'] = {'messages': messages, 'deliveries': len(latencies),
+                               'messages_per_s': messages / elapsed, 'deliveries_per_s': len(latencies) / elapsed,
+                               'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99)}
+
+        # Repair after a crash of a random node (not the leader)
+        if count > 2:
+            phase = 'repair'
+            victim = random.choice([n for n in nodes if not n.is_leader])
+            nodes.remove(victim)
+            victim.close()
+            result['repair'] = await wait_until(lambda: ring_complete(nodes), timeout)
+
+        # Election after a crash of the leader
+        if count > 1:
+            phase = 'election'
+            victim = next(n for n in nodes if n.is_leader)
+            nodes.remove(victim)
+            victim.close()
+            result['election'] = await wait_until(lambda: ring_complete(nodes), timeout)
+    except asyncio.TimeoutError:
+        result['timeout'] = phase
+    finally:
+        for node in nodes:
+            node.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return result
+
+
+@click.command()
+@click.option('-n', '--nodes', type=int, multiple=True,
+              help='Number of nodes, can be repeated. 10, 100 and 500 by default')
+@click.option('-m', '--messages', type=int, default=1000, show_default=True, help='Number of broadcast messages')
+@click.option('--base-port', type=int, default=30000, show_default=True, help='Port of the first node')
+@click.option('--timeout', type=float, default=60.0, show_default=True, help='Seconds to wait for each phase')
+@click.option('--heartbeat-interval', type=float, default=0.0, show_default=True,
+              help='Heartbeat interval of the nodes, 0 disables the heartbeats')
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed choosing the senders and the crashed node')
+@click.option('--loop', 'loops', type=click.Choice(LOOPS), multiple=True,
+              help='Event loop, can be repeated. Both asyncio and uvloop by default')
+@click.option('--dissemination', type=click.Choice(DISSEMINATION_MODES), default='star', show_default=True,
+              help='Broadcast mode of the leader')
+@click.option('--fanout', type=int, default=4, show_default=True, help='Fanout of the gossip mode')
+@click.option('--relay-threshold', type=int, default=64, show_default=True,
+              help='Number of nodes from which the leader uses relays, 0 disables them')
+def main(nodes, messages, base_port, timeout, heartbeat_interval, seed, loops, dissemination, fanout,
+         relay_threshold):
+    """
+    Run the benchmark and print one JSON line per number of nodes and event loop.
+    """
+    logging.basicConfig(level=logging.CRITICAL)
+
+    # Every node needs a few sockets
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    options = {'heartbeat_interval': heartbeat_interval, 'dissemination': dissemination, 'fanout': fanout,
+               'relay_threshold': relay_threshold}
+    for count in nodes or (10, 100, 500):
+        for loop in loops or LOOPS:
+            random.seed(seed)
+            used = use_loop(loop)
+            result = {'loop': used, 'dissemination': dissemination}
+            result.update(asyncio.run(bench(count, messages, base_port, timeout, options)))
+            print(json.dumps(result), flush=True)
+            base_port += count
+
+
+if __name__ == '__main__':
+    main()
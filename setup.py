@@ -36,6 +36,9 @@ setup(
         'prompt_toolkit',
         'asyncio'
     ],
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
     setup_requires=[
         'pytest-runner'
     ],
@@ -0,0 +1,348 @@
+from enum import Enum
+import asyncio
+import logging
+import random
+import time
+from soucevi1_dist_chat.framing import MAX_FRAME_SIZE, encode_batch
+
+
+def peer_key(address, port):
+    """
+    Key identifying a peer node by its listening address and port.
+    Ports may come as strings (CLI) or integers (messages).
+
+    :param address: IP address of the peer
+    :param port: Port of the peer
+    :return: Hashable key
+    """
+    return str(address), str(port)
+
+
+class OverflowPolicy(Enum):
+    """
+    What happens when a message is sent to a connection whose queue is full
+
+       * drop_oldest: the oldest queued message is dropped to make room for the new one
+
+       * disconnect: the slow connection is closed and removed
+
+       * block: the sender waits until there is room in the queue
+    """
+    drop_oldest = 'drop-oldest'
+    disconnect = 'disconnect'
+    block = 'block'
+
+
+class CConnection:
+    """
+    Class representing a connection of the leader to one node of the chat.
+    Messages sent to the node are put in a bounded queue and written
+    by a separate task, so one slow node does not delay the others.
+    With a batch window, the task waits a moment for more messages
+    and packs them into one batch frame.
+    The connection counts the traffic and remembers its last activity.
+    """
+
+    __slots__ = ('addr', 'port', 'reader', 'writer', 'policy', 'on_close', 'queue', 'task',
+                 'bytes_sent', 'messages_sent', 'messages_dropped', 'last_activity', 'detector',
+                 'batch_window', 'batch_size', 'log')
+
+    def __init__(self, address, port, reader, writer, queue_size=1024, policy=OverflowPolicy.block, on_close=None,
+                 detector=None, batch_window=0.0, batch_size=64, log=None):
+        """
+        :param address: IP address of the node
+        :param port: Port of the node
+        :param reader: Stream reader of the connection
+        :param writer: Stream writer of the connection
+        :param queue_size: Maximum number of frames waiting to be written
+        :param policy: OverflowPolicy applied when the queue is full
+        :param on_close: Callback called with this connection when it fails
+        :param detector: Failure detector fed by the activity of the node
+        :param batch_window: Seconds to wait for more messages to batch, 0 disables batching
+        :param batch_size: Maximum number of messages in one batch
+        :param log: Logger of the node owning the connection
+        """
+        self.addr = address
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.policy = OverflowPolicy(policy)
+        self.on_close = on_close
+        self.queue = asyncio.Queue(queue_size)
+        self.task = None
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.last_activity = time.monotonic()
+        self.detector = detector
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.log = log if log is not None else logging.getLogger(__name__)
+
+    def key(self):
+        """
+        :return: Key of the node this connection leads to
+        """
+        return peer_key(self.addr, self.port)
+
+    def touch(self):
+        """
+        Record activity (e.g. a received message) on the connection.
+        """
+        self.last_activity = time.monotonic()
+        if self.detector is not None:
+            self.detector.alive(self.last_activity)
+
+    def start(self):
+        """
+        Start the task writing the queued frames to the connection.
+        """
+        self.task = asyncio.create_task(self.run_sender())
+
+    async def send(self, frame):
+        """
+        Queue the frame to be written to the connection.
+
+        :param frame: Encoded frame
+        :return: False if the connection overflowed and must be disconnected, True otherwise
+        """
+        if not self.queue.full():
+            self.queue.put_nowait(frame)
+            return True
+
+        if self.policy == OverflowPolicy.block:
+            await self.queue.put(frame)
+        elif self.policy == OverflowPolicy.drop_oldest:
+            self.queue.get_nowait()
+            self.queue.put_nowait(frame)
+            self.messages_dropped += 1
+            self.log.warning(f'{self.addr}:{self.port} is too slow, dropped the oldest message')
+        else:
+            return False
+        return True
+
+    def offer(self, frame):
+        """
+        Queue the frame only if there is room in the queue.
+        Used for frames that can be lost, such as heartbeats.
+
+        :param frame: Encoded frame
+        :return: True if the frame was queued
+        """
+        if self.queue.full():
+            return False
+        self.queue.put_nowait(frame)
+        return True
+
+    async def run_sender(self):
+        """
+        Coroutine writing the queued frames to the connection.
+        All the frames already waiting are written before one drain.
+        With batching, the sender waits for the rest of a burst until
+        the batch is full or the batch window ends, whichever comes first.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                frames = [await self.queue.get()]
+                if self.batch_window:
+                    deadline = loop.time() + self.batch_window
+                    while len(frames) + self.queue.qsize() < self.batch_size:
+                        remaining = deadline - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            frames.append(await asyncio.wait_for(self.queue.get(), remaining))
+                        except asyncio.TimeoutError:
+                            break
+                while not self.queue.empty():
+                    frames.append(self.queue.get_nowait())
+                self.write_frames(frames)
+                await self.writer.drain()
+                self.last_activity = time.monotonic()
+        except ConnectionError:
+            self.log.error(f'{self.addr}:{self.port} not reachable to broadcast')
+            if self.on_close is not None:
+                self.on_close(self)
+
+    def write_frames(self, frames):
+        """
+        Write the frames to the connection, packed in batches if batching is enabled.
+
+        :param frames: Frames to write
+        """
+        if not self.batch_window:
+            for frame in frames:
+                self.writer.write(frame)
+                self.bytes_sent += len(frame)
+            self.messages_sent += len(frames)
+            return
+
+        for start in range(0, len(frames), self.batch_size):
+            chunk = frames[start:start + self.batch_size]
+            size = sum(len(frame) for frame in chunk)
+            if len(chunk) == 1 or size >= MAX_FRAME_SIZE:
+                self.writer.writelines(chunk)
+            else:
+                self.writer.write(encode_batch(chunk))
+            self.messages_sent += len(chunk)
+            self.bytes_sent += size
+
+    def close(self):
+        """
+        Stop the writing task and close the connection.
+        """
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+class ConnectionRegistry:
+    """
+    Connections of the leader indexed by the reader, the writer
+    and the (address, port) of the node, so that every lookup is O(1).
+    Iterating the registry yields the connections in the order they were added.
+
+    The registry also keeps the features the peers announced (e.g. relaying
+    the ring broadcast) and counts the registered connections lacking each
+    of them, so that checking whether all the nodes support a feature is O(1).
+    A list of the connections in arbitrary order is kept for the random sampling.
+    """
+
+    def __init__(self, connections=()):
+        """
+        :param connections: Initial CConnection instances
+        """
+        self.by_reader = {}
+        self.by_writer = {}
+        self.by_peer = {}
+        self.sampled = []
+        self.position = {}
+        self.features = {}
+        self.lacking = {}
+        for conn in connections:
+            self.add(conn)
+
+    def add(self, conn):
+        """
+        Add the connection. A connection to the same node that
+        was registered before is replaced.
+
+        :param conn: CConnection to add
+        :return: Replaced CConnection or None
+        """
+        replaced = self.by_peer.get(conn.key())
+        if replaced is not None:
+            self.remove(replaced)
+        self.by_reader[conn.reader] = conn
+        self.by_writer[conn.writer] = conn
+        self.by_peer[conn.key()] = conn
+        self.position[conn.key()] = len(self.sampled)
+        self.sampled.append(conn)
+        self.count_lacking(conn.key(), 1)
+        return replaced
+
+    def remove(self, conn):
+        """
+        Remove the connection, if it is registered.
+
+        :param conn: CConnection to remove
+        :return: True if the connection was removed
+        """
+        if self.by_peer.get(conn.key()) is not conn:
+            return False
+        del self.by_peer[conn.key()]
+        self.by_reader.pop(conn.reader, None)
+        self.by_writer.pop(conn.writer, None)
+        # The last connection takes the place of the removed one
+        index = self.position.pop(conn.key())
+        last = self.sampled.pop()
+        if last is not conn:
+            self.sampled[index] = last
+            self.position[last.key()] = index
+        self.count_lacking(conn.key(), -1)
+        return True
+
+    def sample(self, k):
+        """
+        :param k: Number of the connections, at most the number of the registered ones
+        :return: List of k distinct random connections
+        """
+        return [self.sampled[index] for index in random.sample(range(len(self.sampled)), k)]
+
+    def count_lacking(self, key, change):
+        """
+        :param key: Key of a connection added to or removed from the registry
+        :param change: 1 if it was added, -1 if it was removed
+        """
+        for feature, peers in self.features.items():
+            if key not in peers:
+                self.lacking[feature] += change
+
+    def set_feature(self, key, feature, supported):
+        """
+        Record whether the peer announced the feature. The peer does not need to be registered (yet).
+
+        :param key: Key of the peer, see peer_key
+        :param feature: Name of the feature
+        :param supported: True if the peer announced the feature
+        """
+        if feature not in self.features:
+            self.features[feature] = set()
+            self.lacking[feature] = len(self.by_peer)
+        peers = self.features[feature]
+        if supported == (key in peers):
+            return
+        if key in self.by_peer:
+            self.lacking[feature] += -1 if supported else 1
+        if supported:
+            peers.add(key)
+        else:
+            peers.discard(key)
+
+    def supports(self, key, feature):
+        """
+        :param key: Key of the peer, see peer_key
+        :param feature: Name of the feature
+        :return: True if the peer announced the feature
+        """
+        return key in self.features.get(feature, ())
+
+    def supported_by_all(self, feature):
+        """
+        :param feature: Name of the feature
+        :return: True if all the registered connections announced the feature
+        """
+        return self.lacking.get(feature, len(self.by_peer)) == 0
+
+    def find_by_reader(self, reader):
+        """
+        :param reader: Stream reader of the connection
+        :return: CConnection or None
+        """
+        return self.by_reader.get(reader)
+
+    def find_by_writer(self, writer):
+        """
+        :param writer: Stream writer of the connection
+        :return: CConnection or None
+        """
+        return self.by_writer.get(writer)
+
+    def find_by_peer(self, address, port):
+        """
+        :param address: IP address of the node
+        :param port: Port of the node
+        :return: CConnection or None
+        """
+        return self.by_peer.get(peer_key(address, port))
+
+    def __len__(self):
+        return len(self.by_peer)
+
+    def __iter__(self):
+        return iter(self.by_peer.values())
+
+    def __contains__(self, conn):
+        return self.by_peer.get(conn.key()) is conn
@@ -1,5 +1,6 @@
 from enum import Enum
 import json
+from soucevi1_dist_chat.framing import encode_frame
 
 
 class MessageType(Enum):
@@ -19,6 +20,28 @@ class MessageType(Enum):
        * hello_leader_message: let the leader know about new node
 
        * elected_message: leader is already elected
+
+       * capabilities_message: codecs supported by the node, sent when a connection opens
+
+       * heartbeat_message: sign of life sent periodically to the neighbors and the leader
+
+       * ring_user_message: user message stamped by the leader, relayed by every node to its next node
+
+       * gossip_message: user message stamped by the leader, pushed by every node to a few peers
+
+       * membership_message: peers the leader tells a node about, to fill its partial view
+
+       * relay_assign_message: the leader assigns a relay the block of nodes it forwards the broadcast to
+
+       * relay_user_message: user message stamped by the leader, forwarded by the relay to its block
+
+       * ack_message: the leader received the user messages of the node up to the given sender_seq
+
+       * probe_message: candidate of the Hirschberg-Sinclair election probing its neighborhood
+
+       * reply_message: the probe of the candidate reached the end of its neighborhood
+
+       * successors_message: the next node tells its previous node the successors it should keep
     """
     user_message = 1
     login_message = 2
@@ -27,14 +50,47 @@ class MessageType(Enum):
     hello_leader_message = 5
     election_message = 6
     elected_message = 7
+    capabilities_message = 8
+    heartbeat_message = 9
+    ring_user_message = 10
+    gossip_message = 11
+    membership_message = 12
+    relay_assign_message = 13
+    relay_user_message = 14
+    ack_message = 15
+    probe_message = 16
+    reply_message = 17
+    successors_message = 18
+
+
+# Attributes caching the encoded forms of the message
+CACHE_ATTRIBUTES = ('raw', 'raw_codec', 'frames')
 
 
 class CMessage:
     """
     Class representing a single instance of a message that is sent
     during chatting or inside mechanisms of the program.
+
+    The message remembers the payload it was received as (raw)
+    and caches the frames it was encoded into, so that forwarding
+    and broadcasting do not encode the same message again.
+    Changing any attribute of the message drops the cache.
+
+    The user messages broadcast by the leader carry the sequence number
+    the leader stamped them with (seq), other messages do not have any.
+    The user messages of the nodes carry the sequence number of their author (sender_seq),
+    the leader acknowledges them and drops the retransmitted ones.
+    Messages of other channels than the default one carry the name of the channel.
     """
 
+    seq = None
+    sender_seq = None
+    channel = None
+    raw = None
+    raw_codec = None
+    frames = None
+
     def __init__(self, **kwargs):
         """
         This concstructor serves as two constructors in fact.
@@ -49,6 +105,9 @@ class CMessage:
         :param message_data: Data carried by the message, the cli_main body
         :param message_json: JSON received by the server
         :param message_str: same as JSON, in string format
+        :param seq: Sequence number stamped by the leader, optional
+        :param sender_seq: Sequence number of the author, optional
+        :param channel: Name of the channel, None for the default channel
         """
         if 'message_json' in kwargs:
             self.from_json(kwargs['message_json'])
@@ -62,9 +121,33 @@ class CMessage:
                 self.message_type = kwargs['message_type']
             else:
                 self.message_type = kwargs['message_type'].value
+            if kwargs.get('seq') is not None:
+                self.seq = kwargs['seq']
+            if kwargs.get('sender_seq') is not None:
+                self.sender_seq = kwargs['sender_seq']
+            if kwargs.get('channel') is not None:
+                self.channel = kwargs['channel']
         elif 'message_str' in kwargs:
             self.from_string(kwargs['message_str'])
 
+    def __setattr__(self, name, value):
+        # The encoded forms do not match the changed message anymore.
+        if name not in CACHE_ATTRIBUTES:
+            for attribute in CACHE_ATTRIBUTES:
+                self.__dict__.pop(attribute, None)
+        object.__setattr__(self, name, value)
+
+    def set_raw(self, payload, codec_name):
+        """
+        Remember the payload the message was received as.
+        Sending the message using the same codec reuses the payload.
+
+        :param payload: Received frame payload
+        :param codec_name: Name of the codec the payload is encoded with
+        """
+        self.raw = payload
+        self.raw_codec = codec_name
+
     def convert_to_json(self):
         """
         Convert message to JSON.
@@ -82,6 +165,13 @@ class CMessage:
         else:
             d['m_type'] = self.message_type.value
 
+        if self.seq is not None:
+            d['seq'] = self.seq
+        if self.sender_seq is not None:
+            d['sseq'] = self.sender_seq
+        if self.channel is not None:
+            d['chan'] = self.channel
+
         j = json.dumps(d)
         return json.loads(j)
 
@@ -102,9 +192,40 @@ class CMessage:
         else:
             d['m_type'] = self.message_type.value
 
+        if self.seq is not None:
+            d['seq'] = self.seq
+        if self.sender_seq is not None:
+            d['sseq'] = self.sender_seq
+        if self.channel is not None:
+            d['chan'] = self.channel
+
         j = json.dumps(d)
         return j
 
+    def convert_to_frame(self, codec=None):
+        """
+        Convert message to the length-prefixed frame sent over the network.
+        The frame is encoded only once per codec, the same bytes object
+        is returned for every recipient.
+
+        :param codec: Codec used to encode the message, JSON if not given
+        :return: Frame bytes
+        """
+        codec_name = 'json' if codec is None else codec.name
+        if self.frames is None:
+            self.frames = {}
+
+        frame = self.frames.get(codec_name)
+        if frame is None:
+            if self.raw is not None and self.raw_codec == codec_name:
+                payload = self.raw
+            elif codec is None:
+                payload = self.convert_to_string().encode()
+            else:
+                payload = codec.encode(self)
+            frame = self.frames[codec_name] = encode_frame(payload)
+        return frame
+
     def from_json(self, received_json):
         """
         Convert JSON to the CMessage class.
@@ -116,6 +237,12 @@ class CMessage:
         self.sender_name = received_json['s_name']
         self.message_data = received_json['data']
         self.time = received_json['time']
+        if received_json.get('seq') is not None:
+            self.seq = received_json['seq']
+        if received_json.get('sseq') is not None:
+            self.sender_seq = received_json['sseq']
+        if received_json.get('chan') is not None:
+            self.channel = received_json['chan']
         if type(received_json['m_type']) == int:
             self.message_type = received_json['m_type']
         else:
@@ -1,11 +1,79 @@
 from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.CConnection import CConnection, ConnectionRegistry, OverflowPolicy, peer_key
 import asyncio
-import sys
+from collections import deque
+import hashlib
+import ipaddress
 import logging
-from soucevi1_dist_chat.colors import Colors
-from prompt_toolkit import prompt
-from prompt_toolkit.eventloop.defaults import use_asyncio_event_loop
-from prompt_toolkit.patch_stdout import patch_stdout
+import math
+import os
+import random
+from time import perf_counter, time_ns
+from soucevi1_dist_chat.codec import CODECS, JSON_CODEC, choose_codec, decode_payload
+from soucevi1_dist_chat.chat_io import ConsoleOutput, PromptInput, prompt_text
+from soucevi1_dist_chat.election import ELECTIONS
+from soucevi1_dist_chat.failure_detector import PhiAccrualDetector
+from soucevi1_dist_chat.framing import HEADER, FrameDecoder, FrameError, read_frame, unpack_batches
+from soucevi1_dist_chat.history import MessageHistory, plain_copy
+from soucevi1_dist_chat.message_log import MessageLog
+from soucevi1_dist_chat.metrics import MetricsRegistry
+
+# Maximum number of bytes read from a stream at once.
+# All complete frames contained in the data are handled.
+READ_SIZE = 65536
+
+# Metric names of the handled message types, built once instead of for every message.
+RECEIVED_COUNTERS = {m_type: f'received.{m_type.name}' for m_type in MessageType}
+HANDLE_HISTOGRAMS = {m_type: f'handle.{m_type.name}' for m_type in MessageType}
+
+# How the leader broadcasts the user messages:
+# star - the leader sends every message to every node itself,
+# ring - the leader sends every message to its next node, the nodes relay it along the ring,
+# gossip - the leader sends every message to a few nodes, every node pushes it to a few peers.
+DISSEMINATION_MODES = ['star', 'ring', 'gossip']
+
+# Number of peers in the partial view of a node used by the gossip
+GOSSIP_VIEW_SIZE = 16
+
+# Number of the recent gossip message IDs a node remembers to drop the duplicates
+GOSSIP_SEEN_SIZE = 4096
+
+# Number of the recent (author, number) pairs of the user messages a node remembers to drop the duplicates
+DELIVERED_SEEN_SIZE = 4096
+
+# Seconds a node whose previous node died waits for the node before the dead one to connect
+# through its successor list, before it sends the prev inform message around the ring
+SUCCESSOR_REPAIR_WAIT = 1.0
+
+# Seconds a node waits for the connection to a successor of its dead next node
+SUCCESSOR_CONNECT_TIMEOUT = 1.0
+
+# Seconds a node waits for a new connection to the leader it suspected dead
+LEADER_CONNECT_TIMEOUT = 1.0
+
+# Maximum seconds a node waits before it sends its outbox to a new leader,
+# so that the nodes do not all send theirs right after the election
+OUTBOX_FLUSH_JITTER = 0.2
+
+
+def set_event(event, state):
+    """
+    Set or clear the event according to the state.
+
+    :param event: asyncio.Event
+    :param state: True to set the event, False to clear it
+    """
+    if state:
+        event.set()
+    else:
+        event.clear()
+
+
+class NodeError(Exception):
+    """
+    Fatal error of one node. Only the node is stopped,
+    other nodes running in the same process continue.
+    """
 
 
 class CNode:
@@ -13,7 +81,39 @@ class CNode:
     Class that represents the node -- one participant of the chat.
     """
 
-    def __init__(self, is_leader, address, port, neighbor_address, neighbor_port, name=''):
+    def __init__(self, is_leader, address, port, neighbor_address, neighbor_port, name='', codecs=None,
+                 send_queue_size=1024, overflow_policy=OverflowPolicy.block,
+                 heartbeat_interval=1.0, phi_threshold=8.0, batch_window=0.0, batch_size=64, stats_port=None,
+                 input_source=None, output=None, dissemination='star', fanout=4, relay_threshold=64,
+                 channel=None, host=None, history_size=1000, history_bytes=1 << 20, message_log=None,
+                 message_log_all=False, fsync='interval', outbox_size=1000, election='hirschberg-sinclair',
+                 successors=3):
+        # Every node has its own logger, so that the nodes
+        # running in one process can be told apart.
+        self.log = logging.getLogger(f'{__name__}.{port}' + (f'.{channel}' if channel is not None else ''))
+
+        # Channel (chatroom) of the node, None for the default one. Nodes of several channels
+        # can share one port of one ChannelHost, which hands them the connections of their channel.
+        self.channel = channel
+        self.host = host
+
+        # Events signalling changes of the ring state, set while
+        # the node has its next node, previous node and leader connection.
+        self.next_attached = asyncio.Event()
+        self.prev_attached = asyncio.Event()
+        self.leader_attached = asyncio.Event()
+
+        # Set once the server of the node accepts connections
+        self.listening = asyncio.Event()
+
+        # Failure detectors of the neighbors and the leader,
+        # created whenever the corresponding connection changes.
+        self.heartbeat_interval = heartbeat_interval
+        self.phi_threshold = phi_threshold
+        self.next_detector = None
+        self.prev_detector = None
+        self.leader_detector = None
+
         self.name = name
         self.address = address
         self.port = port
@@ -25,12 +125,122 @@ class CNode:
         self.next_node_writer = None
         self.prev_node_reader = None
         self.prev_node_writer = None
+        self.prev_node_address = None
+        self.prev_node_port = None
+        # Messages waiting for a previous node to connect (election messages)
+        # and for the ring to be renewed after the next node died (ring broadcast, election messages)
+        self.prev_backlog = []
+        self.next_backlog = []
         self.leader_reader = None
         self.leader_writer = None
+        self.leader_task = None
+        self.tasks = []
+        self.error = None
         self.exiting = False
-        self.connections = []
+        self.connections = ConnectionRegistry()
         self.voting = False
         self.initiate = False
+
+        # The ID of this node compared in the elections, the election algorithms
+        # this node takes part in and the one it starts (see election.py)
+        if election not in ELECTIONS:
+            raise ValueError(f'Unknown election algorithm: {election}')
+        self.id = self.node_id(address, port)
+        self.elections = {name: algorithm(self) for name, algorithm in ELECTIONS.items()}
+        self.election = self.elections[election]
+        self.election_handlers = {m_type: algorithm for algorithm in self.elections.values()
+                                  for m_type in algorithm.message_types}
+
+        # The next nodes along the ring as [address, port], at most successor_count of them,
+        # the first one is the next node. Every node tells its previous node its list, so a node
+        # whose next node dies connects straight to the first live successor instead of waiting
+        # for the prev inform message going around the ring. Used only with the peers announcing it.
+        self.successor_count = successors
+        self.successors = []
+        self.successor_peers = set()
+        self.codecs = list(codecs) if codecs else list(CODECS)
+        self.peer_codecs = {}
+        self.send_queue_size = send_queue_size
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+
+        # Leader broadcast batching, used only with the peers able to unpack batches.
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.batch_peers = set()
+
+        # Broadcast along the ring, used only if all the nodes are able to relay the messages.
+        # The leader stamps the broadcast messages with a sequence number,
+        # the nodes remember the last relayed one to drop the messages going around again.
+        if dissemination not in DISSEMINATION_MODES:
+            raise ValueError(f'Unknown dissemination mode: {dissemination}')
+        self.dissemination = dissemination
+        self.broadcast_seq = 0
+        self.ring_seq = 0
+
+        # Gossip: the partial view of the peers learned from the traffic
+        # and the IDs (sequence numbers) of the recently seen messages.
+        self.fanout = fanout
+        self.view = []
+        self.gossip_seen = set()
+        self.gossip_seen_order = deque()
+
+        # Star with relays: from relay_threshold connections on, the leader sends the broadcast
+        # to about sqrt(N) relays, each of them forwards it to its block of nodes.
+        # The assignment (relay connection -> block) is rebuilt when the connections change.
+        # A relay keeps the keys of the nodes in its block.
+        self.relay_threshold = relay_threshold
+        self.relays = None
+        self.relay_block = []
+
+        # Connections this node opened to other nodes than its neighbors
+        # and the leader (peers of the gossip view, nodes in the block of a relay)
+        self.peer_connections = ConnectionRegistry()
+        self.peer_opening = {}
+
+        # Recent user messages the leader replays to the nodes saying hello,
+        # and the last message this node saw as (time, address, port), sent in its hello.
+        self.history = MessageHistory(history_size, history_bytes)
+        self.last_seen = None
+
+        # The user messages of the node are numbered and kept until the leader acknowledges them,
+        # they are sent again to the new leader after a failover. The numbers start from the current
+        # time in microseconds, so that a restarted node does not reuse them. Every node remembers
+        # the highest number of every author it saw broadcast, so that as the leader it drops
+        # the retransmitted messages (they come from the author in order). The other nodes may get
+        # the messages out of order (gossip, relays), they remember the recent (author, number) pairs
+        # to drop the messages a new leader broadcasts again.
+        self.sender_seq = time_ns() // 1000
+        self.unacked = {}
+        self.delivered = {}
+        self.delivered_seen = set()
+        self.delivered_order = deque()
+
+        # The unacknowledged messages are the outbox of the node: while no leader is reachable
+        # the messages are only put there, up to outbox_size of them. A message is sent at once
+        # only if all the previous ones were sent to the current leader (outbox_sent is the number
+        # of the last one), otherwise the outbox_task sends them, so the leader gets them in order.
+        self.outbox_size = outbox_size
+        self.outbox_sent = self.sender_seq
+        self.outbox_task = None
+
+        # Persistent log of the user messages written by the leader (by every node with message_log_all),
+        # the history is loaded from it when the node starts. Every channel has its own directory.
+        self.message_log = None
+        if message_log is not None:
+            if channel is not None:
+                message_log = os.path.join(message_log, channel)
+            self.message_log = MessageLog(message_log, fsync=fsync)
+        self.message_log_all = message_log_all
+
+        # Metrics read by the '//stats' command and the stats server
+        self.metrics = MetricsRegistry()
+        self.stats_port = stats_port
+
+        # Where the user input comes from and where the chat goes to, the console by default.
+        if input_source is None:
+            input_source = PromptInput(lambda: prompt_text(name, address, port, self.pending()))
+        self.input_source = input_source
+        self.output = output if output is not None else ConsoleOutput()
         if is_leader:
             self.leader_address = self.address
             self.leader_port = self.port
@@ -38,6 +248,77 @@ class CNode:
             self.leader_address = None
             self.leader_port = None
 
+    @property
+    def next_node_reader(self):
+        """
+        Stream reader of the connection to the next node.
+        Setting it sets or clears the next_attached event.
+        """
+        return self._next_node_reader
+
+    @next_node_reader.setter
+    def next_node_reader(self, reader):
+        self._next_node_reader = reader
+        self.next_detector = self.create_detector(reader)
+        set_event(self.next_attached, reader is not None)
+
+    @property
+    def prev_node_writer(self):
+        """
+        Stream writer of the connection from the previous node.
+        Setting it sets or clears the prev_attached event.
+        """
+        return self._prev_node_writer
+
+    @prev_node_writer.setter
+    def prev_node_writer(self, writer):
+        self._prev_node_writer = writer
+        self.prev_detector = self.create_detector(writer)
+        set_event(self.prev_attached, writer is not None)
+
+    @property
+    def leader_writer(self):
+        """
+        Stream writer of the connection to the leader.
+        Setting it sets or clears the leader_attached event.
+        """
+        return self._leader_writer
+
+    @leader_writer.setter
+    def leader_writer(self, writer):
+        self._leader_writer = writer
+        self.leader_detector = self.create_detector(writer)
+        set_event(self.leader_attached, writer is not None)
+
+    def detector_of(self, reader, writer):
+        """
+        :param reader: Stream reader of the connection a message came through
+        :param writer: Stream writer of the same connection
+        :return: Failure detector of the connection, None if it has none
+        """
+        if reader is not None and reader is self.next_node_reader:
+            return self.next_detector
+        if writer is not None and writer is self.prev_node_writer:
+            return self.prev_detector
+        if writer is not None and writer is self.leader_writer:
+            return self.leader_detector
+        if self.is_leader:
+            conn = self.connections.find_by_reader(reader)
+            if conn is not None:
+                return conn.detector
+        return None
+
+    def create_detector(self, stream):
+        """
+        Create the failure detector of a newly attached connection.
+
+        :param stream: Stream of the connection, None if the connection was detached
+        :return: PhiAccrualDetector, None if there is no connection or the heartbeat is disabled
+        """
+        if stream is None or not self.heartbeat_interval:
+            return None
+        return PhiAccrualDetector(self.heartbeat_interval)
+
     async def handle_message(self, message, reader, writer):
         """
         Decide what to do with received message.
@@ -47,51 +328,178 @@ class CNode:
         :param writer: Reader/writer pair of the message sender
         :type message: CMessage
         """
-        m_type = MessageType(message.message_type)
+        start = perf_counter()
         sender = message.sender_address, message.sender_port
+        try:
+            m_type = MessageType(message.message_type)
+        except ValueError:
+            self.log.error(f'{self.logical_clock} Received unknown message type: {message.message_type}')
+            self.metrics.counter('received.unknown').inc()
+            return
+
+        self.metrics.counter(RECEIVED_COUNTERS[m_type]).inc()
+
+        if message.channel != self.channel:
+            self.log.error(f'{self.logical_clock}: Received message of channel {message.channel} from {sender}')
+            self.metrics.counter('received.wrong_channel').inc()
+            return
+
+        # Heartbeats feed the failure detector of the connection,
+        # they are not significant events for the logical clock.
+        if m_type == MessageType.heartbeat_message:
+            detector = self.detector_of(reader, writer)
+            if detector is not None:
+                detector.heartbeat()
+            return
 
         self.set_logical_clock(message.time)
 
         # New node wants to log in
         if m_type == MessageType.login_message:
 
-            logging.info(f'{self.logical_clock}: Received login message from {sender}')
+            self.log.info(f'{self.logical_clock}: Received login message from {sender}')
             await self.handle_login_message(message, writer)
 
         # New node informing about itself
         elif m_type == MessageType.i_am_prev_message:
 
-            logging.info(f'{self.logical_clock}: Received i am prev message from {sender}')
-            await self.handle_i_am_prev_message(reader, writer)
+            self.log.info(f'{self.logical_clock}: Received i am prev message from {sender}')
+            await self.handle_i_am_prev_message(message, reader, writer)
 
         # Prev node died, inform its prev where to connect
         elif m_type == MessageType.prev_inform_message:
 
-            logging.info(f'{self.logical_clock}: Received prev inform message from {sender}')
+            self.log.info(f'{self.logical_clock}: Received prev inform message from {sender}')
             await self.handle_prev_inform_message(message)
 
         # Another user writes a message
         elif m_type == MessageType.user_message:
 
-            await self.handle_user_message(message, reader)
+            await self.handle_user_message(message, reader, writer)
+
+        elif m_type == MessageType.ring_user_message:
+
+            await self.handle_ring_user_message(message)
+
+        elif m_type == MessageType.gossip_message:
+
+            await self.handle_gossip_message(message)
+
+        elif m_type == MessageType.membership_message:
+
+            for address, port in message.message_data['peers']:
+                self.add_to_view(address, port)
+
+        elif m_type == MessageType.relay_assign_message:
+
+            self.handle_relay_assign_message(message)
+
+        elif m_type == MessageType.relay_user_message:
+
+            await self.handle_relay_user_message(message)
+
+        elif m_type == MessageType.ack_message:
+
+            self.handle_ack_message(message)
 
         elif m_type == MessageType.hello_leader_message:
 
-            await self.handle_hello_leader_message(message, reader)
+            await self.handle_hello_leader_message(message, reader, writer)
+
+        elif m_type in self.election_handlers:
+
+            self.log.info(f'{self.logical_clock}: Received {m_type.name} from {sender}')
+            await self.election_handlers[m_type].handle_message(message)
 
-        elif m_type == MessageType.election_message:
+        elif m_type == MessageType.successors_message:
 
-            logging.info(f'{self.logical_clock}: Received election message from {sender}')
-            await self.handle_election_message(message)
+            await self.handle_successors_message(message)
 
         elif m_type == MessageType.elected_message:
 
-            logging.info(f'{self.logical_clock}: Received elected message from {sender}')
+            self.log.info(f'{self.logical_clock}: Received elected message from {sender}')
             await self.handle_elected_message(message)
 
+        elif m_type == MessageType.capabilities_message:
+
+            await self.handle_capabilities_message(message, writer)
+
         else:
 
-            logging.error(f'{self.logical_clock} Received unknown message type: {m_type}')
+            self.log.error(f'{self.logical_clock} Received unknown message type: {m_type}')
+
+        self.metrics.histogram(HANDLE_HISTOGRAMS[m_type]).observe(perf_counter() - start)
+
+    async def handle_capabilities_message(self, message, writer):
+        """
+        A peer opened a connection and announced the codecs it can decode,
+        or answered this node's announcement. Remember the best common codec
+        for the messages sent to the peer and answer the announcement.
+
+        :param message: CMessage with the list of the peer's codecs
+        :param writer: Stream writer of the connection the message came from
+        """
+        codec = choose_codec(self.codecs, message.message_data['codecs'])
+        key = peer_key(message.sender_address, message.sender_port)
+        self.peer_codecs[key] = codec
+        for feature, peers in (('batch', self.batch_peers), ('successors', self.successor_peers)):
+            if message.message_data.get(feature):
+                peers.add(key)
+            else:
+                peers.discard(key)
+        for feature in ('ring', 'gossip', 'relay'):
+            self.connections.set_feature(key, feature, bool(message.message_data.get(feature)))
+        self.log.info(f'{self.logical_clock}: Using codec {codec.name} for '
+                     f'{message.sender_address}:{message.sender_port}')
+
+        if message.message_data.get('answer'):
+            return
+
+        m = self.craft_message(MessageType.capabilities_message, dict(self.capabilities(), answer=True))
+        try:
+            writer.write(m.convert_to_frame())
+            await writer.drain()
+        except ConnectionError:
+            self.log.error(f'{self.logical_clock}: Cannot answer the capabilities message')
+
+    def codec_for(self, address, port):
+        """
+        Codec used for messages sent to the given peer.
+        Peers that did not announce their capabilities get JSON.
+
+        :param address: IP address of the peer
+        :param port: Port of the peer
+        :return: Codec instance
+        """
+        return self.peer_codecs.get(peer_key(address, port), JSON_CODEC)
+
+    async def open_connection(self, address, port):
+        """
+        Open a connection to another node and announce its capabilities as the first message.
+
+        :param address: IP address of the node
+        :param port: Port of the node
+        :return: Stream reader and writer of the connection
+        """
+        start = perf_counter()
+        try:
+            reader, writer = await asyncio.open_connection(address, port)
+        except OSError:
+            self.metrics.counter('connect.failures').inc()
+            raise
+        self.metrics.histogram('connect').observe(perf_counter() - start)
+        m = self.craft_message(MessageType.capabilities_message, self.capabilities())
+        writer.write(m.convert_to_frame())
+        return reader, writer
+
+    def capabilities(self):
+        """
+        :return: Data of the capabilities message: the codecs this node decodes,
+                 it unpacks batches, relays the ring broadcast, gossips, can be a relay
+                 and keeps a successor list
+        """
+        return {'codecs': self.codecs, 'batch': True, 'ring': True, 'gossip': True, 'relay': True,
+                'successors': bool(self.successor_count)}
 
     async def handle_elected_message(self, message):
         """
@@ -104,14 +512,17 @@ class CNode:
         self.leader_address = message.message_data['addr']
         self.leader_port = message.message_data['port']
         self.voting = False
+        for election in self.elections.values():
+            election.finish()
+        self.prev_backlog.clear()
+        self.ring_seq = 0
+        self.gossip_seen.clear()
+        self.gossip_seen_order.clear()
 
-        logging.info(f'{self.logical_clock}: New leader is {self.leader_address}:{self.leader_port}')
-
-        sender_id = str(message.message_data['addr'] + str(message.message_data['port']))
-        self_id = str(self.address) + str(self.port)
+        self.log.info(f'{self.logical_clock}: New leader is {self.leader_address}:{self.leader_port}')
 
-        if sender_id != self_id:
-            logging.info(f'{self.logical_clock}: Passing elected message on...')
+        if self.node_id(message.message_data['addr'], message.message_data['port']) != self.id:
+            self.log.info(f'{self.logical_clock}: Passing elected message on...')
             await self.send_message_to_ring(message)
 
         self.set_logical_clock(self.logical_clock)
@@ -119,57 +530,80 @@ class CNode:
         if not self.is_leader:
             await self.connect_to_leader()
 
-    async def handle_election_message(self, message):
+    def node_id(self, address, port):
         """
-        Election messages are the cli_main communication during the
-        Chang-Roberts algorithm. The node with the biggest ID
-        (concatenated string "IP+port") will become the next leader.
-        This coroutine is the cli_main body of the Chang-Roberts algorithm.
+        ID of the node compared in the elections: the integer of the packed IP address followed by the port.
+        In other channels than the default one, the ID is hashed together with the name
+        of the channel, so that the channels sharing the nodes elect different leaders.
 
-        :param message: Election CMessage from the previous node
+        :param address: IP address of the node
+        :param port: Port of the node
+        :return: ID integer
         """
-        sender_id = str(message.message_data['addr']) + str(message.message_data['port'])
-        self_id = str(self.address) + str(self.port)
-
-        if sender_id > self_id:
-
-            # If the sender of the message as bigger ID, he's the candidate.
-            logging.info(f'{self.logical_clock}: Passing election message on. '
-                         f'Candidate: {message.message_data["addr"]}:{message.message_data["port"]}')
-            await self.send_message_to_ring(message)
-            self.voting = True
-
-        elif sender_id < self_id and not self.voting:
-
-            # If this node has bigger ID, he's the candidate.
-            logging.info(f'{self.logical_clock}: I am the new leader candidate')
-            m = self.craft_message(MessageType.election_message, {'addr': self.address, 'port': self.port})
-            await self.send_message_to_ring(m)
-            self.voting = True
-
-        elif sender_id == self_id:
-
-            # If the message arrived with this node's ID, he won the election.
-            logging.info(f'{self.logical_clock}: Received election message with my number -- NEW LEADER')
-            m = self.craft_message(MessageType.elected_message, {'addr': self.address, 'port': self.port})
-            self.is_leader = True
-            await self.send_message_to_ring(m)
+        try:
+            packed = int(ipaddress.ip_address(address))
+        except ValueError:
+            # Host name instead of an address
+            packed = int.from_bytes(str(address).encode(), 'big')
+        node_id = packed << 16 | int(port)
+        if self.channel is not None:
+            node_id = int(hashlib.sha1(f'{self.channel}:{node_id}'.encode()).hexdigest(), 16)
+        return node_id
+
+    async def announce_leader(self):
+        """
+        This node won the election. It becomes the leader and sends
+        the elected message around the ring.
+        """
+        m = self.craft_message(MessageType.elected_message, {'addr': self.address, 'port': self.port})
+        self.is_leader = True
+        await self.send_message_to_ring(m)
+        await self.broadcast_unacked()
 
-    async def handle_hello_leader_message(self, message, reader):
+    async def handle_hello_leader_message(self, message, reader, writer):
         """
         New node registers to the message broadcast.
+        The broadcast is sent through the connection the node opened.
 
-        :param message:
-        :param reader:
+        :param message: Hello message of the new node
+        :param reader: Stream reader of the connection from the node
+        :param writer: Stream writer of the connection from the node
         """
         if self.find_in_connections(reader):
             # Connection already exists
-            logging.error(f'{self.logical_clock}: Hello leader received from known node!')
+            self.log.error(f'{self.logical_clock}: Hello leader received from known node!')
             return
-        await self.add_connection_record(message, reader)
-        logging.info(f'{self.logical_clock}: Number of connections: {len(self.connections)}')
+        self.add_connection_record(message, reader, writer)
+        self.log.info(f'{self.logical_clock}: Number of connections: {len(self.connections)}')
+        if 'last_seen' in message.message_data:
+            await self.replay_history(message)
+        if self.dissemination == 'gossip':
+            await self.share_membership(message.sender_address, message.sender_port)
         await self.send_hello_from_leader(message)
 
+    async def replay_history(self, message):
+        """
+        Send the new node the messages of the history it did not see yet.
+        Its own messages are left out, the leader never sends a node what it wrote.
+        Nodes that do not send their last seen message in the hello get no history.
+
+        :param message: Hello message of the node, its data contain the last seen message
+        """
+        last_seen = message.message_data['last_seen']
+        conn = self.connections.find_by_peer(message.sender_address, message.sender_port)
+        author = peer_key(message.sender_address, message.sender_port)
+        codec = self.codec_for(conn.addr, conn.port)
+        replayed = 0
+        for m in self.history.since(tuple(last_seen) if last_seen is not None else None):
+            if peer_key(m.sender_address, m.sender_port) == author:
+                continue
+            if not await conn.send(m.convert_to_frame(codec)):
+                self.close_connection(conn)
+                return
+            replayed += 1
+        self.metrics.counter('history.replayed').inc(replayed)
+        self.log.info(f'{self.logical_clock}: Replayed {replayed} messages to {author[0]}:{author[1]}')
+
     async def send_hello_from_leader(self, message):
         """
         The leader node distributes a message telling everyone in
@@ -182,99 +616,540 @@ class CNode:
         # The leader user needs to be told about the new node too...
         self.print_user_message(m)
 
-        await self.distribute_message(m)
+        await self.broadcast(m)
 
-    async def handle_user_message(self, message, reader):
+    async def handle_user_message(self, message, reader, writer):
         """
         The node received the user message.
         If it it not a leader node, it just displays the message
         to the console.
-        If it is a leader, it must distribute the message to all the
+        If it is a leader, it must broadcast the message to all the
         nodes in the ring.
 
+        The leader acknowledges the numbered messages and drops the ones sent again.
+
         :param message: User message to handle
         :param reader: Stream reader
+        :param writer: Stream writer of the same connection
         """
+        if self.is_leader and self.already_delivered(message):
+            self.log.debug('%s: Dropping message %s sent again', self.logical_clock, message.sender_seq)
+            self.metrics.counter('received.duplicates').inc()
+            await self.send_ack(message, self.connections.find_by_reader(reader))
+            return
+
         self.print_user_message(message)
         if self.is_leader:
-            if not self.find_in_connections(reader):
-                logging.error(f'{self.logical_clock}: Received user message from unknown node')
-                await self.add_connection_record(message, reader)
+            conn = self.connections.find_by_reader(reader)
+            if conn is None:
+                self.log.error(f'{self.logical_clock}: Received user message from unknown node')
+                self.add_connection_record(message, reader, writer)
+                conn = self.connections.find_by_reader(reader)
+            else:
+                conn.touch()
+            await self.broadcast(message)
+            await self.send_ack(message, conn)
+
+    async def send_ack(self, message, conn):
+        """
+        Acknowledge the numbered messages of the author up to the given one.
+        The ack is queued after the broadcast of the message, so the author
+        gets it exactly where it would get its own message.
+
+        :param message: Numbered user message
+        :param conn: Connection of the author
+        """
+        if message.sender_seq is None or conn is None:
+            return
+        m = self.craft_message(MessageType.ack_message, {'seq': message.sender_seq})
+        if not await conn.send(m.convert_to_frame(self.codec_for(conn.addr, conn.port))):
+            self.close_connection(conn)
+
+    def handle_ack_message(self, message):
+        """
+        The leader received the messages of this node up to the acknowledged one.
+        They stop being kept for the retransmission and get into the history.
+
+        :param message: Ack message from the leader
+        """
+        acked = message.message_data['seq']
+        for sender_seq in list(self.unacked):
+            if sender_seq > acked:
+                break
+            self.keep_message(self.unacked.pop(sender_seq))
+
+    def pending(self):
+        """
+        :return: Number of the messages in the outbox not sent to the current leader yet
+        """
+        return sum(1 for sender_seq in self.unacked if sender_seq > self.outbox_sent)
+
+    async def flush_outbox(self):
+        """
+        Send the leader the messages it did not acknowledge, in their order,
+        including the ones written meanwhile. The node waits a random while first,
+        so that a new leader does not get the outboxes of all the nodes at once.
+        """
+        if self.unacked:
+            await asyncio.sleep(random.uniform(0, OUTBOX_FLUSH_JITTER))
+        sent = 0
+        while self.leader_writer is not None and not self.is_leader:
+            pending = [message for sender_seq, message in self.unacked.items() if sender_seq > self.outbox_sent]
+            if not pending:
+                break
+            for message in pending:
+                if self.leader_writer is None or self.is_leader:
+                    break
+                await self.send_message_to_leader(message)
+                self.outbox_sent = message.sender_seq
+                sent += 1
+        self.metrics.counter('sent.retransmitted').inc(sent)
+
+    async def broadcast_unacked(self):
+        """
+        The node became the leader, it broadcasts its unacknowledged messages itself.
+        """
+        unacked, self.unacked = self.unacked, {}
+        for message in unacked.values():
+            await self.broadcast(message)
+
+    async def handle_ring_user_message(self, message):
+        """
+        The node received the user message broadcast along the ring.
+        Relay it to the next node and display it, unless this node wrote it.
+        The leader stamped the message, so the message went around the whole ring
+        when it comes to the leader. Messages going around again
+        (e.g. while the ring is renewed) are dropped.
+
+        :param message: User message stamped by the leader
+        """
+        if self.is_leader:
+            self.metrics.counter('ring.returned').inc()
+            return
+        if message.seq <= self.ring_seq:
+            self.log.debug('%s: Dropping ring message %s, already relayed', self.logical_clock, message.seq)
+            return
+        self.ring_seq = message.seq
+
+        await self.send_message_to_ring(message, keep=True)
+        self.metrics.counter('ring.relayed').inc()
+        if peer_key(message.sender_address, message.sender_port) != peer_key(self.address, self.port):
+            self.print_user_message(message)
+
+    async def broadcast(self, message):
+        """
+        The leader broadcasts the message to all the nodes.
+        The message is stamped with the next sequence number.
+        In the ring mode the message is sent only to the next node and the nodes relay it,
+        so the leader sends one copy instead of one per node. The leader falls back
+        to the star while the ring is broken or some node cannot relay the messages.
+
+        :param message: User message
+        """
+        self.broadcast_seq += 1
+        message.seq = self.broadcast_seq
+        self.keep_message(message)
+        if self.dissemination == 'ring' and self.ring_usable():
+            message.message_type = MessageType.ring_user_message.value
+            self.metrics.counter('ring.sent').inc()
+            await self.send_message_to_ring(message)
+        elif self.dissemination == 'gossip' and self.connections.supported_by_all('gossip'):
+            message.message_type = MessageType.gossip_message.value
+            await self.gossip_from_leader(message)
+        elif self.relay_threshold and len(self.connections) >= self.relay_threshold \
+                and self.connections.supported_by_all('relay'):
+            await self.distribute_through_relays(message)
+        else:
             await self.distribute_message(message)
 
+    def ring_usable(self):
+        """
+        :return: True if the ring is closed and all the nodes relay the ring broadcast
+        """
+        if self.next_node_writer is None:
+            return False
+        return self.connections.supported_by_all('ring')
+
+    async def gossip_from_leader(self, message):
+        """
+        The leader starts the gossip: the message is sent to the next node
+        and to random nodes, fanout nodes in total.
+
+        :param message: Gossip message stamped by the leader
+        """
+        targets = self.connections.sample(min(self.fanout, len(self.connections)))
+        next_conn = self.connections.find_by_peer(self.next_node_address, self.next_node_port)
+        if next_conn is not None and next_conn not in targets:
+            targets[-1] = next_conn
+
+        for conn in targets:
+            if not await conn.send(message.convert_to_frame(self.codec_for(conn.addr, conn.port))):
+                self.close_connection(conn)
+        self.metrics.counter('gossip.sent').inc(len(targets))
+
+    async def handle_gossip_message(self, message):
+        """
+        The node received the gossip message. If it sees the message for the first time,
+        it pushes the message to its next node and to random peers of its partial view,
+        fanout peers in total, and displays it, unless this node wrote it.
+        The next node is always among the peers, so the message reaches every node
+        even if the random choice misses some. The sender of the message is a member
+        of the chatroom, so it is added to the view.
+
+        :param message: Gossip message stamped by the leader
+        """
+        if self.is_leader:
+            return
+        if message.seq in self.gossip_seen:
+            self.metrics.counter('gossip.duplicates').inc()
+            return
+        self.gossip_seen.add(message.seq)
+        self.gossip_seen_order.append(message.seq)
+        if len(self.gossip_seen_order) > GOSSIP_SEEN_SIZE:
+            self.gossip_seen.discard(self.gossip_seen_order.popleft())
+
+        own = peer_key(message.sender_address, message.sender_port) == peer_key(self.address, self.port)
+        if not own:
+            self.add_to_view(message.sender_address, message.sender_port)
+
+        await self.push_gossip(message)
+        if not own:
+            self.print_user_message(message)
+
+    async def push_gossip(self, message):
+        """
+        Push the gossip message to the next node and to random peers of the view.
+
+        :param message: Gossip message
+        """
+        excluded = {peer_key(self.address, self.port), peer_key(self.leader_address, self.leader_port),
+                    peer_key(message.sender_address, message.sender_port)}
+        sent = 0
+        if self.next_node_writer is not None:
+            await self.send_message_to_ring(message)
+            excluded.add(peer_key(self.next_node_address, self.next_node_port))
+            sent += 1
+
+        candidates = [peer for peer in self.view if peer not in excluded]
+        for address, port in random.sample(candidates, max(0, min(self.fanout - sent, len(candidates)))):
+            conn = await self.peer_connection(address, port)
+            if conn is None:
+                continue
+            if await conn.send(message.convert_to_frame(self.codec_for(address, port))):
+                sent += 1
+            else:
+                self.close_peer_connection(conn)
+        self.metrics.counter('gossip.sent').inc(sent)
+
+    def add_to_view(self, address, port):
+        """
+        Add the peer to the partial view. When the view is full,
+        the peer replaces a random one, so the view stays a random sample
+        of the chatroom that follows its changes.
+
+        :param address: IP address of the peer
+        :param port: Port of the peer
+        """
+        if address is None or port is None:
+            return
+        key = peer_key(address, port)
+        if key == peer_key(self.address, self.port) or key in self.view:
+            return
+        if len(self.view) < GOSSIP_VIEW_SIZE:
+            self.view.append(key)
+        else:
+            self.view[random.randrange(GOSSIP_VIEW_SIZE)] = key
+
+    async def share_membership(self, address, port):
+        """
+        The leader fills the partial view of the new node with random nodes
+        and adds the new node to the views of fanout random nodes.
+
+        :param address: IP address of the new node
+        :param port: Port of the new node
+        """
+        new = self.connections.find_by_peer(address, port)
+
+        sample = self.sample_others(GOSSIP_VIEW_SIZE, new)
+        peers = [[conn.addr, conn.port] for conn in sample]
+        if new is not None:
+            await new.send(self.craft_message(MessageType.membership_message, {'peers': peers}).convert_to_frame())
+
+        m = self.craft_message(MessageType.membership_message, {'peers': [[address, port]]})
+        for conn in self.sample_others(self.fanout, new):
+            await conn.send(m.convert_to_frame(self.codec_for(conn.addr, conn.port)))
+
+    def sample_others(self, k, excluded):
+        """
+        :param k: Number of the connections
+        :param excluded: Registered CConnection not to be sampled or None
+        :return: Up to k random connections of the leader other than the excluded one
+        """
+        extra = 0 if excluded is None else 1
+        sample = self.connections.sample(min(k + extra, len(self.connections)))
+        return [conn for conn in sample if conn is not excluded][:k]
+
+    async def distribute_through_relays(self, message):
+        """
+        The leader sends the message to the relays only, each relay forwards it to its block.
+        The relays are assigned first if the connections changed since the last assignment.
+        Every node gets the messages through one path, so it gets them in the order of the leader.
+
+        :param message: User message stamped by the leader
+        """
+        start = perf_counter()
+        if self.relays is None:
+            await self.assign_relays()
+
+        message.message_type = MessageType.relay_user_message.value
+        relays = list(self.relays)
+        for conn in relays:
+            if not await conn.send(message.convert_to_frame(self.codec_for(conn.addr, conn.port))):
+                self.log.error(f'{self.logical_clock}: Relay {conn.addr}:{conn.port} is too slow, disconnecting')
+                self.close_connection(conn)
+
+        self.metrics.counter('relayed').inc(len(relays))
+        self.metrics.histogram('distribute').observe(perf_counter() - start)
+
+    async def assign_relays(self):
+        """
+        Promote the sqrt(N) longest connected nodes to relays and split
+        the other nodes among them. Each relay is told its block.
+        """
+        conns = list(self.connections)
+        count = max(1, int(math.sqrt(len(conns))))
+        relays, others = conns[:count], conns[count:]
+        self.relays = {relay: others[i::count] for i, relay in enumerate(relays)}
+        self.log.info(f'{self.logical_clock}: Assigning {count} relays to {len(others)} nodes')
+
+        for relay, block in self.relays.items():
+            m = self.craft_message(MessageType.relay_assign_message,
+                                   {'block': [[conn.addr, conn.port] for conn in block]})
+            await relay.send(m.convert_to_frame(self.codec_for(relay.addr, relay.port)))
+
+    def handle_relay_assign_message(self, message):
+        """
+        The leader made this node a relay of a block of nodes, or changed the block.
+        Connections to the nodes that left the block are closed.
+
+        :param message: Relay assign message with the block
+        """
+        self.relay_block = [peer_key(address, port) for address, port in message.message_data['block']]
+        self.log.info(f'{self.logical_clock}: Relaying the broadcast to {len(self.relay_block)} nodes')
+        for conn in list(self.peer_connections):
+            if conn.key() not in self.relay_block and conn.key() not in self.view:
+                self.close_peer_connection(conn)
+
+    async def handle_relay_user_message(self, message):
+        """
+        The relay received the user message from the leader.
+        Forward it to the block (except its author) and display it, unless this node wrote it.
+
+        :param message: User message stamped by the leader
+        """
+        message.message_type = MessageType.user_message.value
+        author = peer_key(message.sender_address, message.sender_port)
+        for address, port in self.relay_block:
+            if (address, port) == author:
+                continue
+            conn = await self.peer_connection(address, port)
+            if conn is not None and not await conn.send(message.convert_to_frame(self.codec_for(address, port))):
+                self.close_peer_connection(conn)
+
+        if author != peer_key(self.address, self.port):
+            self.print_user_message(message)
+
+    async def peer_connection(self, address, port):
+        """
+        Connection to another node, opened on the first use.
+        A node that cannot be reached is removed from the gossip view.
+
+        :param address: IP address of the peer
+        :param port: Port of the peer
+        :return: CConnection or None
+        """
+        conn = self.peer_connections.find_by_peer(address, port)
+        if conn is not None:
+            return conn
+
+        key = peer_key(address, port)
+        opening = self.peer_opening.get(key)
+        if opening is None:
+            opening = self.peer_opening[key] = asyncio.ensure_future(self.open_connection(address, port))
+        try:
+            reader, writer = await asyncio.shield(opening)
+        except OSError:
+            self.log.warning(f'{self.logical_clock}: {address}:{port} not reachable')
+            if key in self.view:
+                self.view.remove(key)
+            return None
+        finally:
+            self.peer_opening.pop(key, None)
+
+        conn = self.peer_connections.find_by_peer(address, port)
+        if conn is None:
+            conn = CConnection(address, port, reader, writer, self.send_queue_size, self.overflow_policy,
+                               self.close_peer_connection, log=self.log)
+            conn.start()
+            self.peer_connections.add(conn)
+            self.tasks.append(asyncio.create_task(self.read_peer(conn)))
+        return conn
+
+    async def read_peer(self, conn):
+        """
+        Coroutine reading the answers (e.g. capabilities) of a node this node connected to.
+        The connection is closed when the node closes it.
+
+        :param conn: CConnection to the node
+        """
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = await conn.reader.read(READ_SIZE)
+                payloads = decoder.feed(data)
+            except (ConnectionError, FrameError):
+                data = b''
+            if data == b'':
+                self.close_peer_connection(conn)
+                return
+            for payload in payloads:
+                await self.handle_message(decode_payload(payload), conn.reader, conn.writer)
+
+    def close_peer_connection(self, conn):
+        """
+        Close the connection to the node and remove the node from the gossip view.
+
+        :param conn: CConnection to be closed
+        """
+        self.peer_connections.remove(conn)
+        if conn.key() in self.view:
+            self.view.remove(conn.key())
+        conn.close()
+
+    def already_delivered(self, message):
+        """
+        :param message: User message sent by its author to the leader
+        :return: True if the message of the author with the same or a later number was seen
+        """
+        return message.sender_seq is not None and \
+            message.sender_seq <= self.delivered.get(peer_key(message.sender_address, message.sender_port), -1)
+
     def print_user_message(self, message):
         """
-        Print received user message.
+        Print received user message and remember it as the last seen one.
+        The leader keeps the messages when it broadcasts them.
+        A message already delivered (broadcast again by a new leader) is dropped.
 
         :param message: CMessage to be printed.
         """
-        print(Colors.BOLD + Colors.CYAN + f'> {message.sender_name}' + Colors.RESET +
-              f'({message.sender_address}:{message.sender_port})' + Colors.GREEN + f'[{message.time}]: '
-              + Colors.RESET + f'{message.message_data}')
+        if message.sender_seq is not None and \
+                (peer_key(message.sender_address, message.sender_port), message.sender_seq) in self.delivered_seen:
+            self.log.debug('%s: Dropping message %s delivered before', self.logical_clock, message.sender_seq)
+            self.metrics.counter('received.duplicates').inc()
+            return
+        self.output.message(message)
+        self.last_seen = message.time, message.sender_address, message.sender_port
+        if not self.is_leader:
+            self.keep_message(message)
+
+    def keep_message(self, message):
+        """
+        Keep the user message in the history and in the message log.
+        The leader logs every message it broadcasts, the other nodes only with message_log_all.
 
-    async def add_connection_record(self, message, reader):
+        :param message: User message of any broadcast type
+        """
+        if message.sender_seq is not None:
+            author = peer_key(message.sender_address, message.sender_port)
+            self.delivered[author] = max(message.sender_seq, self.delivered.get(author, -1))
+            self.delivered_seen.add((author, message.sender_seq))
+            self.delivered_order.append((author, message.sender_seq))
+            if len(self.delivered_order) > DELIVERED_SEEN_SIZE:
+                self.delivered_seen.discard(self.delivered_order.popleft())
+        copy = plain_copy(message)
+        self.history.add(copy)
+        if self.message_log is not None and (self.is_leader or self.message_log_all):
+            self.message_log.append(copy)
+
+    def load_history(self):
+        """
+        Fill the history with the last messages of the message log,
+        the last of them is the last message this node saw.
+        The logical clock continues from the latest logged time.
+        """
+        self.set_logical_clock(self.message_log.max_time)
+        for _, frame in self.message_log.tail(self.history.max_messages):
+            message = decode_payload(frame[HEADER.size:])
+            self.history.add(message)
+            self.last_seen = message.time, message.sender_address, message.sender_port
+        self.log.info(f'{self.logical_clock}: Loaded {len(self.history)} messages from the message log')
+
+    def add_connection_record(self, message, reader, writer):
         """
         Add new connection to the broadcasting list.
+        The connection opened by the node is used in both directions,
+        the node reads the broadcast from its leader_reader.
 
         :param message: Received user message
-        :param reader: Stream reader
+        :param reader: Stream reader of the connection from the node
+        :param writer: Stream writer of the connection from the node
         """
-        conn = {
-            'addr': message.sender_address,
-            'port': message.sender_port,
-            'reader': reader,
-        }
-        try:
-            _, conn['writer'] = await asyncio.open_connection(message.sender_address, message.sender_port)
-        except ConnectionError:
-            logging.error(f'{self.logical_clock}: Cannot open backwards connection to client')
-            return
-        self.connections.append(conn)
-        logging.info(f'{self.logical_clock}: Adding {message.sender_address}:{message.sender_port} to the list')
+        batch_window = 0.0
+        if peer_key(message.sender_address, message.sender_port) in self.batch_peers:
+            batch_window = self.batch_window
+        conn = CConnection(message.sender_address, message.sender_port, reader, writer,
+                           self.send_queue_size, self.overflow_policy, self.close_connection,
+                           self.create_detector(writer), batch_window, self.batch_size, self.log)
+        conn.start()
+        replaced = self.connections.add(conn)
+        if replaced is not None:
+            replaced.close()
+        self.relays = None
+        self.log.info(f'{self.logical_clock}: Adding {message.sender_address}:{message.sender_port} to the list')
         self.set_logical_clock(self.logical_clock)
 
     def find_in_connections(self, reader):
         """
         Find if there is a record of the connection
-        represented by the given stream writer.
+        represented by the given stream reader.
 
-        :param reader: Stream writer
-        :return: True if writer is in connections, False otherwise.
+        :param reader: Stream reader
+        :return: True if reader is in connections, False otherwise.
         """
-        for c in self.connections:
-            if c['reader'] == reader:
-                return True
-        return False
+        return self.connections.find_by_reader(reader) is not None
 
     async def distribute_message(self, message, exc=None):
         """
         Distribute message to all known nodes.
+        The message is only queued for each connection, the connections
+        write it on their own, so a slow node does not delay the others.
 
         :param message: User message
         :param exc: Exception in distribution: IP and port of a node that will not receive the message
         """
-        for conn in self.connections:
+        start = perf_counter()
+        sender = self.connections.find_by_peer(message.sender_address, message.sender_port)
+        excluded = self.connections.find_by_peer(exc[0], exc[1]) if exc else None
+        fanout = 0
 
-            # Do not send the message back to the sender
-            if conn['addr'] == message.sender_address and conn['port'] == message.sender_port:
-                continue
+        for conn in list(self.connections):
 
-            if exc and conn['addr'] == exc[0] and conn['port'] == exc[1]:
+            # Do not send the message back to the sender
+            if conn is sender or conn is excluded:
                 continue
+            fanout += 1
 
-            try:
-
-                logging.info(f'{self.logical_clock}: Distribution to: {conn["addr"]}:{conn["port"]}')
-                conn['writer'].write(message.convert_to_string().encode())
-                await conn['writer'].drain()
-
-            except ConnectionError:
-
-                logging.error(f'{self.logical_clock}: {conn["addr"]}:{conn["port"]} not reachable to broadcast')
-                self.remove_from_connections(conn['reader'], conn['writer'])
+            # Hot path: the line is only formatted when debug logging is enabled.
+            self.log.debug('%s: Distribution to: %s:%s', self.logical_clock, conn.addr, conn.port)
+            if not await conn.send(message.convert_to_frame(self.codec_for(conn.addr, conn.port))):
+                self.log.error(f'{self.logical_clock}: {conn.addr}:{conn.port} is too slow, disconnecting')
+                self.close_connection(conn)
 
             self.set_logical_clock(self.logical_clock)
 
+        self.metrics.counter('distributed').inc(fanout)
+        self.metrics.histogram('distribute').observe(perf_counter() - start)
+
     async def handle_prev_inform_message(self, message):
         """
         A node died. Its next node detects it and sends
@@ -283,47 +1158,171 @@ class CNode:
 
         :param message: Message to handle
         """
+        # The message went around the whole ring, nobody needed it.
+        if peer_key(message.sender_address, message.sender_port) == peer_key(self.address, self.port):
+            self.log.info(f'{self.logical_clock}: Prev inform message returned, dropping it')
+            return
+
+        # The next node might have died without this node noticing it yet.
+        dead = message.message_data.get('dead_IP'), message.message_data.get('dead_port')
+        next_is_dead = dead[0] is not None and peer_key(*dead) == peer_key(self.next_node_address,
+                                                                             self.next_node_port)
+
         # Pass the message on if this node's next is alive.
-        if self.next_node_writer is not None:
-            logging.info(f'{self.logical_clock}: Passed prev inform message on...')
+        if self.next_node_writer is not None and not next_is_dead:
+            self.log.info(f'{self.logical_clock}: Passed prev inform message on...')
             await self.send_message_to_ring(message)
             return
 
+        if self.next_node_writer is not None:
+            await self.handle_next_lost()
+
         # Update new next node and address.
-        self.next_node_reader, self.next_node_writer = await asyncio.open_connection(message.sender_address,
-                                                                                     message.sender_port)
-        self.next_node_address = message.sender_address
-        self.next_node_port = message.sender_port
+        reader, writer = await self.open_connection(message.sender_address, message.sender_port)
+        self.log.info(f'{self.logical_clock}: Opened new connection to {message.sender_address}:{message.sender_port}')
+        await self.attach_next(message.sender_address, message.sender_port, reader, writer)
 
-        logging.info(f'{self.logical_clock}: Opened new connection to {message.sender_address}:{message.sender_port}')
+    async def attach_next(self, address, port, reader, writer, dead=None):
+        """
+        Make the node at the other end of a newly opened connection the next node
+        of this node after the old one died. If the old next node was the leader,
+        the election starts, the ring is complete again.
+
+        :param address: IP address of the new next node
+        :param port: Port of the new next node
+        :param reader: Stream reader of the connection
+        :param writer: Stream writer of the connection
+        :param dead: Address and port of the dead next node if the new one is its successor
+        """
+        self.next_node_reader, self.next_node_writer = reader, writer
+        self.next_node_address = address
+        self.next_node_port = port
+
+        # The successors after the new next node stay, until it sends its own list
+        keys = [peer_key(*successor) for successor in self.successors]
+        if peer_key(address, port) in keys:
+            self.successors = self.successors[keys.index(peer_key(address, port)):]
+        else:
+            self.successors = [[address, port]]
 
         # Inform the new next about the connection,
         # so that it can update the prev streams.
-        m = self.craft_message(MessageType.i_am_prev_message, {})
+        m = self.craft_message(MessageType.i_am_prev_message, {} if dead is None else {'dead': list(dead)})
         await self.send_message_to_ring(m)
-        logging.info(f'{self.logical_clock}: Ring renewed')
+        self.log.info(f'{self.logical_clock}: Ring renewed')
+
+        # The messages that waited for the ring to be renewed
+        backlog, self.next_backlog = self.next_backlog, []
+        for m in backlog:
+            await self.send_message_to_ring(m, keep=True)
         self.set_logical_clock(self.logical_clock)
         if self.initiate:
+            self.initiate = False
             await self.initiate_election()
 
-    async def handle_i_am_prev_message(self, reader, writer):
+    async def connect_to_successor(self, dead):
+        """
+        The next node died. Connect straight to the first reachable node after it
+        in the successor list. If there is none, the node waits for the prev inform message.
+
+        :param dead: Address and port of the dead next node
+        """
+        keys = [peer_key(*successor) for successor in self.successors]
+        first = keys.index(peer_key(*dead)) + 1 if peer_key(*dead) in keys else 0
+        for address, port in self.successors[first:]:
+            if self.next_node_writer is not None:
+                return
+            try:
+                reader, writer = await asyncio.wait_for(self.open_connection(address, port),
+                                                        SUCCESSOR_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                self.log.info(f'{self.logical_clock}: Successor {address}:{port} unreachable')
+                continue
+
+            # The prev inform message came meanwhile
+            if self.next_node_writer is not None:
+                writer.close()
+                return
+            self.log.info(f'{self.logical_clock}: Connected to successor {address}:{port}')
+            self.metrics.counter('ring.successor_repairs').inc()
+            await self.attach_next(address, port, reader, writer, dead)
+            return
+        self.log.info(f'{self.logical_clock}: No successor reachable, waiting for prev inform message')
+
+    async def send_successors(self):
+        """
+        Tell the previous node the successors it should keep: this node followed by its own successors.
+        """
+        if not self.successor_count or self.prev_node_writer is None or \
+                peer_key(self.prev_node_address, self.prev_node_port) not in self.successor_peers:
+            return
+        successors = [[self.address, self.port]] + self.successors[:self.successor_count - 1]
+        await self.send_message_to_prev(self.craft_message(MessageType.successors_message,
+                                                           {'successors': successors}))
+
+    async def handle_successors_message(self, message):
+        """
+        The next node sent its successors. The list ends before this node (in a small ring).
+        If the list of this node changed, its previous node is told as well,
+        so a change spreads at most successor_count nodes back.
+
+        :param message: Successors message from the next node
+        """
+        if peer_key(message.sender_address, message.sender_port) != peer_key(self.next_node_address,
+                                                                            self.next_node_port):
+            return
+        successors = []
+        for address, port in message.message_data['successors'][:self.successor_count]:
+            if peer_key(address, port) == peer_key(self.address, self.port):
+                break
+            successors.append([address, port])
+        if successors != self.successors:
+            self.successors = successors
+            await self.send_successors()
+
+    async def handle_i_am_prev_message(self, message, reader, writer):
         """
         The previous node of the current node has changed
         and it's informing this node about being its new prev,
         so it can update the instance streams.
 
+        A node connecting through its successor list names the dead node it replaces.
+        If the previous node of this node is another one and alive, the connection is refused,
+        the node was cut out of the ring (e.g. it was only suspected dead).
+
+        :param message: Message of the new previous node
         :param reader: Stream reader of the new previous node
         :param writer: Stream writer of the new previous node
         """
-        # There is still an active connection to the old previous node
-        if self.prev_node_writer is not None and not self.prev_node_writer.is_closing():
-            self.prev_node_writer.close()
-            logging.info(f'{self.logical_clock}: Closing the old prev')
-            await self.prev_node_writer.wait_closed()
+        dead = message.message_data.get('dead')
+        if dead is not None and self.prev_node_writer is not None and \
+                peer_key(*dead) != peer_key(self.prev_node_address, self.prev_node_port):
+            self.log.info(f'{self.logical_clock}: Refusing {message.sender_address}:{message.sender_port} '
+                          f'replacing {dead[0]}:{dead[1]}, the previous node is alive')
+            writer.close()
+            return
+
+        old_writer = self.prev_node_writer
 
-        # Update the instance streams
+        # Update the instance streams first, so that closing the old
+        # connection is not taken for a death of the previous node.
         self.prev_node_reader = reader
         self.prev_node_writer = writer
+        self.prev_node_address = message.sender_address
+        self.prev_node_port = message.sender_port
+
+        # There is still an active connection to the old previous node
+        if old_writer is not None and not old_writer.is_closing():
+            old_writer.close()
+            self.log.info(f'{self.logical_clock}: Closing the old prev')
+            await old_writer.wait_closed()
+
+        # The election messages that waited for a previous node
+        backlog, self.prev_backlog = self.prev_backlog, []
+        for m in backlog:
+            await self.send_message_to_prev(m, keep=True)
+
+        await self.send_successors()
 
     async def handle_login_message(self, message, writer):
         """
@@ -356,43 +1355,40 @@ class CNode:
             }
 
         a = self.craft_message(MessageType.login_message, answer)
-        s_answer = a.convert_to_string()
 
         try:
 
-            logging.info(f'{self.logical_clock}: Sending info to the new node')
-            writer.write(s_answer.encode())
+            self.log.info(f'{self.logical_clock}: Sending info to the new node')
+            writer.write(a.convert_to_frame(self.codec_for(message.sender_address, message.sender_port)))
             await writer.drain()
             self.set_logical_clock(self.logical_clock)
 
         except ConnectionRefusedError:
 
-            logging.critical(f'{self.logical_clock}: Critical error while answering to login message')
-            sys.exit(1)
+            self.fail('Critical error while answering to login message')
 
         self.next_node_port = message.sender_port
         self.next_node_address = message.sender_address
 
         try:
 
-            logging.info(f'{self.logical_clock}: Opening connection to new next')
-            self.next_node_reader, self.next_node_writer = await asyncio.open_connection(self.next_node_address,
-                                                                                         self.next_node_port)
+            self.log.info(f'{self.logical_clock}: Opening connection to new next')
+            self.next_node_reader, self.next_node_writer = await self.open_connection(self.next_node_address,
+                                                                                      self.next_node_port)
             self.set_logical_clock(self.logical_clock)
 
         except ConnectionRefusedError:
 
-            logging.critical(f'{self.logical_clock}: Critical error while connecting to the new next node')
-            sys.exit(1)
+            self.fail('Critical error while connecting to the new next node')
 
-        logging.info(f'{self.logical_clock}: New connection opened, next node is:'
+        self.log.info(f'{self.logical_clock}: New connection opened, next node is:'
                      f' {self.next_node_address}:{self.next_node_port}')
 
-        logging.info(f'{self.logical_clock}: Informing next about being its prev')
+        self.log.info(f'{self.logical_clock}: Informing next about being its prev')
         m = self.craft_message(MessageType.i_am_prev_message, {})
         await self.send_message_to_ring(m)
 
-        logging.info(f'{self.logical_clock}: Closing the old connection')
+        self.log.info(f'{self.logical_clock}: Closing the old connection')
         writer.close()
         await writer.wait_closed()
 
@@ -404,10 +1400,23 @@ class CNode:
         and one is listening to incoming connections.
         """
 
-        logging.info(f'{self.logical_clock}: Starting node on port: {self.port}')
+        self.log.info(f'{self.logical_clock}: Starting node on port: {self.port}')
         self.set_logical_clock(self.logical_clock)
 
+        if self.message_log is not None:
+            self.load_history()
+            self.tasks.append(asyncio.create_task(self.message_log.run()))
+
         server_coro = asyncio.create_task(self.server_init())
+        self.tasks.append(server_coro)
+
+        # The ring connects back to this node while it joins, so the server must listen first.
+        # Depending on the event loop, binding the socket can take more than one loop iteration.
+        listening = asyncio.create_task(self.listening.wait())
+        await asyncio.wait([server_coro, listening], return_when=asyncio.FIRST_COMPLETED)
+        listening.cancel()
+        if server_coro.done():
+            self.fail(f'Server cannot be started: {server_coro.exception()}')
 
         # If node is the leader, it just needs to wait for a connection
         if self.is_leader:
@@ -419,29 +1428,36 @@ class CNode:
 
             try:
 
-                self.next_node_reader, self.next_node_writer = await asyncio.open_connection(self.next_node_address,
-                                                                                             self.next_node_port)
+                self.next_node_reader, self.next_node_writer = await self.open_connection(self.next_node_address,
+                                                                                          self.next_node_port)
             except ConnectionRefusedError:
 
-                logging.critical(f'{self.logical_clock}: Invalid IP or port passed in argument')
-                sys.exit(1)
+                self.fail('Invalid IP or port passed in argument')
 
-            logging.info(f'{self.logical_clock}: Initial connection established with '
+            self.log.info(f'{self.logical_clock}: Initial connection established with '
                          f'{self.next_node_address}:{self.next_node_port}')
             self.set_logical_clock(self.logical_clock)
 
             await self.join_the_ring()
-            logging.info(f'{self.logical_clock}: Ring joined')
+            self.log.info(f'{self.logical_clock}: Ring joined')
 
-        logging.info(f'{self.logical_clock}: Initialize socket reading')
+        self.log.info(f'{self.logical_clock}: Initialize socket reading')
         socket_coro = asyncio.create_task(self.read_socket())
+        self.tasks.append(socket_coro)
         self.set_logical_clock(self.logical_clock)
 
-        logging.info(f'{self.logical_clock}: Initialize input reading')
+        self.log.info(f'{self.logical_clock}: Initialize input reading')
         input_coro = asyncio.create_task(self.read_input())
+        self.tasks.append(input_coro)
         self.set_logical_clock(self.logical_clock)
 
-        print(Colors.GREEN + "/// Welcome to the dist-chat, you're free to write messages now. ///" + Colors.RESET)
+        if self.heartbeat_interval:
+            self.tasks.append(asyncio.create_task(self.run_heartbeat()))
+
+        if self.stats_port:
+            self.tasks.append(asyncio.create_task(self.stats_server_init()))
+
+        self.output.notice("/// Welcome to the dist-chat, you're free to write messages now. ///")
 
         try:
 
@@ -450,30 +1466,30 @@ class CNode:
             # Wait for the input_coro to end (= user wants to exit)
             # and cancel all the remaining running tasks.
             if input_coro.cancelled() or input_coro.done():
-                socket_coro.cancel()
-                server_coro.cancel()
+                for task in self.tasks:
+                    task.cancel()
 
             await socket_coro
             await server_coro
 
         except asyncio.CancelledError:
-            logging.info(f'{self.logical_clock}: All tasks cancelled')
+            self.log.info(f'{self.logical_clock}: All tasks cancelled')
+
+        if self.message_log is not None:
+            self.message_log.close()
+
+        # A fatal error in one of the tasks stopped the node
+        if self.error is not None:
+            raise self.error
 
     async def wait_for_connection(self):
         """
         The leader is alone and must wait for the first connection
         is order to continue creating the ring.
         """
-        while True:
-
-            # Try if already connected
-            if self.next_node_reader is not None:
-                logging.info(f'{self.logical_clock}: First connection - waking up...')
-                self.set_logical_clock(self.logical_clock)
-                break
-
-            # Not connected -- pass the execution for a while
-            await asyncio.sleep(0.1)
+        await self.next_attached.wait()
+        self.log.info(f'{self.logical_clock}: First connection - waking up...')
+        self.set_logical_clock(self.logical_clock)
 
     async def join_the_ring(self):
         """
@@ -482,23 +1498,31 @@ class CNode:
         with information about its next node, that is to become this node's next node.
         """
 
-        logging.info(f'{self.logical_clock}: Joining the ring')
+        self.log.info(f'{self.logical_clock}: Joining the ring')
 
         # Send login message to given node.
         message = self.craft_message(MessageType.login_message, {})
-        logging.info(f'{self.logical_clock}: Sending login message')
+        self.log.info(f'{self.logical_clock}: Sending login message')
         try:
             await self.send_message_to_ring(message)
         except ConnectionRefusedError:
-            logging.critical(f'{self.logical_clock}: Critical ring error')
-            sys.exit(1)
+            self.fail('Critical ring error')
 
         # Wait for the answer, close the current
         # connection to the node.
-        logging.info(f'{self.logical_clock}: Waiting for the answer to login message')
-        answer_raw = await self.next_node_reader.read()
-        answer = answer_raw.decode()
-        m_answer = CMessage(message_str=answer)
+        self.log.info(f'{self.logical_clock}: Waiting for the answer to login message')
+        while True:
+            try:
+                answer_raw = await read_frame(self.next_node_reader)
+            except (asyncio.IncompleteReadError, FrameError):
+                self.fail('Invalid answer to the login message')
+            m_answer = decode_payload(answer_raw)
+
+            # The node answers the capabilities announcement first.
+            if m_answer.message_type != MessageType.capabilities_message.value:
+                break
+            await self.handle_capabilities_message(m_answer, self.next_node_writer)
+
         answer_data = m_answer.message_data
         self.set_logical_clock(m_answer.time)
 
@@ -507,55 +1531,119 @@ class CNode:
 
         # The answer contains IP and port
         # of the new next node and the leader.
+        self.add_to_view(self.next_node_address, self.next_node_port)
         self.next_node_address = answer_data['next_IP']
         self.next_node_port = answer_data['next_port']
         self.leader_address = answer_data['leader_IP']
         self.leader_port = answer_data['leader_port']
+        self.add_to_view(self.next_node_address, self.next_node_port)
 
-        logging.info(f'{self.logical_clock}: Next node is {self.next_node_address}:{self.next_node_port}')
+        self.log.info(f'{self.logical_clock}: Next node is {self.next_node_address}:{self.next_node_port}')
 
         # Open new connection to the node whose
         # address and port were in the answer.
-        logging.info(f'{self.logical_clock}: Opening the new connection')
+        self.log.info(f'{self.logical_clock}: Opening the new connection')
         try:
-            self.next_node_reader, self.next_node_writer = await asyncio.open_connection(self.next_node_address,
-                                                                                         self.next_node_port)
+            self.next_node_reader, self.next_node_writer = await self.open_connection(self.next_node_address,
+                                                                                      self.next_node_port)
         except ConnectionError:
-            logging.error(f'{self.logical_clock}: Connection to the next node cannot be opened')
-            sys.exit(1)
+            self.fail('Connection to the next node cannot be opened')
 
         self.set_logical_clock(self.logical_clock)
 
         # Close the old connection now.
         old_w.close()
         await old_w.wait_closed()
-        logging.info(f'{self.logical_clock}: Closed old connection')
+        self.log.info(f'{self.logical_clock}: Closed old connection')
         self.set_logical_clock(self.logical_clock)
 
         # Inform next node to change its prev
         m = self.craft_message(MessageType.i_am_prev_message, {})
-        logging.info(f'{self.logical_clock}: Informing new next node')
+        self.log.info(f'{self.logical_clock}: Informing new next node')
         await self.send_message_to_ring(m)
 
         await self.connect_to_leader()
 
-    async def connect_to_leader(self):
-        # Connect to the leader and send him a hello
-        logging.info(f'{self.logical_clock}: Connecting to leader: {self.leader_address}:{self.leader_port}')
+    async def connect_to_leader(self, required=True):
+        """
+        Connect to the leader and send him a hello,
+        followed by the messages in the outbox (see flush_outbox).
+        The leader sends the broadcast back through the same connection,
+        it is read by the read_leader coroutine.
+
+        :param required: If set, the node fails if the connection cannot be opened
+        """
+        if self.leader_writer is not None:
+            self.leader_writer.close()
+            self.leader_writer = None
+        if self.leader_task is not None and self.leader_task is not asyncio.current_task():
+            self.leader_task.cancel()
+        if self.outbox_task is not None:
+            self.outbox_task.cancel()
+
+        # Nothing is sent to the new leader yet, the messages written meanwhile wait in the outbox
+        self.outbox_sent = next(iter(self.unacked), self.sender_seq + 1) - 1
+
+        self.log.info(f'{self.logical_clock}: Connecting to leader: {self.leader_address}:{self.leader_port}')
         try:
-            self.leader_reader, self.leader_writer = await asyncio.open_connection(self.leader_address,
-                                                                                   self.leader_port)
-        except ConnectionError:
-            logging.error(f'{self.logical_clock}: Connection to the leader cannot be opened')
-            sys.exit(1)
-        except asyncio.CancelledError:
-            logging.error(f'{self.logical_clock}: CancelledError')
-            sys.exit(1)
+            self.leader_reader, self.leader_writer = await self.open_connection(self.leader_address,
+                                                                                self.leader_port)
+        except OSError as e:
+            if required and isinstance(e, ConnectionError):
+                self.fail('Connection to the leader cannot be opened')
+            if required:
+                raise
+            self.log.info(f'{self.logical_clock}: Connection to the leader cannot be opened: {e!r}')
+            return
 
         self.set_logical_clock(self.logical_clock)
+        self.leader_task = asyncio.create_task(self.read_leader(self.leader_reader, self.leader_writer))
 
-        m = self.craft_message(MessageType.hello_leader_message, {})
+        m = self.craft_message(MessageType.hello_leader_message, {'last_seen': self.last_seen})
         await self.send_message_to_leader(m)
+        self.outbox_task = asyncio.create_task(self.flush_outbox())
+
+    async def reconnect_to_leader(self):
+        """
+        The leader is suspected dead, but it may be alive (a false suspicion, a half-open connection).
+        Open a new connection to it. If the leader cannot be reached, it is dead indeed:
+        its ring neighbors detect it too, and the node connects to the leader named by the election.
+        """
+        try:
+            await asyncio.wait_for(self.connect_to_leader(required=False), LEADER_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.log.info(f'{self.logical_clock}: Leader unreachable, waiting for the election')
+
+    async def read_leader(self, reader, writer):
+        """
+        Coroutine reading the messages the leader sends
+        through the connection this node opened to it.
+
+        :param reader: Stream reader of the connection to the leader
+        :param writer: Stream writer of the connection to the leader
+        """
+        decoder = FrameDecoder()
+
+        while True:
+            try:
+                data = await reader.read(READ_SIZE)
+                payloads = unpack_batches(decoder.feed(data))
+            except (ConnectionError, FrameError):
+                data = b''
+
+            if data != b'' and self.leader_writer is writer and self.leader_detector is not None:
+                self.leader_detector.alive()
+
+            if data == b'':
+                self.log.info(f'{self.logical_clock}: Lost connection to the leader')
+                if self.leader_writer is writer:
+                    writer.close()
+                    self.leader_reader = None
+                    self.leader_writer = None
+                return
+
+            for payload in payloads:
+                await self.handle_message(decode_payload(payload), reader, writer)
 
     def set_logical_clock(self, other_clock):
         """
@@ -568,14 +1656,19 @@ class CNode:
     async def server_init(self):
         """
         Initialize the server coroutine, make it run forever.
+        A node hosted by a ChannelHost gets its connections from the host instead.
         """
-        logging.info(f'{self.logical_clock}: Initializing the server')
+        self.log.info(f'{self.logical_clock}: Initializing the server')
         self.set_logical_clock(self.logical_clock)
+        if self.host is not None:
+            await self.host.serve(self)
+            return
         server = await asyncio.start_server(self.run_server, self.address, self.port)
+        self.listening.set()
         async with server:
             await server.serve_forever()
 
-    async def run_server(self, reader, writer):
+    async def run_server(self, reader, writer, pending=b''):
         """
         Callback made whenever a connection with the server is made.
         Try to read some data.
@@ -583,17 +1676,24 @@ class CNode:
         If the received data is empty, and this node is exiting, return.
         If the data is empty and the prev reader is not the current reader,
         return (the previous node must have changed).
-        Otherwise if the data is empty, close the connection, set the prev streams to none
-        and inform the dead previous' previous node where to connect.
-        If the data is OK, create a CMessage instance out of them and handle the message.
+        Otherwise if the data is empty, the previous node is lost (see handle_prev_lost).
+        If the data is OK, record the sign of life of the sender, decode all complete frames,
+        create a CMessage instance out of each of them and handle the messages.
+        Partial frame stays buffered for the next read.
 
         :param reader: AsyncIO StreamReader, high level socket for receiving data from the connection.
         :param writer: ASyncIO StreamWriter, high level socket for sending data through the connection.
+        :param pending: Data already read from the connection (e.g. by the ChannelHost)
         """
+        decoder = FrameDecoder()
+
         while True:
 
             # Read the data from the connection.
-            data = await reader.read(10000)
+            try:
+                data, pending = pending or await reader.read(READ_SIZE), b''
+            except ConnectionError:
+                data = b''
 
             # If the connection is closed/ing,
             # end the callback.
@@ -614,26 +1714,154 @@ class CNode:
                 if self.exiting:
                     return
 
+                await self.handle_prev_lost()
+                return
+
+            # Any data is a sign of life of the sender.
+            if writer is self.prev_node_writer:
+                if self.prev_detector is not None:
+                    self.prev_detector.alive()
+            elif self.is_leader:
+                conn = self.connections.find_by_reader(reader)
+                if conn is not None:
+                    conn.touch()
+
+            try:
+                payloads = decoder.feed(data)
+            except FrameError:
+                self.log.error(f'{self.logical_clock}: Invalid frame received, closing the connection')
                 writer.close()
-                await writer.wait_closed()
-                logging.info(f'{self.logical_clock}: Lost connection to previous node')
-                self.set_logical_clock(self.logical_clock)
-                self.prev_node_reader = None
-                self.prev_node_writer = None
-                await asyncio.sleep(0.5)
-                if self.next_node_writer is not None:
-                    logging.info(f'{self.logical_clock}: Informing the new prev')
-                    await self.send_prev_inform_message()
-                else:
-                    logging.info(f'{self.logical_clock}: Left alone, became the leader')
-                    self.is_leader = True
-                    self.leader_address = self.address
-                    self.leader_port = self.port
                 return
 
-            message = CMessage(message_str=data.decode())
+            for payload in payloads:
+                message = decode_payload(payload)
+                await self.handle_message(message, reader, writer)
 
-            await self.handle_message(message, reader, writer)
+                # The connection might have been closed by the handler (e.g. login).
+                if writer.is_closing():
+                    return
+
+    async def handle_prev_lost(self):
+        """
+        The previous node died or is suspected dead. Close the connection
+        and inform the dead previous' previous node where to connect.
+        The message carries the address of the dead node, so its previous
+        node can react even if it did not notice the death yet.
+        If there is no next node either, this node is left alone.
+        """
+        writer = self.prev_node_writer
+        dead = self.prev_node_address, self.prev_node_port
+        repairing = peer_key(*dead) in self.successor_peers
+        self.prev_node_reader = None
+        self.prev_node_writer = None
+        self.prev_node_address = None
+        self.prev_node_port = None
+        if writer is not None and not writer.is_closing():
+            writer.close()
+
+        self.log.info(f'{self.logical_clock}: Lost connection to previous node')
+        self.set_logical_clock(self.logical_clock)
+
+        # In a ring of two, the dead previous node is the next node as well.
+        if self.next_node_writer is not None and peer_key(self.next_node_address, self.next_node_port) == \
+                peer_key(*dead):
+            await self.handle_next_lost()
+
+        if self.next_node_writer is not None and self.successor_count and repairing:
+            # The node before the dead one most likely keeps a successor list as well
+            self.tasks.append(asyncio.create_task(self.inform_prev_unless_repaired(dead)))
+        elif self.next_node_writer is not None:
+            self.log.info(f'{self.logical_clock}: Informing the new prev')
+            await self.send_prev_inform_message(dead)
+        else:
+            self.log.info(f'{self.logical_clock}: Left alone, became the leader')
+            self.is_leader = True
+            self.leader_address = self.address
+            self.leader_port = self.port
+            await self.broadcast_unacked()
+
+    async def inform_prev_unless_repaired(self, dead):
+        """
+        Wait for the node before the dead previous node to connect through its successor list.
+        If it does not come in time, inform it by the prev inform message.
+
+        :param dead: Address and port of the dead previous node
+        """
+        try:
+            await asyncio.wait_for(self.prev_attached.wait(), SUCCESSOR_REPAIR_WAIT)
+            self.log.info(f'{self.logical_clock}: New prev connected through its successor list')
+            return
+        except asyncio.TimeoutError:
+            pass
+        if self.next_node_writer is not None and self.prev_node_writer is None:
+            self.log.info(f'{self.logical_clock}: Informing the new prev')
+            await self.send_prev_inform_message(dead)
+
+    async def handle_next_lost(self, repair=False):
+        """
+        The next node died or is suspected dead. Forget it and connect to its successor,
+        or wait for the prev inform message telling where to connect. If the next node
+        was the leader, this node initiates the election once the ring is renewed.
+
+        :param repair: True if the node detected the death itself, it connects to the successor of the dead node
+        """
+        writer = self.next_node_writer
+        dead = self.next_node_address, self.next_node_port
+        self.log.info(f'{self.logical_clock}: Lost connection to next node')
+        self.set_logical_clock(self.logical_clock)
+        if self.next_node_address == self.leader_address and self.next_node_port == self.leader_port:
+            self.initiate = True
+
+        self.next_node_writer = None
+        self.next_node_reader = None
+        self.next_node_address = None
+        self.next_node_port = None
+        if writer is not None and not writer.is_closing():
+            writer.close()
+
+        if repair and self.successor_count:
+            self.tasks.append(asyncio.create_task(self.connect_to_successor(dead)))
+
+    async def run_heartbeat(self):
+        """
+        Coroutine sending heartbeats to the neighbors and the leader
+        (or from the leader to all nodes) and checking the failure
+        detectors of these connections. A suspected connection is handled
+        as if it was closed, so the ring repair or the election starts
+        within a few heartbeat intervals even if TCP does not report anything.
+        """
+        heartbeat = self.craft_message(MessageType.heartbeat_message, {})
+
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            heartbeat.time = self.logical_clock
+
+            for writer, address, port in ((self.next_node_writer, self.next_node_address, self.next_node_port),
+                                          (self.prev_node_writer, self.prev_node_address, self.prev_node_port),
+                                          (self.leader_writer, self.leader_address, self.leader_port)):
+                if writer is not None and not writer.is_closing():
+                    writer.write(heartbeat.convert_to_frame(self.codec_for(address, port)))
+
+            if self.is_leader:
+                for conn in list(self.connections):
+                    conn.offer(heartbeat.convert_to_frame(self.codec_for(conn.addr, conn.port)))
+                    if conn.detector is not None and conn.detector.is_suspected(self.phi_threshold):
+                        self.log.info(f'{self.logical_clock}: {conn.addr}:{conn.port} suspected dead')
+                        self.close_connection(conn)
+
+            if self.prev_detector is not None and self.prev_detector.is_suspected(self.phi_threshold):
+                self.log.info(f'{self.logical_clock}: Previous node suspected dead')
+                await self.handle_prev_lost()
+
+            if self.next_detector is not None and self.next_detector.is_suspected(self.phi_threshold):
+                self.log.info(f'{self.logical_clock}: Next node suspected dead')
+                await self.handle_next_lost(repair=True)
+
+            if self.leader_detector is not None and self.leader_detector.is_suspected(self.phi_threshold):
+                self.log.info(f'{self.logical_clock}: Leader suspected dead, reconnecting')
+                self.leader_writer.close()
+                self.leader_writer = None
+                self.tasks.append(asyncio.create_task(self.reconnect_to_leader()))
 
     def remove_from_connections(self, reader, writer):
         """
@@ -643,106 +1871,174 @@ class CNode:
         :param reader: Stream reader of the removed connection
         :param writer: Stream writer of the removed connection
         """
-        for c in self.connections:
-            if c['reader'] == reader and c['writer'] == writer:
-                self.connections.remove(c)
-                return
+        conn = self.connections.find_by_reader(reader)
+        if conn is not None and conn.writer == writer:
+            self.close_connection(conn)
+
+    def fail(self, reason):
+        """
+        Stop the node because of a fatal error.
+
+        :param reason: Description of the error
+        :raises NodeError: Always
+        """
+        self.log.critical(f'{self.logical_clock}: {reason}')
+        self.error = NodeError(reason)
+        self.close()
+        raise self.error
+
+    def close(self):
+        """
+        Stop the node at once, as if it crashed: cancel all its tasks
+        and close all its connections without telling anyone.
+        The other nodes repair the ring as if the node died.
+        """
+        self.exiting = True
+        for task in self.tasks:
+            task.cancel()
+        if self.leader_task is not None:
+            self.leader_task.cancel()
+        if self.outbox_task is not None:
+            self.outbox_task.cancel()
+        for election in self.elections.values():
+            election.finish()
+
+        for writer in (self.next_node_writer, self.prev_node_writer, self.leader_writer):
+            if writer is not None and not writer.is_closing():
+                writer.close()
+        for conn in list(self.connections):
+            self.close_connection(conn)
+        for conn in list(self.peer_connections):
+            self.close_peer_connection(conn)
+        if self.message_log is not None:
+            self.message_log.close()
+
+    def close_connection(self, conn):
+        """
+        Close the leader connection and remove it from the connections list.
+
+        :param conn: CConnection to be closed
+        """
+        if self.connections.remove(conn):
+            # A relay or a node of a block is gone, the relays are assigned again
+            self.relays = None
+        conn.close()
 
     async def read_socket(self):
         """
         Coroutine keeping the connection to the next node alive.
-        No data is expected except for when the next node dies.
+        Only the answer to the capabilities announcement and heartbeats
+        are expected, b'' comes when the next node dies.
         """
-
-        # Flag is there to give the writer another change if the connection seems
-        # to be lost. During the various reconnections while logging in a new node
-        # it sometimes looked disconnected (probably a race condition).
-        flag = True
+        reader = writer = None
+        decoder = FrameDecoder()
 
         while True:
 
             # Next node is dead, must wait for message telling where to connect
-            if self.next_node_writer.is_closing():
-
-                logging.info(f'{self.logical_clock}: Waiting for connection...')
-                self.next_node_writer = None
-                self.next_node_reader = None
-                self.next_node_address = None
-                self.next_node_port = None
+            if self.next_node_reader is None:
+                self.log.info(f'{self.logical_clock}: Waiting for connection to the next node...')
+                await self.next_attached.wait()
 
-                while self.next_node_writer is None or self.next_node_reader is None:
-                    await asyncio.sleep(0.1)
+            # The next node has changed, start decoding its stream from scratch.
+            # The replaced connection is kept (and read) until the old next node
+            # closes it after it got the i am prev message from its new prev.
+            if reader is not self.next_node_reader:
+                reader, writer = self.next_node_reader, self.next_node_writer
+                decoder = FrameDecoder()
 
-                flag = True
-                continue
-
-            # Wait for some data to come. The only data to come through
-            # this stream should be b'' in case of the next node's death.
             try:
-
-                data = await self.next_node_reader.read()
-
-            except (asyncio.CancelledError, ConnectionError):
-
-                logging.info(f'{self.logical_clock}: Waiting for connection to the next node...')
-                self.next_node_writer = None
-                self.next_node_reader = None
-                self.next_node_address = None
-                self.next_node_port = None
-
-                while self.next_node_writer is None or self.next_node_reader is None:
-                    await asyncio.sleep(0.1)
-
-                flag = True
+                data = await reader.read(READ_SIZE)
+                payloads = decoder.feed(data)
+            except (ConnectionError, FrameError):
+                data = b''
+
+            if data != b'':
+                if reader is self.next_node_reader and self.next_detector is not None:
+                    self.next_detector.alive()
+                for payload in payloads:
+                    await self.handle_message(decode_payload(payload), reader, writer)
                 continue
 
-            # Next node just died, close the connection
-            if data == b'':
-
-                if self.exiting:
-                    return
-
-                # If there is a second chance, wait and repeat the reading.
-                if flag:
-                    await asyncio.sleep(0.3)
-                    flag = False
-                    continue
+            if self.exiting:
+                return
 
-                self.next_node_writer.close()
-                await self.next_node_writer.wait_closed()
-                logging.info(f'{self.logical_clock}: Lost connection to next node')
-                self.set_logical_clock(self.logical_clock)
-                if self.next_node_address == self.leader_address and self.next_node_port == self.leader_port:
-                    self.initiate = True
+            # The next node was replaced (login, ring repair) while reading, read the new one.
+            if reader is not self.next_node_reader:
+                writer.close()
+                continue
 
-            flag = True
+            await self.handle_next_lost(repair=True)
 
     async def read_input(self):
         """
-        Coroutine reading the user's keyboard input and
+        Coroutine reading the user's input and
         transforming it into the CMessage.
-        If '//exit' is read here, the program exits.
+        If '//exit' is read here or the input ends, the program exits.
+        '//stats' prints the metrics of the node.
         """
-        use_asyncio_event_loop()
+        async for message in self.input_source:
 
-        while True:
+            if message == '//exit':
+                break
 
-            with patch_stdout():
-                message = await prompt(f'> {self.name}({self.address}:{self.port}): ', async_=True)
+            if message == '//stats':
+                for line in self.collect_metrics().format():
+                    self.output.notice(line)
+                continue
 
-            if message == '//exit':
+            # Sending is an event of the node, so every message of the node has its own time
+            self.set_logical_clock(self.logical_clock)
+            umsg = self.craft_message(MessageType.user_message, message)
+            await self.send_user_message(umsg)
 
-                logging.info(f'{self.logical_clock}: Exiting...')
-                self.exiting = True
+        self.log.info(f'{self.logical_clock}: Exiting...')
+        self.exiting = True
 
-                if self.next_node_writer is not None:
-                    self.next_node_writer.close()
-                    await self.next_node_writer.wait_closed()
+        if self.next_node_writer is not None:
+            self.next_node_writer.close()
+            await self.next_node_writer.wait_closed()
 
-                return
+    def collect_metrics(self):
+        """
+        Update the gauges describing the current state of the node.
 
-            umsg = self.craft_message(MessageType.user_message, message)
-            await self.send_user_message(umsg)
+        :return: MetricsRegistry of the node
+        """
+        self.metrics.gauge('leader.connections').set(len(self.connections))
+        self.metrics.gauge('leader.queue_depth').set(sum(conn.queue.qsize() for conn in self.connections))
+        self.metrics.gauge('leader.messages_sent').set(sum(conn.messages_sent for conn in self.connections))
+        self.metrics.gauge('leader.bytes_sent').set(sum(conn.bytes_sent for conn in self.connections))
+        self.metrics.gauge('leader.messages_dropped').set(sum(conn.messages_dropped for conn in self.connections))
+        self.metrics.gauge('logical_clock').set(self.logical_clock)
+        self.metrics.gauge('history.messages').set(len(self.history))
+        self.metrics.gauge('history.bytes').set(self.history.bytes)
+        self.metrics.gauge('outbox.messages').set(len(self.unacked))
+        self.metrics.gauge('outbox.pending').set(self.pending())
+        return self.metrics
+
+    async def stats_server_init(self):
+        """
+        Serve the metrics of the node as JSON to local connections.
+        """
+        self.log.info(f'{self.logical_clock}: Serving stats on port {self.stats_port}')
+        server = await asyncio.start_server(self.send_stats, '127.0.0.1', self.stats_port)
+        async with server:
+            await server.serve_forever()
+
+    async def send_stats(self, reader, writer):
+        """
+        Callback of the stats server: send one JSON line with the metrics and close the connection.
+
+        :param reader: AsyncIO StreamReader of the connection
+        :param writer: AsyncIO StreamWriter of the connection
+        """
+        writer.write(self.collect_metrics().to_json().encode() + b'\n')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
 
     def craft_message(self, m_type, data):
         """
@@ -756,43 +2052,101 @@ class CNode:
         :return: CMessage instance
         """
         message = CMessage(sender_address=self.address, sender_port=self.port, sender_name=self.name,
-                           message_type=m_type, message_data=data, time=self.logical_clock)
+                           message_type=m_type, message_data=data, time=self.logical_clock, channel=self.channel)
         return message
 
     async def send_user_message(self, message):
         """
         Send user input as a message to the leader node.
+        The message is numbered and kept in the outbox until the leader acknowledges it,
+        it is sent again if the connection to the leader fails meanwhile.
+        While no leader is reachable (or older messages wait), the message only waits in the outbox.
+        A message that does not fit into the full outbox is refused with a notice.
 
         :param message: CMessage made from the user input.
         """
         if not self.is_leader:
-            logging.info(f'{self.logical_clock}: Sending message to leader')
+            if len(self.unacked) >= self.outbox_size:
+                self.output.notice(f'/// No leader to send to, {len(self.unacked)} messages wait already. '
+                                   f'Message not sent: {message.message_data}')
+                self.metrics.counter('outbox.refused').inc()
+                return
+            self.sender_seq += 1
+            message.sender_seq = self.sender_seq
+            self.unacked[message.sender_seq] = message
+            if self.leader_writer is None or self.voting or self.outbox_sent != message.sender_seq - 1:
+                self.log.debug('%s: Message %s waits in the outbox', self.logical_clock, message.sender_seq)
+                return
+            self.log.debug('%s: Sending message to leader', self.logical_clock)
+            self.outbox_sent = message.sender_seq
             await self.send_message_to_leader(message)
         else:
-            logging.info(f'{self.logical_clock}: No need to send user message, distributing')
-            await self.distribute_message(message)
+            self.log.debug('%s: No need to send user message, broadcasting', self.logical_clock)
+            await self.broadcast(message)
 
-    async def send_prev_inform_message(self):
+    async def send_prev_inform_message(self, dead=(None, None)):
         """
         Inform the node whose next is dead to connect to this node.
+
+        :param dead: Address and port of the dead previous node
         """
-        data = {'new_next_IP': self.address, 'new_next_port': self.port}
+        data = {'new_next_IP': self.address, 'new_next_port': self.port,
+                'dead_IP': dead[0], 'dead_port': dead[1]}
         message = self.craft_message(MessageType.prev_inform_message, data)
         await self.send_message_to_ring(message)
         self.set_logical_clock(self.logical_clock)
 
-    async def send_message_to_ring(self, message):
+    async def send_message_to_ring(self, message, keep=False):
         """
         Send given message to the next node in the ring.
 
         :param message: CMessage to be sent
+        :param keep: If set and there is no next node, the message waits until the ring is renewed
         """
-        m = message.convert_to_string()
+        if self.next_node_writer is None:
+            if keep:
+                self.log.info(f'{self.logical_clock}: No connection to the next node, keeping the message')
+                self.next_backlog.append(message)
+            else:
+                self.log.error('%s: No connection to the next node, dropping: %s', self.logical_clock,
+                               message.convert_to_string())
+                self.metrics.counter('dropped.ring').inc()
+            return
         try:
-            self.next_node_writer.write(m.encode())
+            self.next_node_writer.write(message.convert_to_frame(self.codec_for(self.next_node_address,
+                                                                                self.next_node_port)))
+            start = perf_counter()
             await self.next_node_writer.drain()
-        except ConnectionRefusedError:
-            logging.error(f'{self.logical_clock}: Connection refused while sending: {m}')
+            self.metrics.histogram('drain.ring').observe(perf_counter() - start)
+            self.metrics.counter('sent.ring').inc()
+        except ConnectionError as e:
+            self.log.error('%s: Connection error %r while sending: %s', self.logical_clock, e,
+                           message.convert_to_string())
+            self.metrics.counter('dropped.ring').inc()
+        self.set_logical_clock(self.logical_clock)
+
+    async def send_message_to_prev(self, message, keep=False):
+        """
+        Send given message to the previous node in the ring,
+        through the connection the previous node opened.
+
+        :param message: CMessage to be sent
+        :param keep: If set and there is no previous node, the message waits for the next one to connect
+        """
+        if self.prev_node_writer is None:
+            if keep:
+                self.log.info(f'{self.logical_clock}: No connection to the previous node, keeping the message')
+                self.prev_backlog.append(message)
+                return
+            self.log.error(f'{self.logical_clock}: Error - No connection to the previous node')
+            return
+        try:
+            self.prev_node_writer.write(message.convert_to_frame(self.codec_for(self.prev_node_address,
+                                                                                self.prev_node_port)))
+            await self.prev_node_writer.drain()
+            self.metrics.counter('sent.prev').inc()
+        except ConnectionError:
+            self.log.error(f'{self.logical_clock}: Error - Connection to the previous node')
         self.set_logical_clock(self.logical_clock)
 
     async def send_message_to_leader(self, message):
@@ -801,12 +2155,18 @@ class CNode:
 
         :param message: CMessage to be sent
         """
-        m = message.convert_to_string()
+        if self.leader_writer is None:
+            self.log.error(f'{self.logical_clock}: Error - No connection to the leader')
+            return
         try:
-            self.leader_writer.write(m.encode())
+            self.leader_writer.write(message.convert_to_frame(self.codec_for(self.leader_address,
+                                                                             self.leader_port)))
+            start = perf_counter()
             await self.leader_writer.drain()
+            self.metrics.histogram('drain.leader').observe(perf_counter() - start)
+            self.metrics.counter('sent.leader').inc()
         except ConnectionError:
-            logging.error(f'{self.logical_clock}: Error - Connection to the leader')
+            self.log.error(f'{self.logical_clock}: Error - Connection to the leader')
         self.set_logical_clock(self.logical_clock)
 
     async def initiate_election(self):
@@ -815,8 +2175,6 @@ class CNode:
         After the ring is renewed, the node who was previous to the leader
         initiates the election algorithm.
         """
-        logging.info(f'{self.logical_clock}: Initializing leader election...')
+        self.log.info(f'{self.logical_clock}: Initializing leader election...')
         self.set_logical_clock(self.logical_clock)
-        self.voting = True
-        m = self.craft_message(MessageType.election_message, {'addr': self.address, 'port': self.port})
-        await self.send_message_to_ring(m)
+        await self.election.start()
@@ -0,0 +1,129 @@
+"""
+Channels: several chatrooms in one process.
+
+Every channel is a ring of its own with its own leader, run by its own
+CNode. The nodes of all the channels of one process share one port: the
+ChannelHost accepts the connections and hands each of them to the node of
+the channel named in its first message (every connection starts with the
+capabilities message). The messages of the other channels than the default
+one carry the name of the channel, and the election IDs are hashed with it,
+so the channels sharing the same nodes elect different leaders.
+"""
+
+import asyncio
+import logging
+from soucevi1_dist_chat.chat_io import IteratorInput
+from soucevi1_dist_chat.codec import decode_payload
+from soucevi1_dist_chat.framing import FrameError, encode_frame, read_frame
+
+
+class ChannelHost:
+    """
+    Server shared by the nodes of several channels.
+    """
+
+    def __init__(self, address, port):
+        """
+        :param address: IP address the server listens on
+        :param port: Port the server listens on
+        """
+        self.address = address
+        self.port = port
+        self.nodes = {}
+        self.starting = None
+        self.log = logging.getLogger(f'{__name__}.{port}')
+
+    async def serve(self, node):
+        """
+        Hand the connections of the node's channel to the node until it stops.
+        The server is started by the first node.
+
+        :param node: CNode of one channel
+        """
+        self.nodes[node.channel] = node
+        if self.starting is None:
+            self.starting = asyncio.ensure_future(asyncio.start_server(self.accept, self.address, self.port))
+        server = await asyncio.shield(self.starting)
+        node.listening.set()
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            if self.nodes.get(node.channel) is node:
+                del self.nodes[node.channel]
+            if not self.nodes:
+                server.close()
+
+    async def accept(self, reader, writer):
+        """
+        Callback of the server: read the first message of the connection
+        and pass the connection to the node of its channel.
+
+        :param reader: Stream reader of the connection
+        :param writer: Stream writer of the connection
+        """
+        try:
+            payload = await read_frame(reader)
+            channel = decode_payload(payload).channel
+        except (asyncio.IncompleteReadError, ConnectionError, FrameError, ValueError, KeyError):
+            writer.close()
+            return
+
+        node = self.nodes.get(channel)
+        if node is None:
+            self.log.warning(f'Connection to unknown channel {channel} refused')
+            writer.close()
+            return
+        await node.run_server(reader, writer, encode_frame(payload))
+
+
+class ChannelRouter:
+    """
+    One input source shared by the nodes of several channels.
+    A line '#name text' is sent to the channel 'name', other lines to the first channel.
+    Commands (e.g. '//exit') and the end of the input go to all the channels.
+    """
+
+    def __init__(self, source, channels):
+        """
+        :param source: Input source, e.g. PromptInput
+        :param channels: Names of the channels, the first one is the default
+        """
+        self.source = source
+        self.channels = list(channels)
+        self.queues = {channel: asyncio.Queue() for channel in self.channels}
+
+    def input_for(self, channel):
+        """
+        :param channel: Name of the channel
+        :return: Input source of the node of the channel
+        """
+        return IteratorInput(self.lines(self.queues[channel]))
+
+    @staticmethod
+    async def lines(queue):
+        while True:
+            line = await queue.get()
+            if line is None:
+                return
+            yield line
+
+    async def run(self):
+        """
+        Coroutine reading the source and routing the lines.
+        """
+        async for line in self.source:
+            if line.startswith('#'):
+                name, _, text = line[1:].partition(' ')
+                if name in self.queues:
+                    self.queues[name].put_nowait(text)
+                    continue
+            if line.startswith('//'):
+                for queue in self.queues.values():
+                    queue.put_nowait(line)
+                if line == '//exit':
+                    break
+            else:
+                self.queues[self.channels[0]].put_nowait(line)
+
+        for queue in self.queues.values():
+            queue.put_nowait(None)
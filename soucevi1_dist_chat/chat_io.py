@@ -0,0 +1,271 @@
+"""
+Input sources and output sinks of the node.
+
+An input source is an async iterable of the lines the user (or a program)
+writes. An output sink shows the received chat messages and the notices
+of the node, it is closed when the node stops. The interactive prompt is only one of the sources, so a node
+can run without a terminal, e.g. as a bot or a load generator. The
+prompt_toolkit library is only imported when the prompt is used.
+"""
+
+import asyncio
+import json
+import sys
+from soucevi1_dist_chat.colors import Colors
+
+
+class PromptInput:
+    """
+    Interactive prompt reading the keyboard input.
+    """
+
+    def __init__(self, prompt_text):
+        """
+        :param prompt_text: Text of the prompt, or a function returning it before every line
+        """
+        self.prompt_text = prompt_text
+
+    async def __aiter__(self):
+        from prompt_toolkit import prompt
+        from prompt_toolkit.eventloop.defaults import use_asyncio_event_loop
+        from prompt_toolkit.patch_stdout import patch_stdout
+
+        use_asyncio_event_loop()
+        while True:
+            text = self.prompt_text() if callable(self.prompt_text) else self.prompt_text
+            with patch_stdout():
+                line = await prompt(text, async_=True)
+            yield line
+
+
+class StdinInput:
+    """
+    Lines read from the standard input, e.g. from a pipe. Ends with the input.
+    """
+
+    def __init__(self, stream=None):
+        """
+        :param stream: Binary stream to read, sys.stdin by default
+        """
+        self.stream = stream
+
+    async def __aiter__(self):
+        stream = self.stream if self.stream is not None else sys.stdin.buffer
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stream)
+        except ValueError:
+            # Regular files cannot be watched by the event loop, they never block anyway
+            for line in stream:
+                yield line.decode().rstrip('\n')
+            return
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield line.decode().rstrip('\n')
+
+
+class UnixSocketInput:
+    """
+    Lines written to a Unix socket by any number of local clients.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the socket
+        """
+        self.path = path
+
+    async def __aiter__(self):
+        lines = asyncio.Queue()
+
+        async def read_client(reader, writer):
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await lines.put(line.decode().rstrip('\n'))
+            writer.close()
+
+        server = await asyncio.start_unix_server(read_client, self.path)
+        async with server:
+            while True:
+                yield await lines.get()
+
+
+class IteratorInput:
+    """
+    Lines taken from a Python iterable or async iterable.
+    """
+
+    def __init__(self, lines):
+        """
+        :param lines: Iterable or async iterable of strings
+        """
+        self.lines = lines
+
+    async def __aiter__(self):
+        if hasattr(self.lines, '__aiter__'):
+            async for line in self.lines:
+                yield line
+        else:
+            for line in self.lines:
+                yield line
+
+
+class NoInput:
+    """
+    No input at all, the node only relays and receives messages until it is closed.
+    """
+
+    async def __aiter__(self):
+        await asyncio.get_running_loop().create_future()
+        yield
+
+
+class ConsoleOutput:
+    """
+    Colored output to the console.
+    """
+
+    def message(self, message):
+        """
+        :param message: Received user CMessage
+        """
+        channel = f'#{message.channel} ' if message.channel is not None else ''
+        print(Colors.BOLD + Colors.CYAN + f'> {channel}{message.sender_name}' + Colors.RESET +
+              f'({message.sender_address}:{message.sender_port})' + Colors.GREEN + f'[{message.time}]: '
+              + Colors.RESET + f'{message.message_data}')
+
+    def notice(self, text):
+        """
+        :param text: Notice of the node for the user
+        """
+        print(Colors.GREEN + text + Colors.RESET)
+
+    def close(self):
+        pass
+
+
+class JsonlOutput:
+    """
+    One JSON object per line: the messages in the JSON message format,
+    the notices as {"notice": text}.
+    """
+
+    def __init__(self, file):
+        """
+        :param file: Text file object the lines are written to
+        """
+        self.file = file
+
+    def message(self, message):
+        self.file.write(message.convert_to_string() + '\n')
+        self.file.flush()
+
+    def notice(self, text):
+        self.file.write(json.dumps({'notice': text}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        """
+        Close the file, the standard output is only flushed.
+        """
+        if self.file in (sys.stdout, sys.__stdout__):
+            self.file.flush()
+        elif not self.file.closed:
+            self.file.close()
+
+
+class CallbackOutput:
+    """
+    Output passed to Python functions.
+    """
+
+    def __init__(self, on_message, on_notice=None):
+        """
+        :param on_message: Function called with every received user CMessage
+        :param on_notice: Function called with every notice, notices are dropped if not given
+        """
+        self.on_message = on_message
+        self.on_notice = on_notice
+
+    def message(self, message):
+        self.on_message(message)
+
+    def notice(self, text):
+        if self.on_notice is not None:
+            self.on_notice(text)
+
+    def close(self):
+        pass
+
+
+class DiscardOutput:
+    """
+    Output dropping everything.
+    """
+
+    def message(self, message):
+        pass
+
+    def notice(self, text):
+        pass
+
+    def close(self):
+        pass
+
+
+def prompt_text(name, address, port, pending=0):
+    """
+    :param name: Name of the node
+    :param address: IP address of the node
+    :param port: Port of the node
+    :param pending: Number of the messages waiting for a leader
+    :return: Text of the interactive prompt
+    """
+    if pending:
+        return f'> {name}({address}:{port}) [{pending} pending]: '
+    return f'> {name}({address}:{port}): '
+
+
+def input_from_spec(spec, prompt):
+    """
+    Create the input source described on the command line.
+
+    :param spec: 'prompt', 'stdin', 'none' or 'unix:PATH'
+    :param prompt: Prompt of the interactive input, text or a function returning it
+    :return: Input source
+    :raises ValueError: Unknown specification
+    """
+    if spec == 'prompt':
+        return PromptInput(prompt)
+    if spec == 'stdin':
+        return StdinInput()
+    if spec == 'none':
+        return NoInput()
+    if spec.startswith('unix:'):
+        return UnixSocketInput(spec[len('unix:'):])
+    raise ValueError(f'Unknown input: {spec}')
+
+
+def output_from_spec(spec):
+    """
+    Create the output sink described on the command line.
+
+    :param spec: 'console', 'discard', 'jsonl' (standard output) or 'jsonl:PATH'
+    :return: Output sink
+    :raises ValueError: Unknown specification
+    """
+    if spec == 'console':
+        return ConsoleOutput()
+    if spec == 'discard':
+        return DiscardOutput()
+    if spec == 'jsonl':
+        return JsonlOutput(sys.stdout)
+    if spec.startswith('jsonl:'):
+        return JsonlOutput(open(spec[len('jsonl:'):], 'a'))
+    raise ValueError(f'Unknown output: {spec}')
@@ -2,27 +2,252 @@
 The main entry module for the command-line interface.
 """
 
+import itertools
 import sys
 import click
 from soucevi1_dist_chat import CNode
+from soucevi1_dist_chat.CConnection import OverflowPolicy
+from soucevi1_dist_chat.channels import ChannelHost, ChannelRouter
+from soucevi1_dist_chat.chat_io import input_from_spec, output_from_spec, prompt_text
+from soucevi1_dist_chat.codec import CODECS, decode_payload
+from soucevi1_dist_chat.event_loop import LOOPS, use_loop
+from soucevi1_dist_chat.framing import HEADER
+from soucevi1_dist_chat.message_log import FSYNC_POLICIES, MessageLog
 import asyncio
 import logging
+import logging.handlers
+import queue
 
 
-@click.command()
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting of the records to the listener thread.
+    The records never leave the process, so they do not need to be prepared.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(filename, verbose, level, fmt=None):
+    """
+    Log through a queue, so that the event loop only puts the records in the queue
+    and the formatting and the file I/O are done by a background thread.
+
+    :param filename: Name of the log file
+    :param verbose: If set, log to stdout as well
+    :param level: Name of the lowest logged level
+    :param fmt: Format of the records, only the message by default
+    :return: Started QueueListener, must be stopped at exit to flush the records
+    """
+    handlers = [logging.FileHandler(filename)]
+
+    # Verbose: log messages printed to stdout
+    if verbose:
+        handlers.append(logging.StreamHandler(sys.stdout))
+
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(fmt))
+
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    root_logger.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+# Options shared by all the commands running nodes
+NODE_OPTIONS = [
+    click.option('-v', '--verbose', is_flag=True, default=False, help='Logging not only to file, but also to stdout.'),
+    click.option('--log-level', type=click.Choice(LOG_LEVELS, case_sensitive=False), default='INFO',
+                 show_default=True,
+                 help='Lowest level of the logged messages. Per-message details are logged at DEBUG.'),
+    click.option('--loop', type=click.Choice(LOOPS), default='asyncio', show_default=True,
+                 help='Event loop implementation, uvloop falls back to asyncio when it is not installed.'),
+    click.option('-c', '--codec', type=click.Choice(list(CODECS)), multiple=True,
+                 help='Codec this node accepts from its peers, can be repeated. All codecs by default.'),
+    click.option('--send-queue-size', type=int, default=1024, show_default=True,
+                 help='Number of messages the leader queues for one node.'),
+    click.option('--overflow-policy', type=click.Choice([p.value for p in OverflowPolicy]),
+                 default=OverflowPolicy.block.value, show_default=True,
+                 help='What the leader does when the queue of a slow node is full.'),
+    click.option('--heartbeat-interval', type=float, default=1.0, show_default=True,
+                 help='Seconds between heartbeats sent to the neighbors and the leader, 0 disables them.'),
+    click.option('--phi-threshold', type=float, default=8.0, show_default=True,
+                 help='Suspicion level above which a silent node is considered dead.'),
+    click.option('--batch-window', type=float, default=0.0, show_default=True,
+                 help='Milliseconds the leader waits to batch messages for one node, 0 disables batching.'),
+    click.option('--batch-size', type=int, default=64, show_default=True,
+                 help='Maximum number of messages the leader packs into one batch.'),
+    click.option('--dissemination', type=click.Choice(CNode.DISSEMINATION_MODES), default='star', show_default=True,
+                 help='How the leader broadcasts the messages: star (sends them to every node), '
+                      'ring (the nodes relay them) or gossip (every node pushes them to a few peers).'),
+    click.option('--fanout', type=click.IntRange(min=1), default=4, show_default=True,
+                 help='Number of peers every node pushes a message to in the gossip mode.'),
+    click.option('--relay-threshold', type=click.IntRange(min=0), default=64, show_default=True,
+                 help='Number of nodes from which the leader broadcasts through relays in the star mode, '
+                      '0 disables the relays.'),
+    click.option('--history-size', type=click.IntRange(min=0), default=1000, show_default=True,
+                 help='Number of recent messages replayed to the nodes joining the chatroom, 0 disables the history.'),
+    click.option('--history-bytes', type=click.IntRange(min=0), default=1 << 20, show_default=True,
+                 help='Maximum size of the history in bytes.'),
+    click.option('--message-log', type=click.Path(file_okay=False),
+                 help='Directory of the persistent log of the messages the node broadcasts as the leader.'),
+    click.option('--message-log-all', is_flag=True, default=False,
+                 help='Log all the messages the node sees, not only as the leader.'),
+    click.option('--fsync', type=click.Choice(FSYNC_POLICIES), default='interval', show_default=True,
+                 help='When the message log is forced to the disk: after every batch of messages, '
+                      'once per second or never.'),
+    click.option('--outbox-size', type=click.IntRange(min=1), default=1000, show_default=True,
+                 help='Number of messages that wait for a leader, further messages are refused.'),
+    click.option('--election', type=click.Choice(list(CNode.ELECTIONS)), default='hirschberg-sinclair',
+                 show_default=True,
+                 help='Leader election algorithm started by this node.'),
+    click.option('--successors', type=click.IntRange(min=0), default=3, show_default=True,
+                 help='Number of next nodes remembered to repair the ring with one connection, 0 disables it.'),
+]
+
+
+def node_options(command):
+    """
+    Decorator adding the options shared by all the commands running nodes.
+    """
+    for option in reversed(NODE_OPTIONS):
+        command = option(command)
+    return command
+
+
+def node_settings(codec, send_queue_size, overflow_policy, heartbeat_interval, phi_threshold, batch_window,
+                  batch_size, dissemination, fanout, relay_threshold, history_size, history_bytes, message_log,
+                  message_log_all, fsync, outbox_size, election, successors):
+    """
+    Translate the shared options to the keyword arguments of CNode.
+
+    :param codec: Codecs announced to the peers, JSON is used with peers that do not share any other.
+    :param send_queue_size: Maximum number of messages queued by the leader for one node.
+    :param overflow_policy: Name of the OverflowPolicy applied when the queue of a node is full.
+    :param heartbeat_interval: Seconds between heartbeats, 0 disables the failure detection.
+    :param phi_threshold: Phi of the accrual failure detector above which a node is suspected dead.
+    :param batch_window: Milliseconds the leader collects messages for one batch, 0 disables batching.
+    :param batch_size: Maximum number of messages in one batch.
+    :param dissemination: Name of the broadcast mode of the leader, star, ring or gossip.
+    :param fanout: Number of peers a node pushes a gossip message to.
+    :param relay_threshold: Number of nodes from which the leader uses relays, 0 disables them.
+    :param history_size: Number of recent messages the node keeps for the catch-up, 0 disables the history.
+    :param history_bytes: Maximum total size of the kept messages.
+    :param message_log: Directory of the message log, no log if not given.
+    :param message_log_all: If set, the node logs all the messages, not only as the leader.
+    :param fsync: Name of the fsync policy of the message log.
+    :param outbox_size: Maximum number of the messages waiting for the leader's acknowledgement.
+    :param election: Name of the election algorithm the node starts.
+    :param successors: Length of the successor list, 0 disables it.
+    :return: Dictionary of the keyword arguments
+    """
+    return {'codecs': codec, 'send_queue_size': send_queue_size, 'overflow_policy': overflow_policy,
+            'heartbeat_interval': heartbeat_interval, 'phi_threshold': phi_threshold,
+            'batch_window': batch_window / 1000, 'batch_size': batch_size, 'dissemination': dissemination,
+            'fanout': fanout, 'relay_threshold': relay_threshold, 'history_size': history_size,
+            'history_bytes': history_bytes, 'message_log': message_log, 'message_log_all': message_log_all,
+            'fsync': fsync, 'outbox_size': outbox_size, 'election': election,
+            'successors': successors}
+
+
+def parse_ports(ctx, param, value):
+    """
+    Click callback parsing a list of ports and port ranges, e.g. '30000-30099,30200'.
+
+    :return: List of the ports
+    """
+    ports = []
+    try:
+        for part in value.split(','):
+            if '-' in part:
+                first, last = part.split('-')
+                ports.extend(range(int(first), int(last) + 1))
+            else:
+                ports.append(int(part))
+    except ValueError:
+        raise click.BadParameter(f'{value} is not a list of ports')
+    if not ports:
+        raise click.BadParameter(f'{value} does not contain any port')
+    return ports
+
+
+def parse_channels(ctx, param, value):
+    """
+    Click callback parsing the channels, e.g. 'general', 'general:leader' or 'general:1.2.3.4:12345'.
+    A channel without its own settings takes the leader flag and the neighbor of the node.
+
+    :return: List of (name, settings) of the channels, the settings are None,
+             'leader' or (neighbor address, neighbor port)
+    """
+    channels = []
+    for spec in value:
+        name, _, settings = spec.partition(':')
+        if not name:
+            raise click.BadParameter(f'{spec} does not name a channel')
+        if not settings:
+            channels.append((name, None))
+        elif settings == 'leader':
+            channels.append((name, 'leader'))
+        else:
+            neighbor_address, _, neighbor_port = settings.rpartition(':')
+            if not neighbor_address or not neighbor_port.isdigit():
+                raise click.BadParameter(f'{spec} is not NAME, NAME:leader or NAME:ADDRESS:PORT')
+            channels.append((name, (neighbor_address, neighbor_port)))
+    return channels
+
+
+def channel_role(settings, leader, neighbor_address, neighbor_port):
+    """
+    :param settings: Settings of the channel, see parse_channels
+    :param leader: Leader flag of the node
+    :param neighbor_address: IP address of the neighbor of the node
+    :param neighbor_port: Port of the neighbor of the node
+    :return: (leader flag, neighbor address, neighbor port) of the node in the channel
+    """
+    if settings == 'leader':
+        return True, None, None
+    if settings is not None:
+        return (False, *settings)
+    return leader, neighbor_address, neighbor_port
+
+
+@click.group(invoke_without_command=True)
 @click.option('-l/-L', '--leader/--not_leader', is_flag=True, default=False,
               help='This is the first node to started in this chatroom, e.g. the leader')
-@click.option('-a', '--address', required=True, help='IP address this node will run on')
+@click.option('-a', '--address', help='IP address this node will run on  [required]')
 @click.option('-p', '--port', type=int, help='Port this node will bind to')
 @click.option('-na', '--neighbor-address', help='IP address of the neighbor')
 @click.option('-np', '--neighbor-port', help='Port of the neighbor')
 @click.option('-n', '--name', help='Name that will be displayed to other participants')
-@click.option('-v', '--verbose', is_flag=True, default=False, help='Logging not only to file, but also to stdout.')
-def cli_main(leader, address, port, neighbor_address, neighbor_port, name, verbose):
+@node_options
+@click.option('--stats-port', type=int, help='Local port serving the metrics of the node as JSON.')
+@click.option('--channel', 'channels', multiple=True, callback=parse_channels,
+              help='Chatroom (channel) the node takes part in, can be repeated. The channels share the port, '
+                   'each of them has its own ring and leader. NAME:leader creates the channel, '
+                   'NAME:ADDRESS:PORT joins it through another neighbor than -na/-np. '
+                   'One default chatroom if not given.')
+@click.option('-i', '--input', 'input_spec', default='prompt', show_default=True,
+              help='Where the messages to send come from: prompt, stdin, none or unix:PATH '
+                   '(lines written to a Unix socket).')
+@click.option('-o', '--output', 'output_spec', default='console', show_default=True,
+              help='Where the received messages go: console, discard, jsonl (stdout) or jsonl:PATH.')
+@click.pass_context
+def cli_main(ctx, leader, address, port, neighbor_address, neighbor_port, name, verbose, log_level, loop,
+             stats_port, channels, input_spec, output_spec, **options):
     """
     Main function of the CLI program.
-    Runs one instance of the node with given parameters.
+    Runs one instance of the node with given parameters,
+    unless a command is given.
 
+    :param ctx: Click context.
     :param leader: Bool flag saying if the started node is the leader of a new chatroom.
     :param address: IP address of this node.
     :param port: Port the node will listen to and send from
@@ -30,31 +255,235 @@ def cli_main(leader, address, port, neighbor_address, neighbor_port, name, verbo
     :param neighbor_port: Port of the neighbor
     :param name: Name of the user
     :param verbose: If set, log to the file as well as to stdout. If not, log only to file.
+    :param log_level: Name of the lowest logged level.
+    :param loop: Name of the event loop implementation.
+    :param stats_port: Port on 127.0.0.1 serving the metrics, no stats server if not given.
+    :param channels: Channels with their settings, see parse_channels.
+                     A line '#name text' of the input goes to the channel 'name'.
+    :param input_spec: Input source of the node, the interactive prompt by default.
+    :param output_spec: Output sink of the node, the console by default.
+    :param options: Options shared by the commands, see node_settings.
     """
+    if ctx.invoked_subcommand is not None:
+        return
+    if address is None:
+        raise click.UsageError('Missing option "-a" / "--address".')
 
     # Initialize logging
-    root_logger = logging.getLogger()
-    file_handler = logging.FileHandler(f'chat_{port}.log')
-    root_logger.addHandler(file_handler)
-
-    # Verbose: log messages printed to stdout
-    if verbose:
-        console_handler = logging.StreamHandler(sys.stdout)
-        root_logger.addHandler(console_handler)
-
-    root_logger.setLevel(logging.INFO)
+    listener = setup_logging(f'chat_{port}.log', verbose, log_level.upper())
 
     # In case the log file already exists, divide the chat sessions
     logging.info('-------------------------------------')
+    logging.info(f'Event loop: {use_loop(loop)}')
 
-    if not leader:
-        if neighbor_address is None or neighbor_port is None:
-            print('/// Neighbor address and port need to be supplied for non-leader nodes')
-            print(f'a {neighbor_address}')
-            print(f'p {neighbor_port}')
-            sys.exit(1)
-    node = CNode.CNode(leader, address, port, neighbor_address, neighbor_port, name)
+    # Leader flag and neighbor of every channel, of the default chatroom if there are none
+    roles = [channel_role(settings, leader, neighbor_address, neighbor_port) for _, settings in channels] \
+        or [(leader, neighbor_address, neighbor_port)]
+    if any(not first and (n_address is None or n_port is None) for first, n_address, n_port in roles):
+        print('/// Neighbor address and port need to be supplied for non-leader nodes')
+        print(f'a {neighbor_address}')
+        print(f'p {neighbor_port}')
+        listener.stop()
+        sys.exit(1)
+
+    # The prompt shows how many messages wait for a leader
+    nodes = []
+
+    def prompt():
+        return prompt_text(name, address, port, sum(node.pending() for node in nodes))
+
+    try:
+        input_source = input_from_spec(input_spec, prompt)
+        output = output_from_spec(output_spec)
+    except (ValueError, OSError) as e:
+        print(f'/// {e}')
+        listener.stop()
+        sys.exit(1)
+
+    async def run_node():
+        # The node is created inside the running loop,
+        # so that its asyncio primitives belong to that loop.
+        node = CNode.CNode(leader, address, port, neighbor_address, neighbor_port, name,
+                           input_source=input_source, output=output, stats_port=stats_port,
+                           **node_settings(**options))
+        nodes.append(node)
+        await node.run()
+
+    async def run_channels():
+        # One node per channel, all of them on the same port
+        host = ChannelHost(address, port)
+        router = ChannelRouter(input_source, [channel for channel, _ in channels])
+        nodes.extend(CNode.CNode(first, address, port, n_address, n_port, name,
+                                 input_source=router.input_for(channel), output=output,
+                                 stats_port=stats_port if i == 0 else None, channel=channel, host=host,
+                                 **node_settings(**options))
+                     for i, ((channel, _), (first, n_address, n_port)) in enumerate(zip(channels, roles)))
+        routing = asyncio.create_task(router.run())
+        try:
+            # The channels this node creates are started first, the other nodes may join them meanwhile
+            return await run_nodes(sorted(nodes, key=lambda node: not node.is_leader))
+        finally:
+            routing.cancel()
 
     # The method 'run' serves as a high-level interface to run_until_complete, run_forever etc.
     # It is provisional and might be replaced in the future AsyncIO releases.
-    asyncio.run(node.run())
+    try:
+        if not channels:
+            asyncio.run(run_node())
+        elif asyncio.run(run_channels()):
+            print('/// Some of the channels failed, see the log')
+            sys.exit(1)
+    except CNode.NodeError as e:
+        print(f'/// {e}')
+        sys.exit(1)
+    finally:
+        output.close()
+        listener.stop()
+
+
+async def run_nodes(nodes):
+    """
+    Run the nodes in the current event loop.
+    The nodes are started one after another, each of them once the previous one
+    is in the chatroom, because the ring does not handle simultaneous joins.
+    A node that fails stops alone, the others keep running.
+
+    :param nodes: CNode instances, the leader of a new chatroom first
+    :return: Number of the nodes that failed
+    """
+    log = logging.getLogger(__name__)
+    tasks = {}
+    failed = 0
+
+    try:
+        for node in nodes:
+            task = asyncio.create_task(node.run())
+            tasks[task] = node
+            ready = asyncio.create_task(node.listening.wait() if node.is_leader else node.leader_attached.wait())
+            await asyncio.wait([task, ready], return_when=asyncio.FIRST_COMPLETED)
+            ready.cancel()
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = task.exception()
+                if error is None:
+                    continue
+                failed += 1
+                # The fatal errors of the nodes were logged by the nodes themselves
+                if not isinstance(error, CNode.NodeError):
+                    log.error(f'Node {tasks[task].port} failed: {error!r}')
+    finally:
+        for node in tasks.values():
+            node.close()
+        # Let the servers see their closed connections before the loop stops
+        await asyncio.sleep(0.1)
+    return failed
+
+
+@cli_main.command()
+@click.option('-l/-L', '--leader/--not_leader', is_flag=True, default=False,
+              help='The first node is the leader of a new chatroom, the others join it')
+@click.option('-a', '--address', required=True, help='IP address the nodes will run on')
+@click.option('-p', '--ports', required=True, callback=parse_ports,
+              help='Ports of the nodes, ranges and single ports separated by commas, e.g. 30000-30099')
+@click.option('-na', '--neighbor-address', help='IP address of the node in the chatroom the nodes join')
+@click.option('-np', '--neighbor-port', help='Port of the node in the chatroom the nodes join')
+@click.option('-n', '--name', default='node{port}', show_default=True,
+              help='Name of the nodes, {port} is replaced by the port of each node')
+@node_options
+@click.option('-i', '--input', 'input_spec', default='none', show_default=True,
+              help='Input of the nodes: none or unix:PATH, {port} is replaced by the port of each node.')
+@click.option('-o', '--output', 'output_spec', default='discard', show_default=True,
+              help='Output of the nodes: discard, console, jsonl or jsonl:PATH, {port} is replaced. '
+                   '{port} is replaced in --message-log as well.')
+def multi(leader, address, ports, neighbor_address, neighbor_port, name, verbose, log_level, loop, input_spec,
+          output_spec, **options):
+    """
+    Run many nodes in one process and one event loop.
+    All the nodes log to one file, each record starts with the name of the logger of the node.
+
+    :param leader: If set, the first node is the leader of a new chatroom.
+    :param address: IP address of the nodes.
+    :param ports: Ports of the nodes.
+    :param neighbor_address: IP address of the node in the chatroom the nodes join.
+    :param neighbor_port: Port of the node in the chatroom the nodes join.
+    :param name: Name of the nodes.
+    :param verbose: If set, log to the file as well as to stdout. If not, log only to file.
+    :param log_level: Name of the lowest logged level.
+    :param loop: Name of the event loop implementation.
+    :param input_spec: Input source of the nodes.
+    :param output_spec: Output sink of the nodes.
+    :param options: Options shared by the commands, see node_settings.
+    """
+    if leader:
+        neighbor_address, neighbor_port = address, ports[0]
+    elif neighbor_address is None or neighbor_port is None:
+        raise click.UsageError('Neighbor address and port need to be supplied unless the first node is the leader')
+    if input_spec in ('prompt', 'stdin'):
+        raise click.UsageError('The nodes cannot share the terminal, use none or unix:PATH as the input')
+
+    listener = setup_logging(f'chat_{ports[0]}-{ports[-1]}.log', verbose, log_level.upper(), '%(name)s %(message)s')
+    logging.info('-------------------------------------')
+    logging.info(f'Event loop: {use_loop(loop)}')
+
+    outputs = []
+
+    async def run_multi():
+        nodes = []
+        for i, port in enumerate(ports):
+            first = leader and i == 0
+            settings = node_settings(**options)
+            if settings['message_log'] is not None:
+                settings['message_log'] = settings['message_log'].replace('{port}', str(port))
+            nodes.append(CNode.CNode(first, address, port,
+                                     None if first else neighbor_address, None if first else neighbor_port,
+                                     name.replace('{port}', str(port)),
+                                     input_source=input_from_spec(input_spec.replace('{port}', str(port)), ''),
+                                     output=output_from_spec(output_spec.replace('{port}', str(port))),
+                                     **settings))
+            outputs.append(nodes[-1].output)
+        return await run_nodes(nodes)
+
+    try:
+        failed = asyncio.run(run_multi())
+    except (ValueError, OSError) as e:
+        print(f'/// {e}')
+        sys.exit(1)
+    finally:
+        for output in outputs:
+            output.close()
+        listener.stop()
+    if failed:
+        print(f'/// {failed} of {len(ports)} nodes failed, see the log')
+        sys.exit(1)
+
+
+@cli_main.command('log')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--since', type=int, help='Only the messages with a later Lamport time.')
+@click.option('--limit', type=click.IntRange(min=0), help='Maximum number of the printed messages.')
+@click.option('-o', '--output', 'output_spec', default='console', show_default=True,
+              help='Where the messages go: console, jsonl (stdout) or jsonl:PATH.')
+def message_log(directory, since, limit, output_spec):
+    """
+    Print the messages of a message log (see --message-log).
+    Only the printed messages are decoded, so paging through a long log is cheap.
+
+    :param directory: Directory of the message log.
+    :param since: Lamport time, only the later messages are printed.
+    :param limit: Maximum number of the printed messages.
+    :param output_spec: Output sink of the messages.
+    """
+    try:
+        output = output_from_spec(output_spec)
+    except (ValueError, OSError) as e:
+        print(f'/// {e}')
+        sys.exit(1)
+
+    log = MessageLog(directory, readonly=True)
+    for _, frame in itertools.islice(log.since(since), limit):
+        output.message(decode_payload(frame[HEADER.size:]))
+    log.close()
+    output.close()
@@ -0,0 +1,228 @@
+"""
+Codecs converting CMessage instances to frame payloads and back.
+
+Two codecs are available:
+
+   * json: the original JSON document, understood by every node
+
+   * binary: fixed binary header (type, clock, port, packed address)
+     followed by length-prefixed name and data
+
+The codec is chosen per peer during the capability handshake
+(see MessageType.capabilities_message). Decoding does not depend
+on the handshake, the codec of a payload is recognized by its first byte.
+"""
+
+import json
+import socket
+import struct
+from soucevi1_dist_chat.CMessage import CMessage
+
+
+class JsonCodec:
+    """
+    Codec sending the message as a JSON document.
+    """
+    name = 'json'
+
+    def encode(self, message):
+        """
+        :param message: CMessage to encode
+        :return: Frame payload
+        """
+        return message.convert_to_string().encode()
+
+    def decode(self, payload):
+        """
+        :param payload: Frame payload
+        :return: Decoded CMessage
+        """
+        return CMessage(message_str=payload.decode())
+
+
+class BinaryCodec:
+    """
+    Codec sending the message in a compact binary form.
+
+    Layout (network byte order)::
+
+       magic (1B) | type (1B) | flags (1B) | time (8B) | port (2B)
+       address (4B IPv4, 16B IPv6 or 1B length + text)
+       name length (2B) | name (UTF-8)
+       data length (4B) | data (UTF-8 text or JSON if FLAG_DATA_JSON)
+       seq (8B, only if FLAG_SEQ)
+       sender seq (8B, only if FLAG_SENDER_SEQ)
+       channel length (1B) | channel (UTF-8, only if FLAG_CHANNEL)
+
+    Messages that cannot be represented (e.g. non-numeric port)
+    are encoded as JSON, the receiver recognizes both.
+    """
+    name = 'binary'
+
+    MAGIC = 0xB1
+    HEADER = struct.Struct('!BBBQH')
+    NAME_LENGTH = struct.Struct('!H')
+    DATA_LENGTH = struct.Struct('!I')
+
+    FLAG_ADDR_V6 = 0x01
+    FLAG_ADDR_TEXT = 0x02
+    FLAG_DATA_JSON = 0x04
+    FLAG_SEQ = 0x08
+    FLAG_CHANNEL = 0x10
+    FLAG_SENDER_SEQ = 0x20
+    SEQ = struct.Struct('!Q')
+
+    def encode(self, message):
+        """
+        :param message: CMessage to encode
+        :return: Frame payload
+        """
+        m_type = message.message_type
+        if type(m_type) != int:
+            m_type = m_type.value
+        try:
+            port = int(message.sender_port)
+        except (TypeError, ValueError):
+            return JSON_CODEC.encode(message)
+        if not (0 <= port <= 0xFFFF and 0 <= m_type <= 0xFF and 0 <= message.time < 2 ** 64):
+            return JSON_CODEC.encode(message)
+
+        flags = 0
+        address = str(message.sender_address)
+        try:
+            packed_address = socket.inet_pton(socket.AF_INET, address)
+        except OSError:
+            try:
+                packed_address = socket.inet_pton(socket.AF_INET6, address)
+                flags |= self.FLAG_ADDR_V6
+            except OSError:
+                text = address.encode()
+                if len(text) > 255:
+                    return JSON_CODEC.encode(message)
+                packed_address = bytes((len(text),)) + text
+                flags |= self.FLAG_ADDR_TEXT
+
+        name = (message.sender_name or '').encode()
+        if len(name) > 0xFFFF:
+            return JSON_CODEC.encode(message)
+
+        seq = b''
+        if message.seq is not None:
+            if not 0 <= message.seq < 2 ** 64:
+                return JSON_CODEC.encode(message)
+            seq = self.SEQ.pack(message.seq)
+            flags |= self.FLAG_SEQ
+
+        sender_seq = b''
+        if message.sender_seq is not None:
+            if not 0 <= message.sender_seq < 2 ** 64:
+                return JSON_CODEC.encode(message)
+            sender_seq = self.SEQ.pack(message.sender_seq)
+            flags |= self.FLAG_SENDER_SEQ
+
+        channel = b''
+        if message.channel is not None:
+            channel = message.channel.encode()
+            if len(channel) > 255:
+                return JSON_CODEC.encode(message)
+            channel = bytes((len(channel),)) + channel
+            flags |= self.FLAG_CHANNEL
+
+        if isinstance(message.message_data, str):
+            data = message.message_data.encode()
+        else:
+            data = json.dumps(message.message_data).encode()
+            flags |= self.FLAG_DATA_JSON
+
+        return b''.join((self.HEADER.pack(self.MAGIC, m_type, flags, message.time, port),
+                         packed_address,
+                         self.NAME_LENGTH.pack(len(name)), name,
+                         self.DATA_LENGTH.pack(len(data)), data, seq, sender_seq, channel))
+
+    def decode(self, payload):
+        """
+        :param payload: Frame payload
+        :return: Decoded CMessage
+        """
+        _, m_type, flags, time, port = self.HEADER.unpack_from(payload)
+        offset = self.HEADER.size
+
+        if flags & self.FLAG_ADDR_TEXT:
+            length = payload[offset]
+            address = payload[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+        elif flags & self.FLAG_ADDR_V6:
+            address = socket.inet_ntop(socket.AF_INET6, payload[offset:offset + 16])
+            offset += 16
+        else:
+            address = socket.inet_ntop(socket.AF_INET, payload[offset:offset + 4])
+            offset += 4
+
+        (length,) = self.NAME_LENGTH.unpack_from(payload, offset)
+        offset += self.NAME_LENGTH.size
+        name = payload[offset:offset + length].decode()
+        offset += length
+
+        (length,) = self.DATA_LENGTH.unpack_from(payload, offset)
+        offset += self.DATA_LENGTH.size
+        data = payload[offset:offset + length].decode()
+        offset += length
+        if flags & self.FLAG_DATA_JSON:
+            data = json.loads(data)
+
+        seq = None
+        if flags & self.FLAG_SEQ:
+            (seq,) = self.SEQ.unpack_from(payload, offset)
+            offset += self.SEQ.size
+
+        sender_seq = None
+        if flags & self.FLAG_SENDER_SEQ:
+            (sender_seq,) = self.SEQ.unpack_from(payload, offset)
+            offset += self.SEQ.size
+
+        channel = None
+        if flags & self.FLAG_CHANNEL:
+            length = payload[offset]
+            channel = payload[offset + 1:offset + 1 + length].decode()
+
+        return CMessage(sender_address=address, sender_port=port, sender_name=name,
+                        message_type=m_type, message_data=data, time=time, seq=seq, sender_seq=sender_seq,
+                        channel=channel)
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+# Codecs in the order of preference
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+
+
+def decode_payload(payload):
+    """
+    Decode the frame payload using the codec it was encoded with.
+    The message keeps the payload, so it can be forwarded without encoding.
+
+    :param payload: Frame payload
+    :return: Decoded CMessage
+    """
+    if payload and payload[0] == BinaryCodec.MAGIC:
+        codec = BINARY_CODEC
+    else:
+        codec = JSON_CODEC
+    message = codec.decode(payload)
+    message.set_raw(payload, codec.name)
+    return message
+
+
+def choose_codec(local_names, remote_names):
+    """
+    Choose the most preferred codec supported by both sides.
+
+    :param local_names: Names of codecs supported by this node
+    :param remote_names: Names of codecs supported by the peer
+    :return: Codec instance, JSON if there is no better common codec
+    """
+    for name, codec in CODECS.items():
+        if name in local_names and name in remote_names:
+            return codec
+    return JSON_CODEC
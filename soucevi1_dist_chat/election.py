@@ -0,0 +1,261 @@
+"""
+Leader elections along the ring.
+
+When the leader dies and the ring is renewed, the node that was previous
+to the leader starts the election, the node with the largest ID
+(see CNode.node_id) becomes the new leader. Every algorithm is an object
+with the same interface: start makes the node a candidate and handle_message
+handles the election messages of the algorithm (their types are in message_types).
+A node takes part in the elections of all the algorithms, it only starts the one
+it is configured with.
+
+An election message may get lost while the ring is being repaired,
+e.g. when a node has no previous node yet. A node taking part in an election
+starts the election again if no leader is elected within ELECTION_TIMEOUT seconds.
+"""
+
+import asyncio
+from soucevi1_dist_chat.CConnection import peer_key
+from soucevi1_dist_chat.CMessage import MessageType
+
+# Seconds after which a node taking part in an election starts it again, unless a leader is elected
+ELECTION_TIMEOUT = 5.0
+
+# Direction of the election messages of Hirschberg-Sinclair along the ring
+DIRECTIONS = ['next', 'prev']
+
+
+def opposite(direction):
+    """
+    :param direction: One of DIRECTIONS
+    :return: The other direction
+    """
+    return 'prev' if direction == 'next' else 'next'
+
+
+class Election:
+    """
+    Base of the election algorithms run by one node.
+    """
+
+    # Types of the messages the algorithm handles
+    message_types = ()
+
+    def __init__(self, node):
+        """
+        :param node: CNode taking part in the elections
+        """
+        self.node = node
+        self.timer = None
+
+    async def start(self):
+        """
+        Make this node a candidate.
+        """
+        raise NotImplementedError
+
+    async def handle_message(self, message):
+        """
+        :param message: CMessage of one of the message_types
+        """
+        raise NotImplementedError
+
+    def vote(self):
+        """
+        The node takes part in the election. Unless a leader is elected in time, the node starts it again.
+        """
+        self.node.voting = True
+        if self.timer is None:
+            self.timer = asyncio.create_task(self.restart_later())
+
+    async def restart_later(self):
+        await asyncio.sleep(ELECTION_TIMEOUT)
+        self.timer = None
+        self.node.log.warning(f'{self.node.logical_clock}: No leader elected in {ELECTION_TIMEOUT} s, '
+                              f'starting the election again')
+        await self.start()
+
+    def finish(self):
+        """
+        The new leader is known or the node stops, the election is over.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def sender_id(self, data):
+        """
+        :param data: Data of an election message
+        :return: ID of the candidate, computed from its address if the message does not carry it
+        """
+        if 'id' in data:
+            return data['id']
+        return self.node.node_id(data['addr'], data['port'])
+
+
+class ChangRoberts(Election):
+    """
+    Chang-Roberts: the candidates send their IDs around the ring, O(n^2) messages in the worst case.
+    """
+
+    message_types = (MessageType.election_message,)
+
+    async def start(self):
+        node = self.node
+        self.vote()
+        m = node.craft_message(MessageType.election_message, {'addr': node.address, 'port': node.port, 'id': node.id})
+        await node.send_message_to_ring(m)
+
+    async def handle_message(self, message):
+        """
+        The node with the biggest ID (see CNode.node_id) will become the next leader.
+
+        :param message: Election CMessage from the previous node
+        """
+        node = self.node
+        sender_id = self.sender_id(message.message_data)
+
+        if sender_id > node.id:
+
+            # If the sender of the message as bigger ID, he's the candidate.
+            node.log.info(f'{node.logical_clock}: Passing election message on. '
+                          f'Candidate: {message.message_data["addr"]}:{message.message_data["port"]}')
+            await node.send_message_to_ring(message)
+            self.vote()
+
+        elif sender_id < node.id and not node.voting:
+
+            # If this node has bigger ID, he's the candidate.
+            node.log.info(f'{node.logical_clock}: I am the new leader candidate')
+            await self.start()
+
+        elif sender_id == node.id:
+
+            # If the message arrived with this node's ID, he won the election.
+            node.log.info(f'{node.logical_clock}: Received election message with my number -- NEW LEADER')
+            await node.announce_leader()
+
+
+class HirschbergSinclair(Election):
+    """
+    Hirschberg-Sinclair: the candidates probe both directions up to 2^phase hops, O(n log n) messages.
+    """
+
+    message_types = (MessageType.probe_message, MessageType.reply_message)
+
+    def __init__(self, node):
+        """
+        :param node: CNode taking part in the elections
+        """
+        super().__init__(node)
+        # Phase of the own candidacy (None if the node is not a candidate) and the replies received in it
+        self.phase = None
+        self.replies = 0
+
+    async def start(self):
+        self.vote()
+        await self.send_probes(0)
+
+    async def handle_message(self, message):
+        """
+        :param message: Probe or reply CMessage
+        """
+        if not self.in_election_round(message.message_data):
+            self.node.log.debug('%s: Dropping %s of a finished election', self.node.logical_clock,
+                                MessageType(message.message_type).name)
+            return
+        if MessageType(message.message_type) == MessageType.probe_message:
+            await self.handle_probe(message.message_data)
+        else:
+            await self.handle_reply(message.message_data)
+
+    def finish(self):
+        super().finish()
+        self.phase = None
+
+    def in_election_round(self, data):
+        """
+        The messages name the leader they replace. Once a new leader is elected, the late
+        messages of the candidates that lost are dropped instead of starting the election again.
+
+        :param data: Data of a probe or reply message
+        :return: True if the message belongs to the election replacing the current leader of this node
+        """
+        return peer_key(*data['leader']) == peer_key(self.node.leader_address, self.node.leader_port)
+
+    async def send_probes(self, phase):
+        """
+        Start the given phase of the own candidacy, probe both directions up to 2^phase hops.
+
+        :param phase: Number of the phase
+        """
+        node = self.node
+        self.phase = phase
+        self.replies = 0
+        node.log.info(f'{node.logical_clock}: Candidate in election phase {phase}')
+        for direction in DIRECTIONS:
+            m = node.craft_message(MessageType.probe_message,
+                                   {'addr': node.address, 'port': node.port, 'id': node.id, 'phase': phase,
+                                    'hops': 1, 'dir': direction, 'leader': [node.leader_address, node.leader_port]})
+            await self.send(m)
+
+    async def handle_probe(self, data):
+        """
+        A candidate probes its neighborhood. A probe of a smaller ID is swallowed, the node becomes
+        a candidate itself if it does not take part in the election yet. A probe of a bigger ID is passed on,
+        or answered by a reply at the end of the neighborhood. A probe that comes
+        back to its candidate went around the whole ring, the candidate won.
+
+        :param data: Data of the probe message
+        """
+        node = self.node
+        if data['id'] == node.id:
+            # The probes of both directions go around a small ring, the second one is ignored
+            if self.phase is not None:
+                self.phase = None
+                node.log.info(f'{node.logical_clock}: Received my own probe -- NEW LEADER')
+                await node.announce_leader()
+            return
+
+        if data['id'] < node.id:
+            if not node.voting:
+                await self.start()
+            return
+
+        self.vote()
+        self.phase = None
+        if data['hops'] < 2 ** data['phase']:
+            m = node.craft_message(MessageType.probe_message, dict(data, hops=data['hops'] + 1))
+        else:
+            m = node.craft_message(MessageType.reply_message, dict(data, dir=opposite(data['dir'])))
+        await self.send(m)
+
+    async def handle_reply(self, data):
+        """
+        The probe of a candidate reached the end of its neighborhood. The replies of other candidates
+        are passed on. A candidate that got the replies from both directions starts the next phase
+        with twice as big neighborhood.
+
+        :param data: Data of the reply message
+        """
+        if data['id'] != self.node.id:
+            await self.send(self.node.craft_message(MessageType.reply_message, data))
+            return
+
+        if data['phase'] == self.phase:
+            self.replies += 1
+            if self.replies == len(DIRECTIONS):
+                await self.send_probes(self.phase + 1)
+
+    async def send(self, message):
+        """
+        :param message: Probe or reply CMessage, sent to the next or the previous node according to its direction.
+                        The message waits for the neighbor if there is none at the moment.
+        """
+        if message.message_data['dir'] == 'next':
+            await self.node.send_message_to_ring(message, keep=True)
+        else:
+            await self.node.send_message_to_prev(message, keep=True)
+
+
+ELECTIONS = {'chang-roberts': ChangRoberts, 'hirschberg-sinclair': HirschbergSinclair}
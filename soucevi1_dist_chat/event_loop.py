@@ -0,0 +1,39 @@
+"""
+Selection of the event loop implementation.
+
+The node runs on the default asyncio loop unless uvloop is selected.
+uvloop is an optional dependency (``pip install soucevi1_dist_chat[uvloop]``),
+a drop-in replacement of the loop built on libuv, which makes the socket
+I/O of the node (mainly the fan-out of the leader) considerably cheaper.
+When it is not installed, the node falls back to the asyncio loop.
+"""
+
+import asyncio
+import logging
+
+LOOPS = ['asyncio', 'uvloop']
+
+
+def use_loop(name):
+    """
+    Install the event loop policy, the loops created afterwards
+    (e.g. by asyncio.run) are of the selected implementation.
+
+    :param name: 'asyncio' or 'uvloop'
+    :return: Name of the loop actually used, 'asyncio' if uvloop is not installed
+    :raises ValueError: Unknown loop
+    """
+    if name not in LOOPS:
+        raise ValueError(f'Unknown event loop: {name}')
+
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning('uvloop is not installed, using the asyncio event loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return 'uvloop'
+
+    asyncio.set_event_loop_policy(None)
+    return 'asyncio'
@@ -0,0 +1,80 @@
+"""
+Phi accrual failure detector.
+
+Instead of a fixed timeout, the detector learns the distribution
+of the intervals between heartbeats of a peer and expresses the
+suspicion as phi = -log10(probability that the heartbeat is still
+to come). Phi 1 means 10 % chance of a mistake, phi 8 one in 10^8.
+"""
+
+from collections import deque
+import math
+import time
+
+
+class PhiAccrualDetector:
+    """
+    Failure detector of one peer.
+    """
+
+    def __init__(self, interval, window=100, min_std=None, now=None):
+        """
+        :param interval: Expected interval between heartbeats in seconds
+        :param window: Number of recent intervals the distribution is estimated from
+        :param min_std: Lower bound of the standard deviation, a quarter of the interval by default
+        :param now: Current time, time.monotonic() by default
+        """
+        self.intervals = deque([interval], maxlen=window)
+        self.min_std = interval / 4 if min_std is None else min_std
+        self.last = time.monotonic() if now is None else now
+        self.last_heartbeat = self.last
+
+    def heartbeat(self, now=None):
+        """
+        Record a heartbeat of the peer. Only the intervals between heartbeats are
+        learned, a burst of other messages would make the peer look suspicious
+        as soon as it goes quiet.
+
+        :param now: Current time, time.monotonic() by default
+        """
+        now = time.monotonic() if now is None else now
+        self.intervals.append(now - self.last_heartbeat)
+        self.last_heartbeat = now
+        self.last = max(self.last, now)
+
+    def alive(self, now=None):
+        """
+        Record another sign of life of the peer (e.g. a received message).
+        It delays the suspicion, but it is not an interval between heartbeats.
+
+        :param now: Current time, time.monotonic() by default
+        """
+        now = time.monotonic() if now is None else now
+        self.last = max(self.last, now)
+
+    def phi(self, now=None):
+        """
+        Suspicion level of the peer.
+
+        :param now: Current time, time.monotonic() by default
+        :return: Phi value, 0 right after a heartbeat, growing while there is none
+        """
+        now = time.monotonic() if now is None else now
+        count = len(self.intervals)
+        mean = sum(self.intervals) / count
+        variance = sum((i - mean) ** 2 for i in self.intervals) / count
+        std = max(math.sqrt(variance), self.min_std)
+
+        # Probability that a heartbeat comes later than now (normal distribution tail)
+        p_later = 0.5 * math.erfc((now - self.last - mean) / (std * math.sqrt(2)))
+        if p_later <= 0.0:
+            return math.inf
+        return -math.log10(p_later)
+
+    def is_suspected(self, threshold, now=None):
+        """
+        :param threshold: Phi above which the peer is considered dead
+        :param now: Current time, time.monotonic() by default
+        :return: True if the peer is suspected to be dead
+        """
+        return self.phi(now) > threshold
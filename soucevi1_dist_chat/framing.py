@@ -0,0 +1,126 @@
+"""
+Length-prefixed framing of the messages sent over TCP streams.
+
+Every message is sent as a frame: a 4-byte big-endian length header
+followed by exactly that many bytes of payload. The framing keeps
+message boundaries intact even if TCP merges or splits the writes.
+
+Several frames can be packed into one batch frame, whose payload is
+the batch marker followed by the complete inner frames.
+"""
+
+import struct
+
+HEADER = struct.Struct('!I')
+
+# Upper bound of a single frame payload, protects the node
+# from allocating huge buffers because of a corrupted header.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# First byte of a batch payload, codec payloads never start with it.
+BATCH_MARKER = b'\xba'
+
+
+class FrameError(ValueError):
+    """
+    The stream does not contain a valid frame.
+    """
+
+
+def encode_frame(payload):
+    """
+    Prepend the length header to the payload.
+
+    :param payload: Bytes to be framed
+    :return: Frame ready to be written to the stream
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f'Frame payload too large: {len(payload)} bytes')
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_batch(frames):
+    """
+    Pack several frames into one batch frame.
+
+    :param frames: Complete frames (with their headers)
+    :return: Batch frame ready to be written to the stream
+    """
+    return encode_frame(BATCH_MARKER + b''.join(frames))
+
+
+def unpack_batches(payloads):
+    """
+    Replace every batch payload by the payloads of the frames inside it.
+
+    :param payloads: Payloads of received frames
+    :return: List of payloads of single messages
+    """
+    result = []
+    for payload in payloads:
+        if payload[:1] != BATCH_MARKER:
+            result.append(payload)
+            continue
+        decoder = FrameDecoder()
+        result.extend(decoder.feed(payload[1:]))
+        if decoder.pending():
+            raise FrameError('Batch ends in the middle of a frame')
+    return result
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of a stream of frames.
+    Data read from the stream is fed to the decoder, which returns
+    all the complete frames and keeps the partial one for the next read.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received data to the buffer and extract the complete frames.
+
+        :param data: Bytes read from the stream
+        :return: List of payloads of all complete frames
+        """
+        self.buffer += data
+        payloads = []
+        offset = 0
+        end = len(self.buffer)
+
+        while end - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f'Frame payload too large: {length} bytes')
+            if end - offset - HEADER.size < length:
+                break
+            start = offset + HEADER.size
+            payloads.append(bytes(self.buffer[start:start + length]))
+            offset = start + length
+
+        if offset:
+            del self.buffer[:offset]
+        return payloads
+
+    def pending(self):
+        """
+        :return: Number of buffered bytes not forming a complete frame yet
+        """
+        return len(self.buffer)
+
+
+async def read_frame(reader):
+    """
+    Read exactly one frame from the stream.
+
+    :param reader: AsyncIO StreamReader
+    :return: Payload of the frame
+    :raises asyncio.IncompleteReadError: The stream ended in the middle of the frame
+    """
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise FrameError(f'Frame payload too large: {length} bytes')
+    return await reader.readexactly(length)
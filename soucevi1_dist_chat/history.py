@@ -0,0 +1,91 @@
+"""
+History of the recent chat messages.
+
+The leader replays the history to the nodes that say hello to it, so a
+node joining the chatroom sees what was said before it came and a node
+reconnecting (e.g. after an election) gets what it missed meanwhile.
+Every node keeps the history of the messages it sees, not only the
+leader, so that a newly elected leader has one too.
+
+A message is identified by its Lamport time and its author, the author
+increments its logical clock before writing every message.
+"""
+
+from collections import deque
+from soucevi1_dist_chat.CConnection import peer_key
+from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.codec import BINARY_CODEC
+
+
+def plain_copy(message):
+    """
+    A plain user message shares its encoded forms with the copy, they are encoded only once.
+
+    :param message: User message of any broadcast type (e.g. ring_user_message)
+    :return: Copy of the message as a plain user message
+    """
+    copy = CMessage(sender_address=message.sender_address, sender_port=message.sender_port,
+                    sender_name=message.sender_name, time=message.time, message_type=MessageType.user_message,
+                    message_data=message.message_data, seq=message.seq, sender_seq=message.sender_seq,
+                    channel=message.channel)
+    if MessageType(message.message_type) == MessageType.user_message:
+        if message.frames is None:
+            message.frames = {}
+        copy.set_raw(message.raw, message.raw_codec)
+        copy.frames = message.frames
+    return copy
+
+
+class MessageHistory:
+    """
+    Recent user messages, bounded by their number and by their encoded size.
+    """
+
+    def __init__(self, max_messages=1000, max_bytes=1 << 20):
+        """
+        :param max_messages: Maximum number of the kept messages, 0 disables the history
+        :param max_bytes: Maximum total size of the kept messages in bytes (binary frames)
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, message):
+        """
+        Keep the message, the oldest messages are dropped when the history is full.
+        The message is sized by its binary frame, which stays cached for the message log and the replay.
+
+        :param message: Plain user message, see plain_copy
+        """
+        if not self.max_messages:
+            return
+        size = len(message.convert_to_frame(BINARY_CODEC))
+        self.entries.append((message, size))
+        self.bytes += size
+        while len(self.entries) > self.max_messages or self.bytes > self.max_bytes:
+            _, dropped = self.entries.popleft()
+            self.bytes -= dropped
+
+    def since(self, last_seen):
+        """
+        Messages that came after the given one. If the given message is not
+        in the history anymore, the messages with a later Lamport time are returned.
+
+        :param last_seen: (time, address, port) of the last message the node saw, None if it saw none
+        :return: List of the messages, the oldest first
+        """
+        messages = [message for message, _ in self.entries]
+        if last_seen is None:
+            return messages
+
+        time, address, port = last_seen
+        key = peer_key(address, port)
+        for i in range(len(messages) - 1, -1, -1):
+            message = messages[i]
+            if message.time == time and peer_key(message.sender_address, message.sender_port) == key:
+                return messages[i + 1:]
+        return [message for message in messages if message.time > time]
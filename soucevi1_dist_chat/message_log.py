@@ -0,0 +1,377 @@
+"""
+Persistent append-only log of the chat messages.
+
+The log is a directory of segments, files of at most segment_bytes bytes
+numbered in the order they were written. A segment is a sequence of
+records: the Lamport time of the message (8 bytes) followed by the message
+exactly as it is sent over the network, a frame of the binary codec.
+The log is read through memory maps and the frames are found by their
+length headers only, so paging through the log does not decode the
+messages. The frames can be sent as they are or decoded when needed.
+
+The Lamport time does not grow along the log, the leader broadcasts the
+messages in the order they came. The sparse index of a segment therefore
+maps the highest time of all the records before a position (which only
+grows) to the position, one entry per index_bytes bytes of the segment.
+All the records before the last entry whose highest time is not later than
+the time looked for are older, so the reading starts there.
+
+Appending a message only puts the record in a buffer. The buffer is written
+by a background task every flush_interval seconds (or when the segment is
+full), so the event loop does not wait for the disk on every message.
+The fsync policy says how often the data are forced to the disk:
+
+   * batch: after every write of the buffer
+   * interval: at most once per fsync_interval seconds
+   * never: left to the operating system
+
+The fsync runs in a thread, the event loop does not wait for it either.
+
+A log opened read-only (e.g. of a running node) never writes to the files,
+it stops at the last complete record instead of removing the cut off one.
+"""
+
+import asyncio
+import bisect
+import mmap
+import os
+import struct
+from soucevi1_dist_chat.codec import BINARY_CODEC
+from soucevi1_dist_chat.framing import HEADER
+
+FSYNC_POLICIES = ['batch', 'interval', 'never']
+
+# Lamport time of the record, followed by the frame of the message
+RECORD_TIME = struct.Struct('!Q')
+
+# Highest time of the records before the position, position in the segment
+INDEX_ENTRY = struct.Struct('!QQ')
+
+
+class Segment:
+    """
+    One file of the log and its sparse index.
+    """
+
+    def __init__(self, directory, number, max_time):
+        """
+        :param directory: Directory of the log
+        :param number: Number of the segment, the files are named after it
+        :param max_time: Highest time of the records in the previous segments
+        """
+        self.number = number
+        self.path = os.path.join(directory, f'{number:020d}.log')
+        self.index_path = os.path.join(directory, f'{number:020d}.idx')
+        self.index_times = []
+        self.index_positions = []
+        self.size = 0
+        self.max_time = max_time
+        self.view = None
+
+    def load(self, readonly=False):
+        """
+        Read the index of an existing segment and find the highest time of its records.
+        A record cut off by a crash at the end of the segment is removed.
+
+        :param readonly: If set, the files are not changed, the cut off record is only skipped
+        """
+        self.size = os.path.getsize(self.path)
+        if readonly:
+            try:
+                with open(self.index_path, 'rb') as index_file:
+                    data = index_file.read()
+            except FileNotFoundError:
+                data = b''
+        else:
+            with open(self.index_path, 'ab+') as index_file:
+                index_file.seek(0)
+                data = index_file.read()
+        for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            time, position = INDEX_ENTRY.unpack_from(data, offset)
+            if position >= self.size:
+                break
+            self.index_times.append(time)
+            self.index_positions.append(position)
+            self.max_time = max(self.max_time, time)
+
+        # Only the records after the last index entry are read
+        position = self.index_positions[-1] if self.index_positions else 0
+        for time, end in self.scan(position):
+            self.max_time = max(self.max_time, time)
+            position = end
+        if position < self.size:
+            if not readonly:
+                with open(self.path, 'r+b') as file:
+                    file.truncate(position)
+            self.size = position
+            self.view = None
+            if self.index_positions and self.index_positions[-1] >= position:
+                self.index_times.pop()
+                self.index_positions.pop()
+
+        # Rewrite the index if it had entries of the removed records or a partial entry
+        if not readonly and len(data) != len(self.index_positions) * INDEX_ENTRY.size:
+            with open(self.index_path, 'wb') as index_file:
+                index_file.write(b''.join(INDEX_ENTRY.pack(time, position) for time, position
+                                          in zip(self.index_times, self.index_positions)))
+
+    def mapped(self):
+        """
+        :return: Memory map of the written part of the segment
+        """
+        if self.size == 0:
+            return b''
+        if self.view is None or len(self.view) != self.size:
+            # The old map is not closed, records read from it may still be in use
+            with open(self.path, 'rb') as file:
+                self.view = mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.view
+
+    def scan(self, position=0, stop=None):
+        """
+        Walk the complete records.
+
+        :param position: Position of the first record
+        :param stop: Position of the first record not walked, the end of the segment by default
+        :return: Generator of (time, end position) of the records
+        """
+        data = self.mapped()
+        size = len(data) if stop is None else min(stop, len(data))
+        while position + RECORD_TIME.size + HEADER.size <= size:
+            (time,) = RECORD_TIME.unpack_from(data, position)
+            (length,) = HEADER.unpack_from(data, position + RECORD_TIME.size)
+            end = position + RECORD_TIME.size + HEADER.size + length
+            if end > size:
+                return
+            yield time, end
+            position = end
+
+    def records(self, position=0, stop=None):
+        """
+        :param position: Position of the first record
+        :param stop: Position of the first record not read, the end of the segment by default
+        :return: Generator of (time, frame) of the records
+        """
+        data = self.mapped()
+        for time, end in self.scan(position, stop):
+            yield time, data[position + RECORD_TIME.size:end]
+            position = end
+
+    def start_after(self, time):
+        """
+        :param time: Lamport time
+        :return: Position from which the records with a later time can be
+        """
+        i = bisect.bisect_right(self.index_times, time) - 1
+        return self.index_positions[i] if i >= 0 else 0
+
+
+class MessageLog:
+    """
+    Segmented append-only log of the user messages.
+    """
+
+    def __init__(self, directory, segment_bytes=64 << 20, index_bytes=4096, flush_interval=0.05,
+                 fsync='interval', fsync_interval=1.0, readonly=False):
+        """
+        Open the log, the existing segments are kept and the new messages are appended.
+
+        :param directory: Directory of the segments, created if it does not exist (unless read-only)
+        :param segment_bytes: Size from which a new segment is started
+        :param index_bytes: Number of bytes of a segment between two index entries
+        :param flush_interval: Seconds between the writes of the buffered records
+        :param fsync: Policy forcing the data to the disk, see FSYNC_POLICIES
+        :param fsync_interval: Minimal seconds between two fsyncs with the interval policy
+        :param readonly: If set, the log is only read, nothing can be appended
+        :raises ValueError: Unknown fsync policy
+        :raises FileNotFoundError: Read-only log directory does not exist
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy: {fsync}')
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_bytes = index_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.readonly = readonly
+
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        max_time = 0
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                segment = Segment(directory, int(name[:-len('.log')]), max_time)
+                segment.load(readonly)
+                self.segments.append(segment)
+                max_time = segment.max_time
+        self.max_time = max_time
+
+        self.buffer = bytearray()
+        self.index_buffer = bytearray()
+        self.last_indexed = None
+        self.dirty = False
+        self.file = None
+        self.index_file = None
+        self.active = self.segments[-1] if self.segments else None
+        if readonly:
+            return
+        if self.segments:
+            self.open_segment(self.segments[-1])
+        else:
+            self.roll()
+
+    def open_segment(self, segment):
+        self.active = segment
+        self.file = open(segment.path, 'ab', buffering=0)
+        self.index_file = open(segment.index_path, 'ab', buffering=0)
+        self.last_indexed = segment.index_positions[-1] if segment.index_positions else None
+
+    def roll(self):
+        """
+        Close the active segment and start a new one.
+        """
+        number = self.segments[-1].number + 1 if self.segments else 0
+        if self.file is not None:
+            self.close_files(wait=False)
+        segment = Segment(self.directory, number, self.max_time)
+        self.segments.append(segment)
+        self.open_segment(segment)
+
+    def append(self, message):
+        """
+        Buffer the message, it is written by the background task.
+        The binary frame cached on the message (e.g. when it was kept in the history) is reused.
+
+        :param message: User message
+        :raises ValueError: The log is read-only
+        """
+        if self.readonly:
+            raise ValueError('The message log is read-only')
+        record = RECORD_TIME.pack(message.time) + message.convert_to_frame(BINARY_CODEC)
+        position = self.active.size + len(self.buffer)
+        if position and position + len(record) > self.segment_bytes:
+            self.flush()
+            self.roll()
+            position = 0
+
+        if self.last_indexed is None or position - self.last_indexed >= self.index_bytes:
+            self.active.index_times.append(self.max_time)
+            self.active.index_positions.append(position)
+            self.index_buffer += INDEX_ENTRY.pack(self.max_time, position)
+            self.last_indexed = position
+
+        self.buffer += record
+        self.max_time = max(self.max_time, message.time)
+
+    def flush(self):
+        """
+        Write the buffered records to the active segment.
+        """
+        if not self.buffer:
+            return
+        self.file.write(self.buffer)
+        self.index_file.write(self.index_buffer)
+        self.active.size += len(self.buffer)
+        self.active.max_time = self.max_time
+        self.buffer = bytearray()
+        self.index_buffer = bytearray()
+        self.dirty = True
+
+    async def run(self):
+        """
+        Coroutine writing the buffered records and forcing them to the disk according to the fsync policy.
+        """
+        loop = asyncio.get_running_loop()
+        synced = loop.time()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+            if not self.dirty or self.fsync == 'never':
+                continue
+            if self.fsync == 'interval' and loop.time() - synced < self.fsync_interval:
+                continue
+
+            # The files may be closed by a roll meanwhile, the thread syncs their duplicates
+            self.dirty = False
+            synced = loop.time()
+            descriptors = [os.dup(self.file.fileno()), os.dup(self.index_file.fileno())]
+            await loop.run_in_executor(None, sync_descriptors, descriptors)
+
+    def since(self, time):
+        """
+        Records of the messages with a later Lamport time than the given one.
+
+        :param time: Lamport time, None for all the records
+        :return: Generator of (time, frame) of the records in the order of the log
+        """
+        self.flush()
+        if time is None:
+            first = 0
+        else:
+            first = bisect.bisect_right([segment.max_time for segment in self.segments], time)
+        for segment in self.segments[first:]:
+            position = segment.start_after(time) if time is not None else 0
+            for record in segment.records(position):
+                if time is None or record[0] > time:
+                    yield record
+
+    def tail(self, count):
+        """
+        :param count: Number of the records
+        :return: List of (time, frame) of the last records in the order of the log
+        """
+        self.flush()
+        chunks, found = [], 0
+        for segment in reversed(self.segments):
+            # The records are read backwards by the parts between the index entries
+            stop = None
+            for position in reversed(segment.index_positions or [0]):
+                if found >= count:
+                    break
+                chunk = list(segment.records(position, stop))
+                chunks.append(chunk)
+                found += len(chunk)
+                stop = position
+        records = [record for chunk in reversed(chunks) for record in chunk]
+        return records[len(records) - count:] if count else []
+
+    def close_files(self, wait=True):
+        """
+        :param wait: If not set and the event loop is running, the fsync runs in a thread
+        """
+        self.flush()
+        if self.dirty and self.fsync != 'never':
+            descriptors = [os.dup(self.file.fileno()), os.dup(self.index_file.fileno())]
+            try:
+                loop = None if wait else asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is None:
+                sync_descriptors(descriptors)
+            else:
+                loop.run_in_executor(None, sync_descriptors, descriptors)
+        self.dirty = False
+        self.file.close()
+        self.index_file.close()
+
+    def close(self):
+        """
+        Write the buffered records and close the log. Closing it again does nothing.
+        """
+        if self.file is not None and not self.file.closed:
+            self.close_files()
+
+
+def sync_descriptors(descriptors):
+    """
+    Force the files to the disk and close the descriptors.
+
+    :param descriptors: Duplicated file descriptors
+    """
+    for descriptor in descriptors:
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
@@ -0,0 +1,181 @@
+"""
+Lightweight metrics of the node: counters, gauges and latency histograms.
+
+Updating a metric is a dictionary lookup and an addition, so the node
+can record every message. The registry produces a snapshot, which is
+printed by the '//stats' command or sent by the stats server.
+"""
+
+from bisect import bisect_left
+import json
+import time
+
+# Upper bounds of the latency histogram buckets in seconds (50 us - 5 s).
+# Observations above the last bound fall into an extra overflow bucket.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    """
+    Monotonically increasing count of events.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """
+        :param amount: Number of events to add
+        """
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """
+    Value that can go up and down, e.g. the number of connections.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        """
+        :param value: Current value
+        """
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        :param bounds: Sorted upper bounds of the buckets
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        :param value: Observed value
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Estimate the quantile as the upper bound of the bucket it falls into.
+
+        :param q: Quantile between 0 and 1
+        :return: Upper bound of the bucket, the maximum for the overflow bucket, 0 if empty
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'max': self.max}
+
+
+class MetricsRegistry:
+    """
+    Named metrics of one node. Metrics are created on their first use.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.metrics = {}
+
+    def get(self, name, kind):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = kind()
+        return metric
+
+    def counter(self, name):
+        """
+        :param name: Name of the counter
+        :return: Counter
+        """
+        return self.get(name, Counter)
+
+    def gauge(self, name):
+        """
+        :param name: Name of the gauge
+        :return: Gauge
+        """
+        return self.get(name, Gauge)
+
+    def histogram(self, name):
+        """
+        :param name: Name of the latency histogram
+        :return: Histogram
+        """
+        return self.get(name, Histogram)
+
+    def snapshot(self):
+        """
+        :return: Dictionary with the uptime and the values of all metrics, sorted by name
+        """
+        snapshot = {'uptime': time.monotonic() - self.started}
+        for name in sorted(self.metrics):
+            snapshot[name] = self.metrics[name].snapshot()
+        return snapshot
+
+    def to_json(self):
+        """
+        :return: Snapshot in the JSON format
+        """
+        return json.dumps(self.snapshot())
+
+    def format(self):
+        """
+        Human-readable snapshot. Counters are shown with their rate per second,
+        latencies in milliseconds.
+
+        :return: List of lines
+        """
+        uptime = time.monotonic() - self.started
+        lines = [f'uptime: {uptime:.1f} s']
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            if isinstance(metric, Counter):
+                lines.append(f'{name}: {metric.value} ({metric.value / uptime:.1f}/s)')
+            elif isinstance(metric, Gauge):
+                lines.append(f'{name}: {metric.value}')
+            else:
+                s = metric.snapshot()
+                lines.append(f'{name}: n={s["count"]} mean={s["mean"] * 1000:.3f} ms p50={s["p50"] * 1000:.3f} ms '
+                             f'p99={s["p99"] * 1000:.3f} ms max={s["max"] * 1000:.3f} ms')
+        return lines
@@ -1,5 +1,7 @@
 import pytest
 from soucevi1_dist_chat.CNode import CNode
+from unittest.mock import MagicMock
+from soucevi1_dist_chat.CConnection import CConnection
 from soucevi1_dist_chat.CMessage import CMessage, MessageType
 
 
@@ -18,3 +20,11 @@ def message_instance():
                        message_type=MessageType.user_message,
                        message_data='Ahoj')
     return message
+
+
+@pytest.fixture
+def connections():
+    writer = MagicMock()
+    writer.is_closing.return_value = False
+    return [CConnection('1.1.1.1', '1111', 'reader1', writer),
+            CConnection('127.0.0.1', '54321', 'reader3', MagicMock())]
@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+from asynctest import CoroutineMock
+from unittest.mock import MagicMock
+from soucevi1_dist_chat.channels import ChannelHost, ChannelRouter
+from soucevi1_dist_chat.chat_io import IteratorInput
+from soucevi1_dist_chat.CMessage import CMessage, MessageType
+
+
+def channel_node(channel):
+    node = MagicMock()
+    node.channel = channel
+    node.listening = asyncio.Event()
+    node.run_server = CoroutineMock()
+    return node
+
+
+@pytest.mark.asyncio
+async def test_channel_host():
+    host = ChannelHost('127.0.0.1', 29110)
+    nodes = [channel_node('a'), channel_node('b')]
+    tasks = [asyncio.create_task(host.serve(node)) for node in nodes]
+    await asyncio.wait_for(nodes[1].listening.wait(), 1)
+    assert nodes[0].listening.is_set()
+
+    message = CMessage(sender_address='127.0.0.1', sender_port='4321', sender_name='Lojza', time=1,
+                       message_type=MessageType.capabilities_message, message_data={}, channel='b')
+    frame = message.convert_to_frame()
+    reader, writer = await asyncio.open_connection('127.0.0.1', 29110)
+    writer.write(frame)
+    for _ in range(100):
+        if nodes[1].run_server.called:
+            break
+        await asyncio.sleep(0.01)
+    nodes[0].run_server.assert_not_called()
+    assert nodes[1].run_server.call_args[0][2] == frame
+
+    # Unknown channel
+    message.channel = 'c'
+    reader, writer = await asyncio.open_connection('127.0.0.1', 29110)
+    writer.write(message.convert_to_frame())
+    assert await asyncio.wait_for(reader.read(), 1) == b''
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert host.nodes == {}
+
+
+@pytest.mark.asyncio
+async def test_channel_router():
+    lines = ['hello', '#b hi b', '#x no such channel', '//stats', '//exit', 'ignored']
+    router = ChannelRouter(IteratorInput(lines), ['a', 'b'])
+    await router.run()
+    assert [line async for line in router.input_for('a')] == ['hello', '#x no such channel', '//stats', '//exit']
+    assert [line async for line in router.input_for('b')] == ['hi b', '//stats', '//exit']
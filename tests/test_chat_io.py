@@ -0,0 +1,83 @@
+import asyncio
+import io
+import json
+import pytest
+from soucevi1_dist_chat.chat_io import CallbackOutput, IteratorInput, JsonlOutput, UnixSocketInput, \
+    input_from_spec, output_from_spec, prompt_text, PromptInput, StdinInput, DiscardOutput, NoInput
+from tests.fixtures import node_instance, message_instance
+
+
+@pytest.mark.asyncio
+async def test_iterator_input():
+    async def lines():
+        yield 'first'
+        yield 'second'
+
+    assert [line async for line in IteratorInput(['a', 'b'])] == ['a', 'b']
+    assert [line async for line in IteratorInput(lines())] == ['first', 'second']
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_input(tmp_path):
+    path = str(tmp_path / 'input.sock')
+    lines = UnixSocketInput(path).__aiter__()
+    first = asyncio.create_task(lines.__anext__())
+    await asyncio.sleep(0.05)
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(b'hello\nworld\n')
+    assert await asyncio.wait_for(first, 1) == 'hello'
+    assert await asyncio.wait_for(lines.__anext__(), 1) == 'world'
+    writer.close()
+    await lines.aclose()
+
+
+def test_outputs(message_instance):
+    file = io.StringIO()
+    output = JsonlOutput(file)
+    output.notice('Welcome')
+    output.message(message_instance)
+    notice, message = [json.loads(line) for line in file.getvalue().splitlines()]
+    assert notice == {'notice': 'Welcome'}
+    assert message['data'] == message_instance.message_data
+    output.close()
+    assert file.closed
+
+    received = []
+    CallbackOutput(received.append).message(message_instance)
+    CallbackOutput(received.append).notice('dropped')
+    assert received == [message_instance]
+
+
+def test_prompt_text():
+    assert prompt_text('Lojza', '127.0.0.1', 4321) == '> Lojza(127.0.0.1:4321): '
+    assert prompt_text('Lojza', '127.0.0.1', 4321, 3) == '> Lojza(127.0.0.1:4321) [3 pending]: '
+
+
+def test_specs(tmp_path):
+    assert isinstance(input_from_spec('prompt', '> '), PromptInput)
+    assert isinstance(input_from_spec('stdin', '> '), StdinInput)
+    assert isinstance(input_from_spec('none', '> '), NoInput)
+    assert input_from_spec('unix:/tmp/chat.sock', '> ').path == '/tmp/chat.sock'
+    assert isinstance(output_from_spec('discard'), DiscardOutput)
+    assert output_from_spec(f'jsonl:{tmp_path / "out.jsonl"}').file.name == str(tmp_path / 'out.jsonl')
+    with pytest.raises(ValueError):
+        input_from_spec('keyboard', '> ')
+    with pytest.raises(ValueError):
+        output_from_spec('printer')
+
+
+@pytest.mark.asyncio
+async def test_read_input(node_instance):
+    received = []
+    node_instance.input_source = IteratorInput(['Ahoj', '//stats', '//exit', 'never sent'])
+    node_instance.output = CallbackOutput(received.append, received.append)
+    sent = []
+
+    async def send(message):
+        sent.append(message.message_data)
+
+    node_instance.send_user_message = send
+    await node_instance.read_input()
+    assert sent == ['Ahoj']
+    assert node_instance.exiting
+    assert any(line.startswith('uptime') for line in received)
@@ -0,0 +1,86 @@
+import asyncio
+import json
+import logging
+import click
+import pytest
+from click.testing import CliRunner
+from soucevi1_dist_chat.chat_io import DiscardOutput, NoInput
+from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.CNode import CNode, NodeError
+from soucevi1_dist_chat.cli import cli_main, channel_role, parse_channels, parse_ports, run_nodes, setup_logging
+from soucevi1_dist_chat.message_log import MessageLog
+
+
+def test_setup_logging(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root_logger = logging.getLogger()
+    handlers, level = root_logger.handlers[:], root_logger.level
+    try:
+        listener = setup_logging('chat_4242.log', False, 'WARNING')
+        logging.info('%s: filtered', 1)
+        logging.warning('%s: written by the listener', 2)
+        logging.getLogger('node.4242').warning('not prefixed')
+        listener.stop()
+
+        listener = setup_logging('chat_4242.log', False, 'WARNING', '%(name)s %(message)s')
+        logging.getLogger('node.4242').warning('prefixed')
+        listener.stop()
+    finally:
+        root_logger.handlers, root_logger.level = handlers, level
+
+    assert (tmp_path / 'chat_4242.log').read_text() == '2: written by the listener\nnot prefixed\nnode.4242 prefixed\n'
+
+
+def test_parse_ports():
+    assert parse_ports(None, None, '30000-30002,30010') == [30000, 30001, 30002, 30010]
+    assert parse_ports(None, None, '30000') == [30000]
+    with pytest.raises(click.BadParameter):
+        parse_ports(None, None, '30000-x')
+
+
+def test_parse_channels():
+    channels = parse_channels(None, None, ('general', 'random:leader', 'music:1.2.3.4:12345'))
+    assert channels == [('general', None), ('random', 'leader'), ('music', ('1.2.3.4', '12345'))]
+    assert [channel_role(settings, False, '5.6.7.8', '5678') for _, settings in channels] == \
+        [(False, '5.6.7.8', '5678'), (True, None, None), (False, '1.2.3.4', '12345')]
+    assert channel_role(None, True, None, None) == (True, None, None)
+    for spec in [':leader', 'music:1.2.3.4', 'music:1.2.3.4:x']:
+        with pytest.raises(click.BadParameter):
+            parse_channels(None, None, (spec,))
+
+
+@pytest.mark.asyncio
+async def test_run_nodes():
+    nodes = [CNode(True, '127.0.0.1', 29100, None, None, 'n0', input_source=NoInput(), output=DiscardOutput(),
+                   heartbeat_interval=0)]
+    for port in (29101, 29102):
+        nodes.append(CNode(False, '127.0.0.1', port, '127.0.0.1', 29100, f'n{port}', input_source=NoInput(),
+                           output=DiscardOutput(), heartbeat_interval=0))
+    # Nobody listens on the neighbor port of this one, it fails alone
+    nodes.append(CNode(False, '127.0.0.1', 29103, '127.0.0.1', 29199, 'lost', input_source=NoInput(),
+                       output=DiscardOutput(), heartbeat_interval=0))
+
+    task = asyncio.create_task(run_nodes(nodes))
+    for _ in range(200):
+        if len(nodes[0].connections) == 2 and nodes[3].error is not None:
+            break
+        await asyncio.sleep(0.01)
+    assert len(nodes[0].connections) == 2
+    assert isinstance(nodes[3].error, NodeError)
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert all(node.exiting for node in nodes)
+
+
+def test_message_log_command(tmp_path):
+    log = MessageLog(str(tmp_path))
+    for time in [3, 1, 5, 4]:
+        log.append(CMessage(sender_address='1.1.1.1', sender_port=1111, sender_name='Lojza', time=time,
+                            message_type=MessageType.user_message, message_data=f'message {time}'))
+    log.close()
+
+    result = CliRunner().invoke(cli_main, ['log', str(tmp_path), '--since', '2', '--limit', '2', '-o', 'jsonl'])
+    assert result.exit_code == 0
+    assert [json.loads(line)['data'] for line in result.output.splitlines()] == ['message 3', 'message 5']
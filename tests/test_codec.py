@@ -0,0 +1,73 @@
+import pytest
+from soucevi1_dist_chat.CMessage import MessageType
+from soucevi1_dist_chat.codec import BINARY_CODEC, JSON_CODEC, choose_codec, decode_payload
+from tests.fixtures import message_instance
+
+
+def assert_same_message(a, b):
+    assert a.sender_address == b.sender_address
+    assert int(a.sender_port) == int(b.sender_port)
+    assert a.sender_name == b.sender_name
+    assert a.message_type == b.message_type
+    assert a.message_data == b.message_data
+    assert a.time == b.time
+
+
+@pytest.mark.parametrize('address', ['127.0.0.1', '::1', 'localhost'])
+def test_binary_roundtrip(message_instance, address):
+    message_instance.sender_address = address
+    payload = BINARY_CODEC.encode(message_instance)
+    assert_same_message(decode_payload(payload), message_instance)
+
+
+def test_binary_roundtrip_dict_data(message_instance):
+    message_instance.message_type = MessageType.login_message
+    message_instance.message_data = {'next_IP': '1.1.1.1', 'next_port': '11111'}
+    decoded = decode_payload(BINARY_CODEC.encode(message_instance))
+    assert decoded.message_type == MessageType.login_message.value
+    assert decoded.message_data == message_instance.message_data
+
+
+def test_binary_smaller_than_json(message_instance):
+    assert len(BINARY_CODEC.encode(message_instance)) < len(JSON_CODEC.encode(message_instance))
+
+
+def test_binary_falls_back_to_json(message_instance):
+    message_instance.sender_port = 'not a port'
+    payload = BINARY_CODEC.encode(message_instance)
+    assert payload == JSON_CODEC.encode(message_instance)
+    assert decode_payload(payload).sender_port == 'not a port'
+
+
+def test_choose_codec():
+    assert choose_codec(['binary', 'json'], ['json', 'binary']) is BINARY_CODEC
+    assert choose_codec(['binary', 'json'], ['json']) is JSON_CODEC
+    assert choose_codec(['json'], ['binary', 'json']) is JSON_CODEC
+    assert choose_codec(['binary'], []) is JSON_CODEC
+
+
+@pytest.mark.parametrize('codec', [BINARY_CODEC, JSON_CODEC])
+def test_seq_roundtrip(message_instance, codec):
+    assert decode_payload(codec.encode(message_instance)).seq is None
+    message_instance.seq = 2 ** 40
+    assert decode_payload(codec.encode(message_instance)).seq == 2 ** 40
+
+
+@pytest.mark.parametrize('codec', [BINARY_CODEC, JSON_CODEC])
+def test_channel_roundtrip(message_instance, codec):
+    assert decode_payload(codec.encode(message_instance)).channel is None
+    message_instance.seq = 7
+    message_instance.channel = 'kanál'
+    decoded = decode_payload(codec.encode(message_instance))
+    assert decoded.channel == 'kanál'
+    assert decoded.seq == 7
+    assert decoded.message_data == message_instance.message_data
+
+
+@pytest.mark.parametrize('codec', [BINARY_CODEC, JSON_CODEC])
+def test_sender_seq_roundtrip(message_instance, codec):
+    assert decode_payload(codec.encode(message_instance)).sender_seq is None
+    message_instance.sender_seq = 1700000000000000
+    message_instance.channel = 'a'
+    decoded = decode_payload(codec.encode(message_instance))
+    assert (decoded.sender_seq, decoded.seq, decoded.channel) == (1700000000000000, None, 'a')
@@ -0,0 +1,183 @@
+import asyncio
+import pytest
+from asynctest import CoroutineMock
+from unittest.mock import MagicMock
+from soucevi1_dist_chat.CConnection import CConnection, ConnectionRegistry, OverflowPolicy
+from soucevi1_dist_chat.framing import FrameDecoder, encode_frame, unpack_batches
+from tests.fixtures import connections
+
+
+def make_connection(policy, writer=None):
+    if writer is None:
+        writer = MagicMock()
+        writer.drain = CoroutineMock()
+    return CConnection('1.1.1.1', '1111', 'reader', writer, queue_size=2, policy=policy)
+
+
+@pytest.mark.asyncio
+async def test_overflow_drop_oldest():
+    conn = make_connection(OverflowPolicy.drop_oldest)
+    for frame in (b'1', b'2', b'3'):
+        assert await conn.send(frame)
+    assert [conn.queue.get_nowait(), conn.queue.get_nowait()] == [b'2', b'3']
+
+
+@pytest.mark.asyncio
+async def test_overflow_disconnect():
+    conn = make_connection(OverflowPolicy.disconnect)
+    assert await conn.send(b'1')
+    assert await conn.send(b'2')
+    assert not await conn.send(b'3')
+
+
+@pytest.mark.asyncio
+async def test_overflow_block():
+    conn = make_connection(OverflowPolicy.block)
+    await conn.send(b'1')
+    await conn.send(b'2')
+    blocked = asyncio.create_task(conn.send(b'3'))
+    await asyncio.sleep(0)
+    assert not blocked.done()
+    conn.queue.get_nowait()
+    assert await blocked
+
+
+@pytest.mark.asyncio
+async def test_offer():
+    conn = make_connection(OverflowPolicy.block)
+    assert conn.offer(b'1')
+    assert conn.offer(b'2')
+    assert not conn.offer(b'3')
+    assert conn.messages_dropped == 0
+
+
+@pytest.mark.asyncio
+async def test_sender_writes_queued_frames():
+    conn = make_connection(OverflowPolicy.block)
+    await conn.send(b'1')
+    await conn.send(b'2')
+    conn.start()
+    await asyncio.sleep(0)
+    assert [c[0][0] for c in conn.writer.write.call_args_list] == [b'1', b'2']
+    conn.writer.drain.assert_called_once()
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_sender_failure_closes_connection():
+    on_close = MagicMock()
+    writer = MagicMock()
+    writer.drain = CoroutineMock(side_effect=ConnectionResetError)
+    conn = CConnection('1.1.1.1', '1111', 'reader', writer, on_close=on_close)
+    conn.start()
+    await conn.send(b'1')
+    await asyncio.sleep(0)
+    on_close.assert_called_once_with(conn)
+
+
+def test_registry_lookups(connections):
+    registry = ConnectionRegistry(connections)
+    assert len(registry) == 2
+    assert registry.find_by_reader('reader3') is connections[1]
+    assert registry.find_by_writer(connections[0].writer) is connections[0]
+    assert registry.find_by_peer('127.0.0.1', 54321) is connections[1]
+    assert registry.find_by_peer('127.0.0.1', '1111') is None
+
+    assert registry.remove(connections[0])
+    assert not registry.remove(connections[0])
+    assert registry.find_by_reader('reader1') is None
+    assert list(registry) == connections[1:]
+
+
+def test_registry_replaces_same_peer(connections):
+    registry = ConnectionRegistry(connections)
+    newer = CConnection('1.1.1.1', 1111, 'reader5', MagicMock())
+    assert registry.add(newer) is connections[0]
+    assert registry.find_by_peer('1.1.1.1', '1111') is newer
+    assert registry.find_by_reader('reader1') is None
+    assert list(registry) == [connections[1], newer]
+
+
+def test_registry_sample():
+    connections = [CConnection('1.1.1.1', port, f'reader{port}', MagicMock()) for port in range(10)]
+    registry = ConnectionRegistry(connections)
+    for conn in connections[::2]:
+        registry.remove(conn)
+    assert sorted(registry.sampled, key=lambda conn: conn.port) == connections[1::2]
+    sample = registry.sample(3)
+    assert len(set(sample)) == 3
+    assert all(conn in registry for conn in sample)
+    assert set(registry.sample(5)) == set(connections[1::2])
+
+
+def test_registry_features(connections):
+    registry = ConnectionRegistry()
+    assert registry.supported_by_all('ring')
+    # A peer may announce the feature before it is registered
+    registry.set_feature(connections[0].key(), 'ring', True)
+    registry.add(connections[0])
+    assert registry.supported_by_all('ring')
+
+    registry.add(connections[1])
+    assert not registry.supported_by_all('ring')
+    registry.set_feature(connections[1].key(), 'ring', True)
+    registry.set_feature(connections[1].key(), 'ring', True)
+    assert registry.supported_by_all('ring')
+    assert not registry.supported_by_all('relay')
+
+    registry.set_feature(connections[0].key(), 'ring', False)
+    assert not registry.supported_by_all('ring')
+    registry.remove(connections[0])
+    assert registry.supported_by_all('ring')
+    assert registry.supports(connections[1].key(), 'ring')
+    assert not registry.supports(connections[0].key(), 'ring')
+
+
+@pytest.mark.asyncio
+async def test_counters():
+    conn = make_connection(OverflowPolicy.drop_oldest)
+    for frame in (b'1', b'22', b'333'):
+        await conn.send(frame)
+    conn.start()
+    await asyncio.sleep(0)
+    assert (conn.messages_sent, conn.bytes_sent, conn.messages_dropped) == (2, 5, 1)
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_sender_batches_burst():
+    writer = MagicMock()
+    writer.drain = CoroutineMock()
+    conn = CConnection('1.1.1.1', '1111', 'reader', writer, batch_window=0.01, batch_size=2)
+    conn.start()
+    for frame in (encode_frame(b'1'), encode_frame(b'2'), encode_frame(b'3')):
+        await conn.send(frame)
+    await asyncio.sleep(0.05)
+
+    # Two messages in one batch frame, the last one alone, all written before one drain
+    payloads = FrameDecoder().feed(b''.join(c[0][0] for c in writer.write.call_args_list))
+    payloads += FrameDecoder().feed(b''.join(b''.join(c[0][0]) for c in writer.writelines.call_args_list))
+    assert unpack_batches(payloads) == [b'1', b'2', b'3']
+    assert writer.write.call_count == 1
+    writer.drain.assert_called_once()
+    assert conn.messages_sent == 3
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_sender_flushes_full_batch():
+    writer = MagicMock()
+    writer.drain = CoroutineMock()
+    conn = CConnection('1.1.1.1', '1111', 'reader', writer, batch_window=10.0, batch_size=3)
+    conn.start()
+    await conn.send(encode_frame(b'1'))
+    await asyncio.sleep(0)
+    for frame in (encode_frame(b'2'), encode_frame(b'3')):
+        await conn.send(frame)
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.05)
+
+    # The batch is full long before the window ends
+    assert unpack_batches(FrameDecoder().feed(writer.write.call_args[0][0])) == [b'1', b'2', b'3']
+    writer.drain.assert_called_once()
+    conn.close()
@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+from asynctest import CoroutineMock
+from unittest.mock import MagicMock, patch
+from soucevi1_dist_chat.CMessage import MessageType
+from tests.fixtures import node_instance, message_instance
+
+
+@pytest.mark.asyncio
+async def test_chang_roberts(node_instance, message_instance):
+    election = node_instance.elections['chang-roberts']
+    message_instance.message_type = MessageType.election_message
+    with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
+        # Test losing node -- pass the message on
+        message_instance.message_data = {'addr': '127.0.0.1', 'port': '99999'}
+        await election.handle_message(message_instance)
+        mocked_send.assert_called_once_with(message_instance)
+        assert node_instance.voting
+
+        # Test candidate node -- it votes already, the smaller candidate is dropped
+        message_instance.message_data = {'addr': '127.0.0.1', 'port': '11111'}
+        await election.handle_message(message_instance)
+        mocked_send.assert_called_once()
+
+        # Not voting yet -- send message with this node's ID
+        node_instance.voting = False
+        await election.handle_message(message_instance)
+        assert mocked_send.call_args[0][0].message_data['id'] == node_instance.id
+
+        # Test winning node -- send Elected message
+        message_instance.message_data = {'addr': '127.0.0.1', 'port': '12345'}
+        await election.handle_message(message_instance)
+        assert node_instance.is_leader
+    node_instance.close()
+
+
+@pytest.mark.asyncio
+async def test_hirschberg_sinclair(node_instance, message_instance):
+    election = node_instance.elections['hirschberg-sinclair']
+    node_instance.leader_address, node_instance.leader_port = '3.3.3.3', 3333
+    election.send = CoroutineMock()
+    sent = election.send
+
+    def probe(port, phase=0, hops=1, direction='next', leader=('3.3.3.3', 3333)):
+        message_instance.message_type = MessageType.probe_message
+        message_instance.message_data = {'addr': '127.0.0.1', 'port': port,
+                                         'id': node_instance.node_id('127.0.0.1', port), 'phase': phase,
+                                         'hops': hops, 'dir': direction, 'leader': list(leader)}
+        return message_instance
+
+    # Smaller ID wakes the node up, it probes both directions
+    await election.handle_message(probe(11111))
+    assert [(c[0][0].message_type, c[0][0].message_data['dir']) for c in sent.call_args_list] == \
+        [(MessageType.probe_message.value, 'next'), (MessageType.probe_message.value, 'prev')]
+    assert node_instance.voting and election.phase == 0
+
+    # Bigger ID is passed on within its neighborhood and answered at its end
+    sent.reset_mock()
+    await election.handle_message(probe(22222, phase=2, hops=1))
+    assert sent.call_args[0][0].message_data['hops'] == 2
+    await election.handle_message(probe(22222, phase=2, hops=4, direction='prev'))
+    reply = sent.call_args[0][0]
+    assert (reply.message_type, reply.message_data['dir']) == (MessageType.reply_message.value, 'next')
+    assert election.phase is None
+
+    # Probe of a finished election is dropped
+    sent.reset_mock()
+    await election.handle_message(probe(22222, leader=('4.4.4.4', 4444)))
+    sent.assert_not_called()
+
+    # Replies from both directions start the next phase
+    await election.send_probes(0)
+    sent.reset_mock()
+    message_instance.message_data = dict(probe(12345).message_data, dir='prev')
+    message_instance.message_type = MessageType.reply_message
+    await election.handle_message(message_instance)
+    sent.assert_not_called()
+    await election.handle_message(message_instance)
+    assert sent.call_args[0][0].message_data['phase'] == 1
+
+    # Own probe came around the ring
+    with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
+        await election.handle_message(probe(12345, phase=1, hops=2))
+        await election.handle_message(probe(12345, phase=1, hops=2, direction='prev'))
+        assert node_instance.is_leader
+        mocked_send.assert_called_once()
+        assert mocked_send.call_args[0][0].message_type == MessageType.elected_message.value
+    node_instance.close()
+
+
+@pytest.mark.asyncio
+async def test_probe_waits_for_prev(node_instance, message_instance):
+    node_instance.leader_address, node_instance.leader_port = '3.3.3.3', 3333
+    with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()):
+        await node_instance.initiate_election()
+    assert [m.message_data['dir'] for m in node_instance.prev_backlog] == ['prev']
+
+    # The previous node connects, the probe is sent to it
+    writer = MagicMock()
+    writer.drain = CoroutineMock()
+    message_instance.message_data = {}
+    with patch('soucevi1_dist_chat.CNode.CNode.send_successors', new=CoroutineMock()):
+        await node_instance.handle_i_am_prev_message(message_instance, 'reader', writer)
+    assert b'"dir": "prev"' in writer.write.call_args[0][0]
+    assert node_instance.prev_backlog == []
+    node_instance.close()
+
+
+@pytest.mark.asyncio
+async def test_election_restarts_after_timeout(node_instance):
+    election = node_instance.election
+    election.send_probes = CoroutineMock()
+    with patch('soucevi1_dist_chat.election.ELECTION_TIMEOUT', 0.01):
+        await election.start()
+        await asyncio.sleep(0.05)
+        assert election.send_probes.call_count > 1
+
+        # The elected message ends the election
+        node_instance.connect_to_leader = CoroutineMock()
+        node_instance.send_message_to_ring = CoroutineMock()
+        message = node_instance.craft_message(MessageType.elected_message, {'addr': '3.3.3.3', 'port': 3333})
+        await node_instance.handle_elected_message(message)
+        calls = election.send_probes.call_count
+        await asyncio.sleep(0.05)
+        assert election.send_probes.call_count == calls
+        assert election.timer is None
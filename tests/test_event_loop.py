@@ -0,0 +1,39 @@
+import asyncio
+import builtins
+import pytest
+from soucevi1_dist_chat.event_loop import use_loop
+
+
+@pytest.fixture
+def restore_policy():
+    yield
+    asyncio.set_event_loop_policy(None)
+
+
+def test_use_asyncio(restore_policy):
+    assert use_loop('asyncio') == 'asyncio'
+    assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy
+
+
+def test_uvloop_fallback(restore_policy, monkeypatch):
+    real_import = builtins.__import__
+
+    def no_uvloop(name, *args, **kwargs):
+        if name == 'uvloop':
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, '__import__', no_uvloop)
+    assert use_loop('uvloop') == 'asyncio'
+    assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy
+
+
+def test_use_uvloop(restore_policy):
+    uvloop = pytest.importorskip('uvloop')
+    assert use_loop('uvloop') == 'uvloop'
+    assert isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy)
+
+
+def test_unknown_loop():
+    with pytest.raises(ValueError):
+        use_loop('tokio')
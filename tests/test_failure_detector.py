@@ -0,0 +1,44 @@
+import math
+from soucevi1_dist_chat.failure_detector import PhiAccrualDetector
+
+
+def test_phi_grows_without_heartbeats():
+    detector = PhiAccrualDetector(1.0, now=0.0)
+    for t in range(1, 11):
+        detector.heartbeat(float(t))
+    assert detector.phi(10.0) < 1
+    assert detector.phi(11.0) < detector.phi(12.0) < detector.phi(13.0)
+    assert not detector.is_suspected(8.0, 11.0)
+    assert detector.is_suspected(8.0, 15.0)
+
+
+def test_phi_adapts_to_jitter():
+    steady = PhiAccrualDetector(1.0, min_std=0.01, now=0.0)
+    jittery = PhiAccrualDetector(1.0, min_std=0.01, now=0.0)
+    t = 0.0
+    for i in range(20):
+        steady.heartbeat(i + 1.0)
+        t += 0.5 if i % 2 else 1.5
+        jittery.heartbeat(t)
+    # The same delay after the last heartbeat is more suspicious on a steady link
+    assert steady.phi(20.0 + 1.5) > jittery.phi(t + 1.5)
+
+
+def test_phi_infinite():
+    detector = PhiAccrualDetector(1.0, min_std=0.001, now=0.0)
+    assert math.isinf(detector.phi(1000.0))
+    assert detector.is_suspected(8.0, 1000.0)
+
+
+def test_burst_does_not_shrink_intervals():
+    detector = PhiAccrualDetector(1.0, now=0.0)
+    for t in range(1, 11):
+        detector.heartbeat(float(t))
+    # A burst of messages is a sign of life, not a heartbeat interval
+    for i in range(200):
+        detector.alive(10.0 + i / 1000)
+    assert len(detector.intervals) == 11
+    detector.heartbeat(11.0)
+
+    # The next heartbeat comes half an interval late
+    assert not detector.is_suspected(8.0, 12.5)
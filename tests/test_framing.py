@@ -0,0 +1,47 @@
+import asyncio
+import pytest
+from soucevi1_dist_chat.framing import FrameDecoder, FrameError, encode_frame, read_frame, HEADER, MAX_FRAME_SIZE, \
+    encode_batch, unpack_batches
+
+
+def test_decoder_multiple_frames_in_one_read():
+    decoder = FrameDecoder()
+    data = encode_frame(b'first') + encode_frame(b'') + encode_frame(b'third')
+    assert decoder.feed(data) == [b'first', b'', b'third']
+    assert decoder.pending() == 0
+
+
+def test_decoder_partial_frames():
+    decoder = FrameDecoder()
+    data = encode_frame(b'x' * 20000) + encode_frame(b'tail')
+    assert decoder.feed(data[:3]) == []
+    assert decoder.feed(data[3:15000]) == []
+    assert decoder.feed(data[15000:-2]) == [b'x' * 20000]
+    assert decoder.pending() == HEADER.size + 2
+    assert decoder.feed(data[-2:]) == [b'tail']
+
+
+def test_decoder_oversized_frame():
+    decoder = FrameDecoder()
+    with pytest.raises(FrameError):
+        decoder.feed(HEADER.pack(MAX_FRAME_SIZE + 1))
+
+
+@pytest.mark.asyncio
+async def test_read_frame():
+    reader = asyncio.StreamReader()
+    reader.feed_data(encode_frame(b'hello') + encode_frame(b'world'))
+    reader.feed_eof()
+    assert await read_frame(reader) == b'hello'
+    assert await read_frame(reader) == b'world'
+    with pytest.raises(asyncio.IncompleteReadError):
+        await read_frame(reader)
+
+
+def test_batches():
+    batch = encode_batch([encode_frame(b'{"a": 1}'), encode_frame(b'\xb1binary')])
+    payloads = FrameDecoder().feed(encode_frame(b'{"single": 0}') + batch)
+    assert unpack_batches(payloads) == [b'{"single": 0}', b'{"a": 1}', b'\xb1binary']
+
+    with pytest.raises(FrameError):
+        unpack_batches([batch[HEADER.size:-1]])
@@ -0,0 +1,59 @@
+from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.codec import BINARY_CODEC
+from soucevi1_dist_chat.history import MessageHistory, plain_copy
+
+
+def message(time, port=1111, data='Ahoj'):
+    return CMessage(sender_address='1.1.1.1', sender_port=port, sender_name='Lojza', time=time,
+                    message_type=MessageType.user_message, message_data=data, seq=time)
+
+
+def test_plain_copy():
+    original = message(3)
+    original.message_type = MessageType.ring_user_message
+    original.channel = 'a'
+    copy = plain_copy(original)
+    assert copy.message_type == MessageType.user_message.value
+    assert (copy.time, copy.seq, copy.channel, copy.message_data) == (3, 3, 'a', 'Ahoj')
+
+    # A plain user message is encoded once for the original and the copy
+    original = message(4)
+    frame = original.convert_to_frame(BINARY_CODEC)
+    copy = plain_copy(original)
+    assert copy.convert_to_frame(BINARY_CODEC) is frame
+    assert original.convert_to_frame() is copy.convert_to_frame()
+
+    # Changing the original does not change the copy
+    original.seq = 5
+    assert copy.convert_to_frame(BINARY_CODEC) is frame
+
+
+def test_since():
+    history = MessageHistory()
+    for m in [message(1), message(5, 2222), message(3), message(7)]:
+        history.add(m)
+
+    assert [m.time for m in history.since(None)] == [1, 5, 3, 7]
+    assert [m.time for m in history.since((5, '1.1.1.1', '2222'))] == [3, 7]
+    assert history.since((7, '1.1.1.1', 1111)) == []
+
+    # Unknown message: everything later in the Lamport time
+    assert [m.time for m in history.since((4, '9.9.9.9', 9999))] == [5, 7]
+
+
+def test_bounds():
+    history = MessageHistory(max_messages=3)
+    for i in range(5):
+        history.add(message(i))
+    assert [m.time for m in history.since(None)] == [2, 3, 4]
+
+    size = len(history.since(None)[0].convert_to_frame(BINARY_CODEC))
+    history = MessageHistory(max_bytes=2 * size + 1)
+    for i in range(5):
+        history.add(message(i))
+    assert len(history) == 2
+    assert history.bytes <= 2 * size + 1
+
+    history = MessageHistory(max_messages=0)
+    history.add(message(1))
+    assert len(history) == 0
@@ -1,7 +1,8 @@
 import pytest
 from asynctest import CoroutineMock
-from unittest.mock import patch
-from soucevi1_dist_chat.CMessage import MessageType
+from unittest.mock import MagicMock, patch
+from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.history import plain_copy
 from tests.fixtures import node_instance, message_instance
 
 
@@ -10,7 +11,7 @@ async def test_handle_message(node_instance, message_instance):
     # User message
     with patch('soucevi1_dist_chat.CNode.CNode.handle_user_message', new=CoroutineMock()) as mocked_handle:
         await node_instance.handle_message(message_instance, 'reader', None)
-        mocked_handle.assert_called_once_with(message_instance, 'reader')
+        mocked_handle.assert_called_once_with(message_instance, 'reader', None)
 
     # Login message
     message_instance.message_type = MessageType.login_message
@@ -22,7 +23,7 @@ async def test_handle_message(node_instance, message_instance):
     message_instance.message_type = MessageType.i_am_prev_message
     with patch('soucevi1_dist_chat.CNode.CNode.handle_i_am_prev_message', new=CoroutineMock()) as mocked_handle:
         await node_instance.handle_message(message_instance, 'reader', 'writer')
-        mocked_handle.assert_called_once_with('reader', 'writer')
+        mocked_handle.assert_called_once_with(message_instance, 'reader', 'writer')
 
     # Prev inform message
     message_instance.message_type = MessageType.prev_inform_message
@@ -30,15 +31,21 @@ async def test_handle_message(node_instance, message_instance):
         await node_instance.handle_message(message_instance, None, None)
         mocked_handle.assert_called_once_with(message_instance)
 
+    # Ring user message
+    message_instance.message_type = MessageType.ring_user_message
+    with patch('soucevi1_dist_chat.CNode.CNode.handle_ring_user_message', new=CoroutineMock()) as mocked_handle:
+        await node_instance.handle_message(message_instance, None, None)
+        mocked_handle.assert_called_once_with(message_instance)
+
     # Hello leader message
     message_instance.message_type = MessageType.hello_leader_message
     with patch('soucevi1_dist_chat.CNode.CNode.handle_hello_leader_message', new=CoroutineMock()) as mocked_handle:
-        await node_instance.handle_message(message_instance, 'reader', None)
-        mocked_handle.assert_called_once_with(message_instance, 'reader')
+        await node_instance.handle_message(message_instance, 'reader', 'writer')
+        mocked_handle.assert_called_once_with(message_instance, 'reader', 'writer')
 
     # Election message
     message_instance.message_type = MessageType.election_message
-    with patch('soucevi1_dist_chat.CNode.CNode.handle_election_message', new=CoroutineMock()) as mocked_handle:
+    with patch('soucevi1_dist_chat.election.ChangRoberts.handle_message', new=CoroutineMock()) as mocked_handle:
         await node_instance.handle_message(message_instance, None, None)
         mocked_handle.assert_called_once_with(message_instance)
 
@@ -48,6 +55,27 @@ async def test_handle_message(node_instance, message_instance):
         await node_instance.handle_message(message_instance, None, None)
         mocked_handle.assert_called_once_with(message_instance)
 
+    # Heartbeat message does not reach any handler nor the logical clock, it feeds the failure detector
+    message_instance.message_type = MessageType.heartbeat_message
+    node_instance.logical_clock = 5
+    node_instance.prev_node_writer = MagicMock()
+    await node_instance.handle_message(message_instance, 'reader', node_instance.prev_node_writer)
+    assert node_instance.logical_clock == 5
+    assert len(node_instance.prev_detector.intervals) == 2
+    message_instance.message_type = MessageType.ack_message
+    message_instance.message_data = {'seq': 0}
+    await node_instance.handle_message(message_instance, 'reader', node_instance.prev_node_writer)
+    assert len(node_instance.prev_detector.intervals) == 2
+    node_instance.prev_node_writer = None
+
+    # Message of another channel is dropped
+    message_instance.message_type = MessageType.user_message
+    message_instance.channel = 'other'
+    with patch('soucevi1_dist_chat.CNode.CNode.handle_user_message', new=CoroutineMock()) as mocked_handle:
+        await node_instance.handle_message(message_instance, 'reader', None)
+        mocked_handle.assert_not_called()
+    assert node_instance.metrics.counter('received.wrong_channel').value == 1
+
 
 @pytest.mark.asyncio
 async def test_handle_elected_message(node_instance, message_instance):
@@ -63,31 +91,13 @@ async def test_handle_elected_message(node_instance, message_instance):
             assert node_instance.leader_port == '8888'
 
 
-@pytest.mark.asyncio
-async def test_handle_election_message(node_instance, message_instance):
-    message_instance.message_type = MessageType.election_message
-    message_instance.message_data = {'addr': '127.0.0.1', 'port': '99999'}
-    with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
-        # Test losing node -- pass the message on
-        message_instance.message_data = {'addr': '127.0.0.1', 'port': '99999'}
-        await node_instance.handle_election_message(message_instance)
-        mocked_send.assert_called_once_with(message_instance)
-
-        # Test candidate node -- send message with this node's address
-        message_instance.message_data = {'addr': '127.0.0.1', 'port': '11111'}
-        await node_instance.handle_election_message(message_instance)
-        message_new = message_instance
-        message_new.message_data = {'addr': node_instance.address, 'port': node_instance.port}
-        mocked_send.assert_called_once_with(message_new)
-
-        # Test winning node -- send Elected message
-        message_instance.message_data = {'addr': '127.0.0.1', 'port': '12345'}
-        await node_instance.handle_election_message(message_instance)
-        assert node_instance.is_leader
-
-
 @pytest.mark.asyncio
 async def test_handle_prev_inform_message(node_instance, message_instance):
+    message_instance.message_data = {'new_next_IP': message_instance.sender_address,
+                                     'new_next_port': message_instance.sender_port,
+                                     'dead_IP': '3.3.3.3',
+                                     'dead_port': '3333'}
+
     # This node's next did not die
     node_instance.next_node_writer = 'writer'
     with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
@@ -96,9 +106,310 @@ async def test_handle_prev_inform_message(node_instance, message_instance):
 
     # This node's next died
     node_instance.next_node_writer = None
-    with patch('asyncio.open_connection', new=CoroutineMock()) as mocked_open:
+    with patch('soucevi1_dist_chat.CNode.CNode.open_connection', new=CoroutineMock()) as mocked_open:
         mocked_open.return_value = ('reader', 'writer')
         with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
             await node_instance.handle_prev_inform_message(message_instance)
             mocked_open.assert_called_once_with(message_instance.sender_address, message_instance.sender_port)
             mocked_send.assert_called_once()
+
+    # This node's next is the dead node, but the connection was not lost yet
+    old_writer = MagicMock()
+    old_writer.is_closing.return_value = False
+    node_instance.next_node_writer = old_writer
+    node_instance.next_node_address, node_instance.next_node_port = '3.3.3.3', 3333
+    node_instance.leader_address, node_instance.leader_port = '3.3.3.3', 3333
+    with patch('soucevi1_dist_chat.CNode.CNode.open_connection', new=CoroutineMock()) as mocked_open:
+        mocked_open.return_value = ('reader', 'writer')
+        with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()):
+            with patch('soucevi1_dist_chat.CNode.CNode.initiate_election', new=CoroutineMock()) as mocked_elect:
+                await node_instance.handle_prev_inform_message(message_instance)
+                old_writer.close.assert_called_once()
+                assert node_instance.next_node_writer == 'writer'
+                mocked_elect.assert_called_once()
+
+    # The message went around the whole ring
+    message_instance.sender_address, message_instance.sender_port = node_instance.address, node_instance.port
+    with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
+        await node_instance.handle_prev_inform_message(message_instance)
+        mocked_send.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_i_am_prev_message(node_instance, message_instance):
+    old_writer = MagicMock()
+    old_writer.is_closing.return_value = False
+    old_writer.wait_closed = CoroutineMock()
+    node_instance.prev_node_writer = old_writer
+    message_instance.message_type = MessageType.i_am_prev_message
+    message_instance.message_data = {}
+    await node_instance.handle_i_am_prev_message(message_instance, 'reader', 'writer')
+    old_writer.close.assert_called_once()
+    assert (node_instance.prev_node_reader, node_instance.prev_node_writer) == ('reader', 'writer')
+    assert (node_instance.prev_node_address, node_instance.prev_node_port) == ('127.0.0.1', '54321')
+
+    # A node connecting through its successor list replaces only the dead previous node
+    new_writer = MagicMock()
+    message_instance.sender_port = '6666'
+    message_instance.message_data = {'dead': ['9.9.9.9', 9999]}
+    await node_instance.handle_i_am_prev_message(message_instance, 'reader2', new_writer)
+    new_writer.close.assert_called_once()
+    assert node_instance.prev_node_port == '54321'
+
+    node_instance.prev_node_writer = old_writer
+    message_instance.message_data = {'dead': ['127.0.0.1', 54321]}
+    await node_instance.handle_i_am_prev_message(message_instance, 'reader3', MagicMock())
+    assert node_instance.prev_node_port == '6666'
+
+
+@pytest.mark.asyncio
+async def test_handle_successors_message(node_instance, message_instance):
+    node_instance.next_node_address, node_instance.next_node_port = '127.0.0.1', '54321'
+    node_instance.prev_node_writer = MagicMock()
+    node_instance.prev_node_address, node_instance.prev_node_port = '2.2.2.2', '2222'
+    node_instance.successor_peers.add(('2.2.2.2', '2222'))
+    node_instance.send_message_to_prev = CoroutineMock()
+    message_instance.message_type = MessageType.successors_message
+    message_instance.message_data = {'successors': [['127.0.0.1', '54321'], ['3.3.3.3', 3333],
+                                                    ['127.0.0.1', '12345'], ['4.4.4.4', 4444]]}
+
+    # The list ends before this node and the change goes on to the previous node
+    await node_instance.handle_successors_message(message_instance)
+    assert node_instance.successors == [['127.0.0.1', '54321'], ['3.3.3.3', 3333]]
+    sent = node_instance.send_message_to_prev.call_args[0][0]
+    assert sent.message_data['successors'] == [['127.0.0.1', '12345'], ['127.0.0.1', '54321'], ['3.3.3.3', 3333]]
+
+    # The same list is not sent again
+    await node_instance.handle_successors_message(message_instance)
+    node_instance.send_message_to_prev.assert_called_once()
+
+    # Lists from other nodes than the next one are ignored
+    message_instance.sender_port = '7777'
+    message_instance.message_data = {'successors': [['127.0.0.1', '7777']]}
+    await node_instance.handle_successors_message(message_instance)
+    assert node_instance.successors == [['127.0.0.1', '54321'], ['3.3.3.3', 3333]]
+
+
+@pytest.mark.asyncio
+async def test_handle_capabilities_message(node_instance, message_instance):
+    writer = MagicMock()
+    writer.drain = CoroutineMock()
+    message_instance.message_type = MessageType.capabilities_message
+    message_instance.message_data = {'codecs': ['binary', 'json'], 'batch': True, 'ring': True}
+    await node_instance.handle_capabilities_message(message_instance, writer)
+    assert node_instance.codec_for(message_instance.sender_address, int(message_instance.sender_port)).name == 'binary'
+    assert ('127.0.0.1', '54321') in node_instance.batch_peers
+    assert node_instance.connections.supports(('127.0.0.1', '54321'), 'ring')
+    writer.write.assert_called_once()
+
+    # Answer to this node's announcement is not answered again
+    writer.reset_mock()
+    message_instance.message_data = {'codecs': ['json'], 'answer': True}
+    await node_instance.handle_capabilities_message(message_instance, writer)
+    assert node_instance.codec_for(message_instance.sender_address, message_instance.sender_port).name == 'json'
+    assert not node_instance.batch_peers
+    assert not node_instance.connections.supports(('127.0.0.1', '54321'), 'ring')
+    writer.write.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_ring_user_message(node_instance, message_instance):
+    message_instance.message_type = MessageType.ring_user_message
+    message_instance.seq = 3
+    node_instance.print_user_message = MagicMock()
+    with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
+        # Relayed and displayed
+        await node_instance.handle_ring_user_message(message_instance)
+        mocked_send.assert_called_once_with(message_instance, keep=True)
+        node_instance.print_user_message.assert_called_once_with(message_instance)
+
+        # The same message going around again is dropped
+        await node_instance.handle_ring_user_message(message_instance)
+        mocked_send.assert_called_once()
+
+        # Own message is relayed, but not displayed
+        message_instance.seq = 4
+        message_instance.sender_address, message_instance.sender_port = node_instance.address, node_instance.port
+        await node_instance.handle_ring_user_message(message_instance)
+        assert mocked_send.call_count == 2
+        node_instance.print_user_message.assert_called_once()
+
+        # The leader ends the round
+        message_instance.seq = 5
+        node_instance.is_leader = True
+        await node_instance.handle_ring_user_message(message_instance)
+        assert mocked_send.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_relay_ring_message_without_next(node_instance, message_instance):
+    message_instance.message_type = MessageType.ring_user_message
+    message_instance.seq = 3
+    node_instance.output = MagicMock()
+    node_instance.next_node_writer = None
+    await node_instance.handle_message(message_instance, 'reader', 'writer')
+    node_instance.output.message.assert_called_once()
+    assert node_instance.next_backlog == [message_instance]
+
+    # Other messages are dropped
+    await node_instance.send_message_to_ring(MagicMock())
+    assert node_instance.metrics.counter('dropped.ring').value == 1
+
+    # The ring is renewed, the kept message goes to the new next node
+    writer = MagicMock()
+    writer.drain = CoroutineMock()
+    await node_instance.attach_next('3.3.3.3', 3333, 'reader', writer)
+    assert writer.write.call_count == 2
+    assert node_instance.next_backlog == []
+
+    # A connection broken while sending
+    writer.drain = CoroutineMock(side_effect=BrokenPipeError)
+    await node_instance.send_message_to_ring(message_instance)
+    assert node_instance.metrics.counter('dropped.ring').value == 2
+
+
+@pytest.mark.asyncio
+async def test_handle_gossip_message(node_instance, message_instance):
+    message_instance.message_type = MessageType.gossip_message
+    message_instance.seq = 7
+    node_instance.print_user_message = MagicMock()
+    with patch('soucevi1_dist_chat.CNode.CNode.push_gossip', new=CoroutineMock()) as mocked_push:
+        await node_instance.handle_gossip_message(message_instance)
+        mocked_push.assert_called_once_with(message_instance)
+        node_instance.print_user_message.assert_called_once_with(message_instance)
+        assert ('127.0.0.1', '54321') in node_instance.view
+
+        # Duplicates are neither pushed nor displayed
+        await node_instance.handle_gossip_message(message_instance)
+        mocked_push.assert_called_once()
+        node_instance.print_user_message.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_handle_membership_message(node_instance, message_instance):
+    message_instance.message_type = MessageType.membership_message
+    message_instance.message_data = {'peers': [['1.1.1.1', 1111], [node_instance.address, node_instance.port]]}
+    await node_instance.handle_message(message_instance, None, None)
+    assert node_instance.view == [('1.1.1.1', '1111')]
+
+
+@pytest.mark.asyncio
+async def test_handle_relay_messages(node_instance, message_instance):
+    message_instance.message_type = MessageType.relay_assign_message
+    message_instance.message_data = {'block': [['1.1.1.1', 1111], ['127.0.0.1', '54321']]}
+    await node_instance.handle_message(message_instance, None, None)
+    assert node_instance.relay_block == [('1.1.1.1', '1111'), ('127.0.0.1', '54321')]
+
+    # The author of the message (127.0.0.1:54321) does not get it back
+    conn = MagicMock()
+    conn.send = CoroutineMock(return_value=True)
+    node_instance.print_user_message = MagicMock()
+    message_instance.message_type = MessageType.relay_user_message
+    message_instance.message_data = 'Ahoj'
+    with patch('soucevi1_dist_chat.CNode.CNode.peer_connection', new=CoroutineMock()) as mocked_connection:
+        mocked_connection.return_value = conn
+        await node_instance.handle_message(message_instance, None, None)
+        mocked_connection.assert_called_once_with('1.1.1.1', '1111')
+    conn.send.assert_called_once()
+    assert message_instance.message_type == MessageType.user_message.value
+    node_instance.print_user_message.assert_called_once_with(message_instance)
+
+
+@pytest.mark.asyncio
+async def test_handle_hello_leader_message_replays_history(node_instance, message_instance):
+    node_instance.is_leader = True
+    node_instance.print_user_message = MagicMock()
+    for i, (address, port) in enumerate([('1.1.1.1', 1111), ('127.0.0.1', '54321'), ('1.1.1.1', 1111)]):
+        node_instance.history.add(CMessage(sender_address=address, sender_port=port, sender_name='Pepa', time=i + 1,
+                                           message_type=MessageType.user_message, message_data=f'message {i}'))
+
+    conn = MagicMock()
+    conn.addr, conn.port = message_instance.sender_address, message_instance.sender_port
+    conn.send = CoroutineMock(return_value=True)
+    node_instance.add_connection_record = MagicMock()
+    node_instance.connections.find_by_peer = MagicMock(return_value=conn)
+    node_instance.broadcast = CoroutineMock()
+
+    # The node saw the first message, its own one is left out
+    message_instance.message_type = MessageType.hello_leader_message
+    message_instance.message_data = {'last_seen': [1, '1.1.1.1', '1111']}
+    await node_instance.handle_message(message_instance, 'reader', 'writer')
+    assert conn.send.call_count == 1
+    assert b'message 2' in conn.send.call_args[0][0]
+    assert node_instance.metrics.counter('history.replayed').value == 1
+
+    # Nodes not sending the last seen message get no history
+    conn.send.reset_mock()
+    message_instance.message_data = {}
+    node_instance.find_in_connections = MagicMock(return_value=False)
+    await node_instance.handle_message(message_instance, 'reader', 'writer')
+    conn.send.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_numbered_user_message(node_instance, message_instance):
+    node_instance.is_leader = True
+    node_instance.print_user_message = MagicMock()
+    node_instance.broadcast = CoroutineMock()
+    conn = MagicMock()
+    conn.addr, conn.port = message_instance.sender_address, message_instance.sender_port
+    conn.send = CoroutineMock(return_value=True)
+    node_instance.connections.find_by_reader = MagicMock(return_value=conn)
+
+    message_instance.sender_seq = 7
+    await node_instance.handle_message(message_instance, 'reader', 'writer')
+    node_instance.broadcast.assert_called_once_with(message_instance)
+    assert b'"seq": 7' in conn.send.call_args[0][0]
+
+    # The broadcast message is remembered, the same message sent again is only acknowledged
+    node_instance.keep_message(message_instance)
+    node_instance.broadcast.reset_mock()
+    conn.send.reset_mock()
+    await node_instance.handle_message(message_instance, 'reader', 'writer')
+    node_instance.broadcast.assert_not_called()
+    conn.send.assert_called_once()
+    assert node_instance.metrics.counter('received.duplicates').value == 1
+
+
+@pytest.mark.asyncio
+async def test_non_leader_drops_rebroadcast_message(node_instance, message_instance):
+    node_instance.output = MagicMock()
+    node_instance.send_message_to_ring = CoroutineMock()
+    message_instance.sender_seq = 7
+    await node_instance.handle_message(message_instance, 'old leader reader', 'writer')
+
+    # The new leader broadcasts the retransmitted message again, along the ring this time
+    again = plain_copy(message_instance)
+    again.message_type, again.seq = MessageType.ring_user_message, 1
+    await node_instance.handle_message(again, 'new leader reader', 'writer')
+    node_instance.output.message.assert_called_once_with(message_instance)
+    assert node_instance.metrics.counter('received.duplicates').value == 1
+
+    later = plain_copy(message_instance)
+    later.sender_seq = 8
+    await node_instance.handle_message(later, 'new leader reader', 'writer')
+    assert node_instance.output.message.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_gossip_out_of_order(node_instance, message_instance):
+    node_instance.output = MagicMock()
+    node_instance.push_gossip = CoroutineMock()
+    for seq, sender_seq in [(2, 8), (1, 7), (3, 7)]:
+        message = plain_copy(message_instance)
+        message.message_type, message.seq, message.sender_seq = MessageType.gossip_message, seq, sender_seq
+        await node_instance.handle_message(message, 'reader', 'writer')
+
+    # Message 8 came before 7, both are displayed, 7 sent again by a new leader is not
+    assert [c[0][0].sender_seq for c in node_instance.output.message.call_args_list] == [8, 7]
+
+
+@pytest.mark.asyncio
+async def test_handle_ack_message(node_instance, message_instance):
+    node_instance.unacked = {5: 'five', 6: 'six', 8: 'eight'}
+    node_instance.keep_message = MagicMock()
+    message_instance.message_type = MessageType.ack_message
+    message_instance.message_data = {'seq': 6}
+    await node_instance.handle_message(message_instance, None, None)
+    assert list(node_instance.unacked) == [8]
+    assert [c[0][0] for c in node_instance.keep_message.call_args_list] == ['five', 'six']
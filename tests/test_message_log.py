@@ -0,0 +1,128 @@
+import asyncio
+import os
+import pytest
+from unittest.mock import patch
+from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.codec import BINARY_CODEC, decode_payload
+from soucevi1_dist_chat.framing import HEADER
+from soucevi1_dist_chat.message_log import MessageLog
+
+
+def message(time):
+    return CMessage(sender_address='1.1.1.1', sender_port=1111, sender_name='Lojza', time=time,
+                    message_type=MessageType.user_message, message_data=f'message {time}')
+
+
+def times(records):
+    return [time for time, _ in records]
+
+
+def test_append_and_read(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=150, index_bytes=60)
+    order = [1, 5, 3, 7, 6, 10, 8, 12, 11, 15, 20, 18]
+    for time in order:
+        log.append(message(time))
+
+    assert len(log.segments) > 2
+    assert times(log.since(None)) == order
+    assert times(log.since(7)) == [10, 8, 12, 11, 15, 20, 18]
+    assert times(log.since(20)) == []
+    assert times(log.tail(3)) == [15, 20, 18]
+    assert times(log.tail(100)) == order
+
+    # The frames are sent over the network as they are
+    _, frame = log.tail(1)[0]
+    decoded = decode_payload(frame[HEADER.size:])
+    assert (decoded.time, decoded.message_data) == (18, 'message 18')
+    log.close()
+
+
+def test_append_cached_frame(tmp_path):
+    log = MessageLog(str(tmp_path))
+    m = message(1)
+    frame = m.convert_to_frame(BINARY_CODEC)
+    with patch.object(BINARY_CODEC, 'encode') as encode:
+        log.append(m)
+    encode.assert_not_called()
+    assert log.tail(1)[0] == (1, frame)
+    log.close()
+
+
+def test_reopen(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=150, index_bytes=60)
+    for time in range(1, 11):
+        log.append(message(time))
+    log.close()
+
+    # A record cut off by a crash is dropped
+    last = sorted(name for name in os.listdir(str(tmp_path)) if name.endswith('.log'))[-1]
+    with open(os.path.join(str(tmp_path), last), 'ab') as file:
+        file.write(b'\x00\x00\x00\x00\x00\x00\x00\x0b\x00\x00\x01')
+
+    log = MessageLog(str(tmp_path), segment_bytes=150, index_bytes=60)
+    assert log.max_time == 10
+    log.append(message(11))
+    assert times(log.since(8)) == [9, 10, 11]
+    assert times(log.since(None)) == list(range(1, 12))
+    log.close()
+
+
+def test_readonly(tmp_path):
+    directory = str(tmp_path / 'log')
+    with pytest.raises(FileNotFoundError):
+        MessageLog(directory, readonly=True)
+
+    log = MessageLog(directory, index_bytes=60)
+    for time in range(1, 6):
+        log.append(message(time))
+    log.flush()
+    files = {name: os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)}
+
+    # The writer is in the middle of a record, the reader stops before it and changes nothing
+    log.file.write(b'\x00\x00\x00\x00\x00\x00\x00\x06\x00\x00')
+    files[os.path.basename(log.active.path)] += 10
+    reader = MessageLog(directory, readonly=True)
+    assert times(reader.since(None)) == [1, 2, 3, 4, 5]
+    assert times(reader.tail(2)) == [4, 5]
+    reader.close()
+    assert {name: os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)} == files
+    with pytest.raises(ValueError):
+        reader.append(message(6))
+    log.close()
+
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+    assert list(MessageLog(str(empty), readonly=True).since(None)) == []
+    assert not os.listdir(str(empty))
+
+
+@pytest.mark.asyncio
+async def test_background_flush(tmp_path):
+    log = MessageLog(str(tmp_path), flush_interval=0.01, fsync='batch')
+    task = asyncio.create_task(log.run())
+    log.append(message(1))
+    assert log.active.size == 0
+    await asyncio.sleep(0.1)
+    assert log.active.size > 0
+    assert not log.dirty
+    task.cancel()
+    log.close()
+
+    # The segment filled up by the appends is forced to the disk in a thread
+    log = MessageLog(str(tmp_path), segment_bytes=150, fsync='batch')
+    with patch('soucevi1_dist_chat.message_log.sync_descriptors') as mocked_sync:
+        loop = asyncio.get_running_loop()
+        with patch.object(loop, 'run_in_executor') as mocked_executor:
+            for time in range(2, 6):
+                log.append(message(time))
+            assert mocked_executor.call_args[0][:2] == (None, mocked_sync)
+            mocked_sync.assert_not_called()
+        log.close()
+        mocked_sync.assert_called_once()
+    calls = [call[0][2] for call in mocked_executor.call_args_list] + [mocked_sync.call_args[0][0]]
+    for descriptors in calls:
+        for descriptor in descriptors:
+            os.close(descriptor)
+
+    with pytest.raises(ValueError):
+        MessageLog(str(tmp_path), fsync='sometimes')
@@ -1,5 +1,7 @@
 import pytest
 from soucevi1_dist_chat.CMessage import CMessage, MessageType
+from soucevi1_dist_chat.codec import BINARY_CODEC, decode_payload
+from soucevi1_dist_chat.framing import HEADER, encode_frame
 
 
 @pytest.fixture
@@ -56,3 +58,22 @@ def test_convert_to_string(message_instance):
     from_cmessage = message_instance.convert_to_string()
     assert string == from_cmessage
 
+
+def test_frame_is_encoded_once(message_instance):
+    frame = message_instance.convert_to_frame()
+    assert message_instance.convert_to_frame() is frame
+    message_instance.message_data = 'Nazdar'
+    assert message_instance.convert_to_frame() is not frame
+    assert b'Nazdar' in message_instance.convert_to_frame()
+
+
+def test_received_payload_is_forwarded_raw(message_instance):
+    payload = BINARY_CODEC.encode(message_instance)
+    received = decode_payload(payload)
+    assert received.convert_to_frame(BINARY_CODEC) == encode_frame(payload)
+    assert received.raw is payload
+
+    # Changed message must be encoded again
+    received.time = 79
+    assert received.raw is None
+    assert decode_payload(received.convert_to_frame(BINARY_CODEC)[HEADER.size:]).time == 79
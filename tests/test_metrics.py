@@ -0,0 +1,28 @@
+import json
+from soucevi1_dist_chat.metrics import Histogram, MetricsRegistry
+
+
+def test_histogram():
+    histogram = Histogram((0.001, 0.01, 0.1))
+    for value in (0.0005, 0.0005, 0.005, 0.05, 3.0):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.quantile(0.4) == 0.001
+    assert histogram.quantile(0.6) == 0.01
+    assert histogram.quantile(1.0) == 3.0
+    assert histogram.snapshot()['max'] == 3.0
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_registry():
+    registry = MetricsRegistry()
+    registry.counter('received.user_message').inc()
+    registry.counter('received.user_message').inc(2)
+    registry.gauge('connections').set(4)
+    registry.histogram('distribute').observe(0.002)
+
+    snapshot = json.loads(registry.to_json())
+    assert snapshot['received.user_message'] == 3
+    assert snapshot['connections'] == 4
+    assert snapshot['distribute']['count'] == 1
+    assert len(registry.format()) == 4
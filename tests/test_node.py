@@ -1,54 +1,38 @@
+import json
 import pytest
 import asyncio
 import pytest_asyncio
 from asynctest import CoroutineMock
-from unittest.mock import patch
-from tests.fixtures import node_instance, message_instance
+from unittest.mock import MagicMock, patch
+from soucevi1_dist_chat.CConnection import CConnection, ConnectionRegistry
+from soucevi1_dist_chat.CMessage import MessageType
+from tests.fixtures import node_instance, message_instance, connections
 
 
 @pytest.mark.asyncio
-async def test_add_connection_record(node_instance, message_instance):
-    node_instance.connections = [{'addr': '1.1.1.1', 'port': '1111', 'reader': 'reader1', 'writer': 'writer1'}]
-    with patch('asyncio.open_connection', new=CoroutineMock()) as mocked_open:
-        mocked_open.return_value = 'reader2', 'writer2'
-        await node_instance.add_connection_record(message_instance, 'reader3')
-        assert node_instance.connections == [{'addr': '1.1.1.1', 'port': '1111',
-                                              'reader': 'reader1', 'writer': 'writer1'},
-                                             {'addr': '127.0.0.1', 'port': '54321',
-                                              'reader': 'reader3', 'writer': 'writer2'}]
+async def test_add_connection_record(node_instance, message_instance, connections):
+    node_instance.connections = ConnectionRegistry(connections[:1])
+    writer = MagicMock()
+    node_instance.add_connection_record(message_instance, 'reader3', writer)
+    assert len(node_instance.connections) == 2
+    conn = node_instance.connections.find_by_reader('reader3')
+    assert (conn.addr, conn.port, conn.reader, conn.writer) == ('127.0.0.1', '54321', 'reader3', writer)
+    conn.close()
 
 
-def test_remove_from_connections(node_instance):
-    node_instance.connections = [{'addr': '1.1.1.1', 'port': '1111', 'reader': 'reader1', 'writer': 'writer1'},
-                                 {'addr': '127.0.0.1', 'port': '54321', 'reader': 'reader3', 'writer': 'writer2'}]
+def test_remove_from_connections(node_instance, connections):
+    node_instance.connections = ConnectionRegistry(connections)
     node_instance.remove_from_connections('reader3665', 'writer634566')
-    assert node_instance.connections == [{'addr': '1.1.1.1',
-                                          'port': '1111',
-                                          'reader': 'reader1',
-                                          'writer': 'writer1'},
-                                         {'addr': '127.0.0.1',
-                                          'port': '54321',
-                                          'reader': 'reader3',
-                                          'writer': 'writer2'}]
+    assert list(node_instance.connections) == connections
     node_instance.remove_from_connections('reader1', 'writer634566')
-    assert node_instance.connections == [{'addr': '1.1.1.1',
-                                          'port': '1111',
-                                          'reader': 'reader1',
-                                          'writer': 'writer1'},
-                                         {'addr': '127.0.0.1',
-                                          'port': '54321',
-                                          'reader': 'reader3',
-                                          'writer': 'writer2'}]
-    node_instance.remove_from_connections('reader1', 'writer1')
-    assert node_instance.connections == [{'addr': '127.0.0.1',
-                                          'port': '54321',
-                                          'reader': 'reader3',
-                                          'writer': 'writer2'}]
-
-
-def test_find_in_connections(node_instance):
-    node_instance.connections = [{'addr': '1.1.1.1', 'port': '1111', 'reader': 'reader1', 'writer': 'writer1'},
-                                 {'addr': '127.0.0.1', 'port': '54321', 'reader': 'reader3', 'writer': 'writer2'}]
+    assert list(node_instance.connections) == connections
+    node_instance.remove_from_connections('reader1', connections[0].writer)
+    assert list(node_instance.connections) == connections[1:]
+    connections[0].writer.close.assert_called_once()
+
+
+def test_find_in_connections(node_instance, connections):
+    node_instance.connections = ConnectionRegistry(connections)
     assert node_instance.find_in_connections('reader3')
     assert not node_instance.find_in_connections('reader256')
 
@@ -65,12 +49,60 @@ async def test_wait_for_connection(node_instance):
 async def test_connect_to_leader(node_instance):
     node_instance.leader_address = '1.2.3.4'
     node_instance.leader_port = '12345'
-    with patch('asyncio.open_connection', new=CoroutineMock()) as mocked_open:
+    with patch('soucevi1_dist_chat.CNode.CNode.open_connection', new=CoroutineMock()) as mocked_open:
         mocked_open.return_value = ('reader', 'writer')
         with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_leader', new=CoroutineMock()) as mocked_send:
-            await node_instance.connect_to_leader()
-            mocked_open.assert_called_once_with(node_instance.leader_address, node_instance.leader_port)
-            mocked_send.assert_called_once()
+            with patch('soucevi1_dist_chat.CNode.CNode.read_leader', new=CoroutineMock()) as mocked_read:
+                await node_instance.connect_to_leader()
+                await node_instance.leader_task
+                mocked_open.assert_called_once_with(node_instance.leader_address, node_instance.leader_port)
+                mocked_send.assert_called_once()
+                mocked_read.assert_called_once_with('reader', 'writer')
+
+
+@pytest.mark.asyncio
+async def test_reconnect_suspected_leader(node_instance):
+    node_instance.leader_address, node_instance.leader_port = '1.2.3.4', '12345'
+    node_instance.heartbeat_interval = 0.01
+    old_writer = MagicMock()
+    node_instance.leader_writer = old_writer
+    node_instance.leader_detector.is_suspected = MagicMock(return_value=True)
+    with patch('soucevi1_dist_chat.CNode.CNode.open_connection', new=CoroutineMock()) as mocked_open:
+        mocked_open.return_value = ('reader', MagicMock())
+        with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_leader', new=CoroutineMock()) as mocked_send:
+            with patch('soucevi1_dist_chat.CNode.CNode.read_leader', new=CoroutineMock()):
+                heartbeat = asyncio.create_task(node_instance.run_heartbeat())
+                await asyncio.sleep(0.05)
+                heartbeat.cancel()
+
+                # The old connection is closed and a new one opened, the node says hello again
+                old_writer.close.assert_called_once()
+                mocked_open.assert_called_with('1.2.3.4', '12345')
+                assert mocked_send.call_args[0][0].message_type == MessageType.hello_leader_message.value
+                assert node_instance.leader_writer is not None
+
+        # The leader is dead indeed, the node waits for the election instead of failing
+        node_instance.leader_writer = None
+        mocked_open.side_effect = ConnectionRefusedError
+        await node_instance.reconnect_to_leader()
+        assert node_instance.leader_writer is None
+        assert node_instance.error is None
+    node_instance.close()
+
+
+@pytest.mark.asyncio
+async def test_read_leader(node_instance, message_instance):
+    reader = asyncio.StreamReader()
+    reader.feed_data(message_instance.convert_to_frame() + message_instance.convert_to_frame())
+    reader.feed_eof()
+    writer = MagicMock()
+    node_instance.leader_reader, node_instance.leader_writer = reader, writer
+    with patch('soucevi1_dist_chat.CNode.CNode.handle_message', new=CoroutineMock()) as mocked_handle:
+        await node_instance.read_leader(reader, writer)
+        assert mocked_handle.call_count == 2
+        assert mocked_handle.call_args[0][0].message_data == message_instance.message_data
+    writer.close.assert_called_once()
+    assert node_instance.leader_writer is None
 
 
 @pytest.mark.asyncio
@@ -82,11 +114,11 @@ async def test_join_the_ring(node_instance, message_instance):
     node_instance.next_node_reader = asyncio.StreamReader()
     node_instance.next_node_writer = asyncio.StreamWriter(None, None, None, None)
     with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
-        with patch('asyncio.StreamReader.read', new=CoroutineMock()) as mocked_read:
+        with patch('soucevi1_dist_chat.CNode.read_frame', new=CoroutineMock()) as mocked_read:
             mocked_read.return_value = message_instance.convert_to_string().encode()
             with patch('asyncio.StreamWriter.wait_closed', new=CoroutineMock()) as mocked_closed:
                 with patch('asyncio.StreamWriter.close') as mocked_close:
-                    with patch('asyncio.open_connection', new=CoroutineMock()) as mocked_open:
+                    with patch('soucevi1_dist_chat.CNode.CNode.open_connection', new=CoroutineMock()) as mocked_open:
                         mocked_open.return_value = ('reader', 'writer')
                         with patch('soucevi1_dist_chat.CNode.CNode.connect_to_leader',
                                    new=CoroutineMock()) as mocked_connect:
@@ -107,6 +139,17 @@ def test_logical_clock(node_instance):
     assert node_instance.logical_clock == 26
 
 
+def test_node_id(node_instance):
+    assert node_instance.node_id('127.0.0.1', '4321') == 0x7f000001 << 16 | 4321
+    assert node_instance.node_id('10.0.0.10', 9000) > node_instance.node_id('10.0.0.9', 80)
+    assert node_instance.id == node_instance.node_id('127.0.0.1', 12345)
+    node_instance.channel = 'a'
+    first = node_instance.node_id('127.0.0.1', '4321')
+    node_instance.channel = 'b'
+    assert node_instance.node_id('127.0.0.1', '4321') not in (first, 0x7f000001 << 16 | 4321)
+    assert node_instance.craft_message(MessageType.user_message, 'Ahoj').channel == 'b'
+
+
 def test_craft_message(node_instance, message_instance):
     message_instance.sender_address = node_instance.address
     message_instance.sender_port = node_instance.port
@@ -124,6 +167,7 @@ def test_craft_message(node_instance, message_instance):
 async def test_send_user_message(node_instance, message_instance):
     with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_leader', new=CoroutineMock()) as mocked_send:
         node_instance.is_leader = False
+        node_instance.leader_writer = MagicMock()
         await node_instance.send_user_message(message_instance)
         mocked_send.assert_called_once_with(message_instance)
     with patch('soucevi1_dist_chat.CNode.CNode.distribute_message', new=CoroutineMock()) as mocked_distribute:
@@ -138,7 +182,7 @@ async def test_send_message_to_ring(node_instance, message_instance):
     with patch('asyncio.StreamWriter.drain', new=CoroutineMock()) as mocked_drain:
         with patch('asyncio.StreamWriter.write') as mocked_write:
             await node_instance.send_message_to_ring(message_instance)
-            mocked_write.assert_called_once_with(message_instance.convert_to_string().encode())
+            mocked_write.assert_called_once_with(message_instance.convert_to_frame())
             mocked_drain.assert_called_once()
 
 
@@ -148,7 +192,7 @@ async def test_send_message_to_leader(node_instance, message_instance):
     with patch('asyncio.StreamWriter.drain', new=CoroutineMock()) as mocked_drain:
         with patch('asyncio.StreamWriter.write') as mocked_write:
             await node_instance.send_message_to_leader(message_instance)
-            mocked_write.assert_called_once_with(message_instance.convert_to_string().encode())
+            mocked_write.assert_called_once_with(message_instance.convert_to_frame())
             mocked_drain.assert_called_once()
 
 
@@ -159,3 +203,300 @@ async def test_initiate_election(node_instance):
         a, k = mocked_send.call_args
         assert a[0].message_data['addr'] == node_instance.address
         assert a[0].message_data['port'] == node_instance.port
+        assert a[0].message_type == MessageType.probe_message.value
+
+        node_instance.election = node_instance.elections['chang-roberts']
+        await node_instance.initiate_election()
+        a, k = mocked_send.call_args
+        assert a[0].message_type == MessageType.election_message.value
+        assert a[0].message_data['id'] == node_instance.id
+    node_instance.close()
+
+
+@pytest.mark.asyncio
+async def test_distribute_message(node_instance, message_instance, connections):
+    connections.append(CConnection('2.2.2.2', '2222', 'reader4', MagicMock()))
+    node_instance.connections = ConnectionRegistry(connections)
+    await node_instance.distribute_message(message_instance)
+
+    # The sender does not get its own message, the others get the very same frame
+    assert connections[1].queue.empty()
+    frame = connections[0].queue.get_nowait()
+    assert frame == message_instance.convert_to_frame()
+    assert connections[2].queue.get_nowait() is frame
+
+
+@pytest.mark.asyncio
+async def test_state_events(node_instance):
+    assert not node_instance.next_attached.is_set()
+    waiter = asyncio.create_task(node_instance.wait_for_connection())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    node_instance.next_node_reader, node_instance.next_node_writer = 'reader', 'writer'
+    await asyncio.wait_for(waiter, 1)
+
+    node_instance.next_node_reader = None
+    assert not node_instance.next_attached.is_set()
+    node_instance.prev_node_writer = 'writer'
+    assert node_instance.prev_attached.is_set()
+    node_instance.leader_writer = 'writer'
+    assert node_instance.leader_attached.is_set()
+
+
+@pytest.mark.asyncio
+async def test_handle_next_lost(node_instance):
+    writer = MagicMock()
+    writer.is_closing.return_value = False
+    node_instance.next_node_reader, node_instance.next_node_writer = 'reader', writer
+    node_instance.next_node_address, node_instance.next_node_port = '1.1.1.1', '1111'
+    node_instance.leader_address, node_instance.leader_port = '1.1.1.1', '1111'
+    await node_instance.handle_next_lost()
+    writer.close.assert_called_once()
+    assert node_instance.next_node_writer is None
+    assert not node_instance.next_attached.is_set()
+    assert node_instance.initiate
+
+
+@pytest.mark.asyncio
+async def test_connect_to_successor(node_instance):
+    node_instance.successors = [['1.1.1.1', 1111], ['2.2.2.2', 2222], ['3.3.3.3', 3333]]
+    node_instance.initiate = True
+    writer = MagicMock()
+
+    async def open_connection(address, port):
+        if port == 2222:
+            raise ConnectionRefusedError()
+        return 'reader', writer
+
+    node_instance.open_connection = open_connection
+    with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
+        with patch('soucevi1_dist_chat.CNode.CNode.initiate_election', new=CoroutineMock()) as mocked_elect:
+            await node_instance.connect_to_successor(('1.1.1.1', 1111))
+            assert (node_instance.next_node_address, node_instance.next_node_port) == ('3.3.3.3', 3333)
+            assert node_instance.next_node_writer is writer
+            assert mocked_send.call_args[0][0].message_data == {'dead': ['1.1.1.1', 1111]}
+            mocked_elect.assert_called_once()
+            assert not node_instance.initiate
+    assert node_instance.successors == [['3.3.3.3', 3333]]
+    assert node_instance.metrics.counter('ring.successor_repairs').value == 1
+
+
+@pytest.mark.asyncio
+async def test_handle_prev_lost(node_instance):
+    node_instance.prev_node_reader, node_instance.prev_node_writer = 'reader', MagicMock()
+    node_instance.prev_node_address, node_instance.prev_node_port = '2.2.2.2', '2222'
+    node_instance.next_node_writer = 'writer'
+    with patch('soucevi1_dist_chat.CNode.CNode.send_prev_inform_message', new=CoroutineMock()) as mocked_send:
+        await node_instance.handle_prev_lost()
+        mocked_send.assert_called_once_with(('2.2.2.2', '2222'))
+        assert node_instance.prev_node_writer is None
+
+    # The node before the dead one connects through its successor list in time
+    node_instance.prev_node_reader, node_instance.prev_node_writer = 'reader', MagicMock()
+    node_instance.prev_node_address, node_instance.prev_node_port = '2.2.2.2', '2222'
+    node_instance.successor_peers.add(('2.2.2.2', '2222'))
+    with patch('soucevi1_dist_chat.CNode.CNode.send_prev_inform_message', new=CoroutineMock()) as mocked_send:
+        await node_instance.handle_prev_lost()
+        node_instance.prev_node_writer = MagicMock()
+        await node_instance.tasks[-1]
+        mocked_send.assert_not_called()
+
+    # Nobody else is left in the ring
+    node_instance.next_node_writer = None
+    await node_instance.handle_prev_lost()
+    assert node_instance.is_leader
+    assert (node_instance.leader_address, node_instance.leader_port) == (node_instance.address, node_instance.port)
+
+
+@pytest.mark.asyncio
+async def test_metrics(node_instance, message_instance, connections):
+    node_instance.connections = ConnectionRegistry(connections)
+    await node_instance.distribute_message(message_instance)
+    with patch('soucevi1_dist_chat.CNode.CNode.handle_user_message', new=CoroutineMock()):
+        await node_instance.handle_message(message_instance, 'reader', 'writer')
+
+    snapshot = node_instance.collect_metrics().snapshot()
+    assert snapshot['distributed'] == 1
+    assert snapshot['distribute']['count'] == 1
+    assert snapshot['received.user_message'] == 1
+    assert snapshot['handle.user_message']['count'] == 1
+    assert snapshot['leader.connections'] == 2
+    assert snapshot['leader.queue_depth'] == 1
+
+    writer = MagicMock()
+    writer.drain = CoroutineMock()
+    await node_instance.send_stats(None, writer)
+    assert json.loads(writer.write.call_args[0][0])['distributed'] == 1
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_close(node_instance, connections):
+    node_instance.connections = ConnectionRegistry(connections)
+    node_instance.next_node_writer = MagicMock()
+    node_instance.next_node_writer.is_closing.return_value = False
+    task = asyncio.create_task(asyncio.sleep(10))
+    node_instance.tasks.append(task)
+
+    node_instance.close()
+    await asyncio.sleep(0)
+    assert task.cancelled()
+    assert node_instance.exiting
+    node_instance.next_node_writer.close.assert_called_once()
+    assert len(node_instance.connections) == 0
+
+
+@pytest.mark.asyncio
+async def test_broadcast(node_instance, message_instance, connections):
+    node_instance.connections = ConnectionRegistry(connections)
+    node_instance.next_node_writer = 'writer'
+    with patch('soucevi1_dist_chat.CNode.CNode.distribute_message', new=CoroutineMock()) as mocked_distribute:
+        with patch('soucevi1_dist_chat.CNode.CNode.send_message_to_ring', new=CoroutineMock()) as mocked_send:
+            # Star by default
+            await node_instance.broadcast(message_instance)
+            mocked_distribute.assert_called_once_with(message_instance)
+            assert message_instance.seq == 1
+
+            # Ring only if every node relays the messages
+            node_instance.dissemination = 'ring'
+            for conn in connections[1:]:
+                node_instance.connections.set_feature(conn.key(), 'ring', True)
+            await node_instance.broadcast(message_instance)
+            assert mocked_distribute.call_count == 2
+            mocked_send.assert_not_called()
+
+            node_instance.connections.set_feature(connections[0].key(), 'ring', True)
+            await node_instance.broadcast(message_instance)
+            mocked_send.assert_called_once_with(message_instance)
+            assert message_instance.message_type == MessageType.ring_user_message.value
+            assert message_instance.seq == 3
+
+
+def test_add_to_view(node_instance):
+    for port in range(100):
+        node_instance.add_to_view('1.1.1.1', port)
+    assert len(node_instance.view) == 16
+    assert len(set(node_instance.view)) == 16
+    node_instance.add_to_view(node_instance.address, node_instance.port)
+    assert (node_instance.address, str(node_instance.port)) not in node_instance.view
+
+
+@pytest.mark.asyncio
+async def test_gossip_from_leader(node_instance, message_instance):
+    connections = [CConnection('1.1.1.1', str(port), f'reader{port}', MagicMock()) for port in range(10)]
+    node_instance.connections = ConnectionRegistry(connections)
+    node_instance.next_node_address, node_instance.next_node_port = '1.1.1.1', '9'
+    node_instance.fanout = 3
+    await node_instance.gossip_from_leader(message_instance)
+
+    # Fanout nodes get the message, the next node always
+    assert sum(not conn.queue.empty() for conn in connections) == 3
+    assert not connections[9].queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_share_membership(node_instance):
+    connections = [CConnection('1.1.1.1', str(port), f'reader{port}', MagicMock()) for port in range(5)]
+    node_instance.connections = ConnectionRegistry(connections)
+    node_instance.fanout = 2
+    await node_instance.share_membership('1.1.1.1', '0')
+
+    # The new node gets the view, fanout other nodes get the new node
+    assert connections[0].queue.qsize() == 1
+    assert sum(conn.queue.qsize() for conn in connections[1:]) == 2
+    assert len(node_instance.sample_others(10, connections[0])) == 4
+    assert len(node_instance.sample_others(10, None)) == 5
+
+
+@pytest.mark.asyncio
+async def test_distribute_through_relays(node_instance, message_instance):
+    connections = [CConnection('1.1.1.1', str(port), f'reader{port}', MagicMock()) for port in range(10)]
+    node_instance.connections = ConnectionRegistry(connections)
+    node_instance.relay_threshold = 9
+    for conn in connections:
+        node_instance.connections.set_feature(conn.key(), 'relay', True)
+    await node_instance.broadcast(message_instance)
+
+    # 3 relays, each got its block and the message, the other nodes got nothing from the leader
+    assert [conn.queue.qsize() for conn in connections] == [2, 2, 2] + [0] * 7
+    assert sorted(len(block) for block in node_instance.relays.values()) == [2, 2, 3]
+
+    # Connections changed, the relays are assigned again
+    node_instance.close_connection(connections[0])
+    assert node_instance.relays is None
+    await node_instance.broadcast(message_instance)
+    assert connections[1].queue.qsize() == 4
+    assert len(node_instance.relays) == 3
+
+
+def test_keep_message(node_instance, message_instance):
+    node_instance.message_log = MagicMock()
+    message_instance.message_type = MessageType.ring_user_message
+    node_instance.keep_message(message_instance)
+    assert node_instance.history.since(None)[0].message_type == MessageType.user_message.value
+    node_instance.message_log.append.assert_not_called()
+
+    # Only the leader logs the messages, unless all the nodes do
+    node_instance.message_log_all = True
+    node_instance.keep_message(message_instance)
+    node_instance.is_leader = True
+    node_instance.message_log_all = False
+    node_instance.keep_message(message_instance)
+    assert node_instance.message_log.append.call_count == 2
+    assert len(node_instance.history) == 3
+
+
+@pytest.mark.asyncio
+async def test_unacked_messages(node_instance):
+    node_instance.send_message_to_leader = CoroutineMock()
+    node_instance.leader_writer = MagicMock()
+    first = node_instance.craft_message(MessageType.user_message, 'first')
+    second = node_instance.craft_message(MessageType.user_message, 'second')
+    await node_instance.send_user_message(first)
+    await node_instance.send_user_message(second)
+    assert second.sender_seq == first.sender_seq + 1
+    assert list(node_instance.unacked.values()) == [first, second]
+    assert node_instance.send_message_to_leader.call_count == 2
+    assert node_instance.pending() == 0
+
+    # Sent again to a new leader
+    node_instance.send_message_to_leader.reset_mock()
+    node_instance.outbox_sent = first.sender_seq - 1
+    with patch('soucevi1_dist_chat.CNode.OUTBOX_FLUSH_JITTER', 0):
+        await node_instance.flush_outbox()
+    assert [c[0][0] for c in node_instance.send_message_to_leader.call_args_list] == [first, second]
+
+    # The node itself became the leader
+    node_instance.is_leader = True
+    node_instance.broadcast = CoroutineMock()
+    await node_instance.broadcast_unacked()
+    assert [c[0][0] for c in node_instance.broadcast.call_args_list] == [first, second]
+    assert node_instance.unacked == {}
+
+
+@pytest.mark.asyncio
+async def test_outbox(node_instance):
+    node_instance.send_message_to_leader = CoroutineMock()
+    node_instance.output = MagicMock()
+    node_instance.outbox_size = 2
+    messages = [node_instance.craft_message(MessageType.user_message, text) for text in ('a', 'b', 'c')]
+
+    # No leader, the messages wait and the full outbox refuses the next one
+    for message in messages:
+        await node_instance.send_user_message(message)
+    node_instance.send_message_to_leader.assert_not_called()
+    assert list(node_instance.unacked.values()) == messages[:2]
+    assert node_instance.pending() == 2
+    node_instance.output.notice.assert_called_once()
+    assert node_instance.metrics.counter('outbox.refused').value == 1
+
+    # A message written while the outbox is sent to the new leader waits for the older ones
+    node_instance.leader_writer = MagicMock()
+    node_instance.outbox_size = 3
+    await node_instance.send_user_message(messages[2])
+    node_instance.send_message_to_leader.assert_not_called()
+    with patch('soucevi1_dist_chat.CNode.OUTBOX_FLUSH_JITTER', 0):
+        await node_instance.flush_outbox()
+    assert [c[0][0] for c in node_instance.send_message_to_leader.call_args_list] == messages
+    assert node_instance.pending() == 0
+    assert node_instance.metrics.counter('sent.retransmitted').value == 3